@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+bench.py — micro-benchmarks for the code that runs on every message.
+
+Synthetic data generators stand in for real opencode output and agent
+state, so the numbers are repeatable and need no credentials or network:
+
+  python bench/bench.py                       # run everything, print a table
+  python bench/bench.py -k state -k alias     # only benchmarks matching
+  python bench/bench.py --quick               # smaller inputs, shorter runs
+  python bench/bench.py --save baseline.json  # store results as a baseline
+  python bench/bench.py --compare baseline.json [--threshold 0.15]
+
+Each benchmark reports ops/sec (best of several timed rounds) and the peak
+memory allocated by one call (tracemalloc). --compare exits 1 if any
+benchmark got slower, or allocates more, than the baseline by more than
+--threshold.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "whatsapp"))
+
+import runopencode  # noqa: E402
+
+
+# ---------------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------------
+
+_rng = random.Random(1234)
+_WORDS = [
+    "".join(_rng.choices(string.ascii_lowercase, k=_rng.randint(2, 10)))
+    for _ in range(2000)
+]
+
+
+def gen_text(chars: int) -> str:
+    """Prose-like text: words, sentences and blank-line paragraph breaks."""
+    out, n = [], 0
+    while n < chars:
+        word = _rng.choice(_WORDS)
+        sep = _rng.choices([" ", ". ", "\n", "\n\n"], weights=[85, 10, 3, 2])[0]
+        out.append(word + sep)
+        n += len(word) + len(sep)
+    return "".join(out)[:chars]
+
+
+def gen_ndjson(parts: int, part_chars: int = 200) -> str:
+    """opencode --format=json stdout: step/tool events around text parts."""
+    sid = "ses_" + "".join(_rng.choices(string.ascii_letters + string.digits, k=24))
+    lines = [json.dumps({"type": "step_start", "sessionID": sid, "part": {}})]
+    for i in range(parts):
+        if i % 5 == 0:
+            lines.append(json.dumps({
+                "type": "tool_use", "sessionID": sid,
+                "part": {"tool": "read", "state": {"input": {"path": "x.md"}}},
+            }))
+        lines.append(json.dumps({
+            "type": "text", "sessionID": sid,
+            "part": {"type": "text", "text": gen_text(part_chars)},
+        }))
+    lines.append(json.dumps({"type": "step_finish", "sessionID": sid, "part": {}}))
+    return "\n".join(lines) + "\n"
+
+
+def gen_terminal_output(megabytes: float) -> str:
+    """Plain `opencode run` output: ANSI colour codes and `> build` lines."""
+    target = int(megabytes * 1024 * 1024)
+    colours = ["\x1b[0m", "\x1b[1m", "\x1b[32m", "\x1b[38;5;244m", "\x1b[?25l"]
+    out, n = ["\n\n\x1b[90m> build · openai/gpt-5.2\x1b[0m\n\n"], 0
+    while n < target:
+        line = gen_text(_rng.randint(20, 120)).replace("\n", " ")
+        if _rng.random() < 0.3:
+            line = _rng.choice(colours) + line + "\x1b[0m"
+        if _rng.random() < 0.01:
+            line = "\x1b[90m> build · step\x1b[0m"
+        out.append(line + ("\r\n" if _rng.random() < 0.1 else "\n"))
+        n += len(line) + 1
+    out.append("\n\n\n")
+    return "".join(out)
+
+
+def gen_state(sessions: int, aliases: int) -> dict:
+    """agent_state.json with `sessions` phone mappings and `aliases` names."""
+    sids = [
+        "ses_" + "".join(_rng.choices(string.ascii_letters + string.digits, k=24))
+        for _ in range(sessions)
+    ]
+    return {
+        "last_processed_time": datetime.now(timezone.utc).isoformat(),
+        "sessions": {f"whatsapp:+1555{i:07d}": sid for i, sid in enumerate(sids)},
+        "aliases": {f"alias-{i}": sids[i % len(sids)] for i in range(aliases)},
+    }
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+#
+# Each factory gets (size, workdir) and returns (fn, cleanup): fn() is the
+# operation being measured, cleanup() releases anything the setup opened.
+# ---------------------------------------------------------------------------
+
+BENCHMARKS: dict[str, Callable] = {}
+
+
+def bench(name: str):
+    def register(factory):
+        BENCHMARKS[name] = factory
+        return factory
+    return register
+
+
+def _noop() -> None:
+    pass
+
+
+@bench("ndjson_parse")
+def _ndjson_parse(size, workdir):
+    stdout = gen_ndjson(parts=size["ndjson_parts"])
+    return (lambda: runopencode.parse_json_events(stdout)), _noop
+
+
+@bench("strip_ansi")
+def _strip_ansi(size, workdir):
+    text = gen_terminal_output(size["output_mb"])
+    return (lambda: runopencode.strip_ansi(text)), _noop
+
+
+@bench("extract_answer")
+def _extract_answer(size, workdir):
+    text = gen_terminal_output(size["output_mb"])
+    return (lambda: runopencode.extract_answer(text)), _noop
+
+
+@bench("answer_stream")
+def _answer_stream(size, workdir):
+    text = gen_terminal_output(size["output_mb"])
+    chunks = [text[i:i + 4096] for i in range(0, len(text), 4096)]
+
+    def run():
+        cleaner = runopencode.AnswerCleaner()
+        for chunk in chunks:
+            cleaner.feed(chunk)
+        cleaner.finish()
+
+    return run, _noop
+
+
+def _json_store(size, workdir):
+    from state_store import StateStore
+    state = gen_state(size["sessions"], size["aliases"])
+    path = os.path.join(workdir, f"state-{_rng.random()}.json")
+    with open(path, "w") as f:
+        json.dump(state, f)
+    # Long interval: flushes happen only when the benchmark asks for them.
+    return StateStore(path, flush_interval=3600), state
+
+
+def _sqlite_store(size, workdir):
+    from sqlite_store import SqliteStore
+    state = gen_state(size["sessions"], size["aliases"])
+    state_path = os.path.join(workdir, f"state-{_rng.random()}.json")
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+    store = SqliteStore(os.path.join(workdir, f"state-{_rng.random()}.db"))
+    store.migrate_from_files(state_path, os.path.join(workdir, "missing.jsonl"))
+    return store, state
+
+
+@bench("state_load_json")
+def _state_load_json(size, workdir):
+    store, _ = _json_store(size, workdir)
+    return store.load, store.close
+
+
+@bench("state_save_json")
+def _state_save_json(size, workdir):
+    store, state = _json_store(size, workdir)
+    phones = list(state["sessions"])
+
+    def save():
+        store.set_session(_rng.choice(phones), "ses_bench")
+        store.flush()
+    return save, store.close
+
+
+@bench("state_save_sqlite")
+def _state_save_sqlite(size, workdir):
+    store, state = _sqlite_store(size, workdir)
+    phones = list(state["sessions"])
+    return (lambda: store.set_session(_rng.choice(phones), "ses_bench")), store.close
+
+
+@bench("alias_lookup_json")
+def _alias_lookup_json(size, workdir):
+    store, state = _json_store(size, workdir)
+    sids = list(state["sessions"].values())
+    return (lambda: store.alias_for_session(_rng.choice(sids))), store.close
+
+
+@bench("alias_lookup_sqlite")
+def _alias_lookup_sqlite(size, workdir):
+    store, state = _sqlite_store(size, workdir)
+    sids = list(state["sessions"].values())
+    return (lambda: store.alias_for_session(_rng.choice(sids))), store.close
+
+
+@bench("chunk_message")
+def _chunk_message(size, workdir):
+    from outbound import chunk_message
+    body = gen_text(size["reply_chars"])
+    return (lambda: chunk_message(body)), _noop
+
+
+@bench("metrics_observe")
+def _metrics_observe(size, workdir):
+    import metrics
+    return (lambda: metrics.observe("bench_seconds", _rng.random())), metrics.reset
+
+
+SIZES = {
+    "full": {
+        "ndjson_parts": 500,
+        "output_mb": 4,
+        "sessions": 5000,
+        "aliases": 5000,
+        "reply_chars": 20000,
+    },
+    "quick": {
+        "ndjson_parts": 50,
+        "output_mb": 0.5,
+        "sessions": 500,
+        "aliases": 500,
+        "reply_chars": 5000,
+    },
+}
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def measure(fn: Callable, min_time: float, rounds: int) -> dict:
+    """Best-of-`rounds` ops/sec, each round running fn for >= min_time."""
+    fn()  # warm caches and lazy imports
+
+    # Calibrate how many calls fill one round.
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10 or number >= 1 << 20:
+            break
+        number *= 10
+    number = max(1, int(number * (min_time / max(elapsed, 1e-9))))
+
+    best = float("inf")
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            best = min(best, (time.perf_counter() - start) / number)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"ops_per_sec": 1 / best, "sec_per_op": best, "peak_bytes": peak}
+
+
+def run(names: list[str], size: dict, min_time: float, rounds: int) -> dict:
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="hal-bench-")
+    try:
+        for name in names:
+            try:
+                fn, cleanup = BENCHMARKS[name](size, workdir)
+            except ImportError as e:
+                # e.g. outbound.py needs twilio installed
+                print(f"  {name}: skipped ({e})", file=sys.stderr)
+                continue
+            try:
+                results[name] = measure(fn, min_time, rounds)
+            finally:
+                cleanup()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Names of benchmarks that regressed by more than `threshold`."""
+    regressed = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        slower = cur["ops_per_sec"] < base["ops_per_sec"] * (1 - threshold)
+        # Ignore tiny absolute allocations; they are mostly noise.
+        bigger = (
+            cur["peak_bytes"] > 64 * 1024
+            and cur["peak_bytes"] > base["peak_bytes"] * (1 + threshold)
+        )
+        if slower or bigger:
+            regressed.append(name)
+    return regressed
+
+
+def _fmt_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+
+def _fmt_change(cur: float, base: Optional[float]) -> str:
+    if not base:
+        return ""
+    return f"{(cur / base - 1) * 100:+.1f}%"
+
+
+def print_table(results: dict, baseline: Optional[dict], regressed: list[str]) -> None:
+    header = f"{'benchmark':<22} {'ops/sec':>12} {'time/op':>11} {'peak mem':>10}"
+    if baseline is not None:
+        header += f" {'Δ ops/sec':>10} {'Δ mem':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        line = (
+            f"{name:<22} {r['ops_per_sec']:>12,.1f} "
+            f"{r['sec_per_op'] * 1e3:>9.3f}ms {_fmt_bytes(r['peak_bytes']):>10}"
+        )
+        if baseline is not None:
+            base = baseline.get(name, {})
+            line += (
+                f" {_fmt_change(r['ops_per_sec'], base.get('ops_per_sec')):>10}"
+                f" {_fmt_change(r['peak_bytes'], base.get('peak_bytes')):>8}"
+            )
+            if name in regressed:
+                line += "  REGRESSION"
+        print(line)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Micro-benchmarks for agent hot paths.")
+    ap.add_argument("-k", dest="filters", action="append", default=[],
+                    help="Only run benchmarks whose name contains this (repeatable)")
+    ap.add_argument("--list", action="store_true", help="List benchmarks and exit")
+    ap.add_argument("--quick", action="store_true", help="Smaller inputs, shorter rounds")
+    ap.add_argument("--rounds", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=None,
+                    help="Seconds per timed round (default 0.2, or 0.05 with --quick)")
+    ap.add_argument("--json", dest="json_out", help="Also write results to this file")
+    ap.add_argument("--save", help="Write results as a baseline file")
+    ap.add_argument("--compare", help="Baseline file to compare against")
+    ap.add_argument("--threshold", type=float, default=0.15,
+                    help="Allowed slowdown / memory growth before flagging (default 0.15)")
+    args = ap.parse_args()
+
+    names = [
+        n for n in BENCHMARKS
+        if not args.filters or any(f in n for f in args.filters)
+    ]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    profile = "quick" if args.quick else "full"
+    min_time = args.min_time or (0.05 if args.quick else 0.2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            stored = json.load(f)
+        if stored.get("profile") != profile:
+            print(
+                f"Warning: baseline was recorded with --{stored.get('profile')} inputs",
+                file=sys.stderr,
+            )
+        baseline = stored["results"]
+
+    results = run(names, SIZES[profile], min_time, args.rounds)
+    regressed = compare(results, baseline, args.threshold) if baseline else []
+    print_table(results, baseline, regressed)
+
+    report = {
+        "profile": profile,
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "ts": datetime.now(timezone.utc).isoformat(),
+        "results": results,
+    }
+    for path in (args.json_out, args.save):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+    if args.save:
+        print(f"\nBaseline saved to {args.save}")
+
+    if regressed:
+        print(f"\n{len(regressed)} regression(s) beyond {args.threshold:.0%}: "
+              + ", ".join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+"""
+replay.py — end-to-end load replay for the WhatsApp agent, offline.
+
+Runs the real agent.main() loop against an in-process fake Twilio (inbound
+served from messages.stream/list, replies captured by messages.create) and
+a fake `opencode` executable that emits NDJSON after a random latency, so
+polling, dispatch, opencode calls, state, trail and outbound pacing are
+all exercised with no network or credentials:
+
+  # replay a real trail at 10x speed, with 10x the senders
+  python bench/replay.py --trail whatsapp/trail.jsonl --speed 10 --scale 10
+
+  # synthetic traffic: 50 senders, 5 msgs/sec for 2 minutes
+  python bench/replay.py --senders 50 --rate 5 --duration 120 \
+      --llm-median 6 --llm-sigma 0.5 --fail-rate 0.02 --timeout-rate 0.01
+
+Each inbound body carries a [rid:N] tag that the fake opencode echoes, so
+replies can be matched to messages. The report covers end-to-end latency
+(inbound visible -> first reply chunk sent), queue wait and handling time
+percentiles, throughput, dropped and duplicated messages, fallback replies,
+and watermark correctness. Watermark correctness means last_processed_time
+is never saved past a message that had not finished, and it ends at the
+newest message.
+
+Needs the agent's own dependencies (twilio). Runs in a temporary working
+directory, so local agent_state.json / trail.jsonl are never touched.
+Inbound runs in poll mode; the webhook receiver is not exercised.
+"""
+
+from __future__ import annotations
+
+import _thread
+import argparse
+import atexit
+import gzip
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import stat
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "whatsapp"))
+
+RID_RE = re.compile(r"\[rid:(\d+)\]")
+
+
+# ---------------------------------------------------------------------------
+# Fake opencode
+# ---------------------------------------------------------------------------
+
+FAKE_OPENCODE = r'''#!{python}
+import json, math, os, random, re, sys, time
+
+cfg = json.loads(os.environ["FAKE_OPENCODE_CONFIG"])
+args = sys.argv[1:]
+prompt = args[1] if len(args) > 1 else ""
+session = next((a.split("=", 1)[1] for a in args if a.startswith("--session=")), None)
+rng = random.Random()
+
+roll = rng.random()
+if roll < cfg["fail_rate"]:
+    time.sleep(rng.uniform(0, cfg["median"]))
+    sys.stderr.write("fake opencode: simulated failure\n")
+    sys.exit(1)
+if roll < cfg["fail_rate"] + cfg["timeout_rate"]:
+    time.sleep(3600)  # the agent's timeout kills us
+
+sid = session or "ses_fake%012x" % rng.getrandbits(48)
+latency = rng.lognormvariate(math.log(cfg["median"]), cfg["sigma"])
+rids = re.findall(r"\[rid:(\d+)\]", prompt)
+words = [
+    "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 9)))
+    for _ in range(max(1, int(rng.expovariate(1 / cfg["reply_chars"]) / 6)))
+]
+paras = [" ".join(words[i:i + 40]) for i in range(0, len(words), 40)]
+# A coalesced prompt carries several tags; answer all of them.
+paras[0] = "".join(f"[rid:{r}] " for r in rids) + paras[0]
+
+def emit(event):
+    event["sessionID"] = sid
+    sys.stdout.write(json.dumps(event) + "\n")
+    sys.stdout.flush()
+
+emit({"type": "step_start", "part": {}})
+for i, para in enumerate(paras):
+    time.sleep(latency / len(paras))
+    text = para + ("\n\n" if i < len(paras) - 1 else "")
+    emit({"type": "text", "part": {"type": "text", "text": text}})
+emit({"type": "step_finish", "part": {}})
+'''
+
+
+def write_fake_opencode(workdir: str) -> str:
+    path = os.path.join(workdir, "fake-opencode")
+    with open(path, "w") as f:
+        f.write(FAKE_OPENCODE.replace("{python}", sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+# ---------------------------------------------------------------------------
+# Fake Twilio
+# ---------------------------------------------------------------------------
+
+@dataclass
+class FakeMessage:
+    sid: str
+    from_: str
+    to: str
+    body: str
+    date_sent: datetime
+    direction: str = "inbound"
+
+
+class FakeMessages:
+    """Twilio's client.messages: inbound visible once injected, replies recorded."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._inbound: list[FakeMessage] = []
+        self.sent: list[tuple[float, str, str]] = []   # (monotonic, to, body)
+        self.errors = 0
+        self.polls = 0
+        self._sid = itertools.count(1)
+
+    def inject(self, msg: FakeMessage) -> None:
+        with self._lock:
+            self._inbound.append(msg)
+
+    def stream(self, date_sent_after=None, to=None, page_size=None, **kwargs):
+        with self._lock:
+            self.polls += 1
+            msgs = [
+                m for m in self._inbound
+                if (to is None or m.to == to)
+                and (date_sent_after is None or m.date_sent >= date_sent_after)
+            ]
+        # Newest first, like the REST API.
+        return iter(sorted(msgs, key=lambda m: m.date_sent, reverse=True))
+
+    def list(self, **kwargs):
+        return list(self.stream(**kwargs))
+
+    def create(self, from_=None, body=None, to=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            from twilio.base.exceptions import TwilioRestException
+            with self._lock:
+                self.errors += 1
+            raise TwilioRestException(429, "fake://messages", "Too Many Requests")
+        with self._lock:
+            self.sent.append((time.monotonic(), to, body))
+            return FakeMessage(
+                sid=f"SMout{next(self._sid):08d}", from_=from_, to=to,
+                body=body, date_sent=datetime.now(timezone.utc),
+                direction="outbound-api",
+            )
+
+
+class FakeClient:
+    def __init__(self, messages: FakeMessages):
+        self.messages = messages
+
+
+# ---------------------------------------------------------------------------
+# Traffic
+# ---------------------------------------------------------------------------
+
+def load_trail(path: str, speed: float, scale: int) -> list[tuple[float, str, str]]:
+    """(offset_seconds, sender, text) for each inbound event in a trail file."""
+    opener = gzip.open if path.endswith(".gz") else open
+    events = []
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.get("inbound") and event.get("inbound_ts") and event.get("from"):
+                ts = datetime.fromisoformat(event["inbound_ts"]).timestamp()
+                events.append((ts, event["from"], event["inbound"]))
+    if not events:
+        raise SystemExit(f"No inbound events in {path}")
+    events.sort()
+    start = events[0][0]
+    rng = random.Random(7)
+    traffic = []
+    for k in range(scale):
+        # Each copy is a different set of senders, jittered so copies
+        # don't arrive in lockstep.
+        jitter = rng.uniform(0, 1) if k else 0.0
+        for ts, sender, text in events:
+            who = sender if k == 0 else f"{sender}~{k}"
+            traffic.append(((ts - start) / speed + jitter, who, text))
+    traffic.sort()
+    return traffic
+
+
+def synthetic(senders: int, rate: float, duration: float, command_rate: float,
+              seed: int) -> list[tuple[float, str, str]]:
+    """Poisson arrivals at `rate`/sec spread over `senders` (Zipf-ish skew)."""
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) ** 0.8 for i in range(senders)]
+    who = [f"whatsapp:+1555{i:07d}" for i in range(senders)]
+    traffic, t = [], 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration:
+            return traffic
+        text = "--id" if rng.random() < command_rate else "hello " * rng.randint(1, 30)
+        traffic.append((t, rng.choices(who, weights)[0], text.strip()))
+
+
+def _is_command(text: str) -> bool:
+    return text.startswith(("--", "!"))
+
+
+# ---------------------------------------------------------------------------
+# Harness
+# ---------------------------------------------------------------------------
+
+class Recorder:
+    """Per-message timings plus watermark checks, fed from agent hooks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.injected: dict[str, tuple[float, datetime, str]] = {}  # sid -> (t, date, rid)
+        self.started: dict[str, float] = {}
+        self.finished: dict[str, float] = {}
+        self.handled_count: dict[str, int] = {}
+        self.shed: set[str] = set()
+        self.watermarks: list[datetime] = []
+        self.violations: list[str] = []
+
+    def handle_start(self, sid: str) -> None:
+        with self.lock:
+            self.started.setdefault(sid, time.monotonic())
+            self.handled_count[sid] = self.handled_count.get(sid, 0) + 1
+
+    def handle_end(self, sid: str) -> None:
+        with self.lock:
+            self.finished[sid] = time.monotonic()
+
+    def shed_message(self, sid: str) -> None:
+        """Refused by admission control: done, but not handled."""
+        with self.lock:
+            self.shed.add(sid)
+            self.finished[sid] = time.monotonic()
+
+    def watermark(self, dt: datetime) -> None:
+        with self.lock:
+            self.watermarks.append(dt)
+            for sid, (_, date, _) in self.injected.items():
+                if date <= dt and sid not in self.finished:
+                    self.violations.append(
+                        f"watermark {dt.isoformat()} passed unfinished {sid}"
+                    )
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+
+    def pct(p: float) -> float:
+        return v[min(len(v) - 1, max(0, math.ceil(p * len(v)) - 1))]
+    return {
+        "n": len(v), "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99),
+        "max": v[-1], "mean": sum(v) / len(v),
+    }
+
+
+def run(args, traffic) -> dict:
+    workdir = tempfile.mkdtemp(prefix="hal-replay-")
+    os.chdir(workdir)
+    os.environ["FAKE_OPENCODE_CONFIG"] = json.dumps({
+        "median": args.llm_median,
+        "sigma": args.llm_sigma,
+        "fail_rate": args.fail_rate,
+        "timeout_rate": args.timeout_rate,
+        "reply_chars": args.reply_chars,
+    })
+
+    import agent
+    import metrics
+    from outbound import OutboundSender
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    fake = FakeMessages(latency=args.twilio_latency, error_rate=args.twilio_error_rate)
+    rec = Recorder()
+
+    agent.ACCOUNT_SID, agent.AUTH_TOKEN = "ACreplay", "replay"
+    agent.OPENCODE_PATH = write_fake_opencode(workdir)
+    agent.OPENCODE_BACKEND = "subprocess"
+    agent.OPENCODE_TIMEOUT = args.opencode_timeout
+    agent.INBOUND_MODE = "poll"
+    agent.STATE_BACKEND = args.state_backend
+    agent.STREAM_REPLIES = args.stream
+    agent.MAX_CONCURRENCY = args.concurrency
+    agent.COALESCE_WINDOW = args.coalesce_window
+    agent.SENDER_RATE_PER_MIN = args.sender_rate_per_min
+    agent.MAX_OPENCODE = args.max_opencode or args.concurrency
+    agent.MAX_QUEUE = args.max_queue
+    agent.REPLY_BUDGET = args.reply_budget
+    agent.POLL_MIN_INTERVAL = args.poll_min
+    agent.POLL_MAX_INTERVAL = args.poll_max
+    agent.METRICS_PORT = agent.STATS_FILE = None
+    agent._outbound_sender = OutboundSender(
+        agent.ACCOUNT_SID, agent.AUTH_TOKEN, agent.FROM_WA,
+        rate=args.outbound_rate, burst=args.outbound_burst,
+    )
+    agent._outbound_sender.client = FakeClient(fake)
+
+    real_handle = agent.handle_message
+    real_save = agent.save_last_processed_time
+    real_shed = agent.shed_message
+
+    def handle_message(msg_date, msg, identity_text):
+        sids = [p.sid for p in getattr(msg, "parts", None) or [msg]]
+        for sid in sids:
+            rec.handle_start(sid)
+        try:
+            real_handle(msg_date, msg, identity_text)
+        finally:
+            for sid in sids:
+                rec.handle_end(sid)
+
+    def save_last_processed_time(dt):
+        rec.watermark(dt)
+        real_save(dt)
+
+    def shed_message(msg_date, msg, reason):
+        rec.shed_message(msg.sid)
+        real_shed(msg_date, msg, reason)
+
+    agent.handle_message = handle_message
+    agent.shed_message = shed_message
+    agent.save_last_processed_time = save_last_processed_time
+
+    # main() starts from "now"; everything injected is newer.
+    agent.get_last_processed_time = lambda: datetime.now(timezone.utc) - timedelta(seconds=1)
+
+    stop = threading.Event()
+
+    def inject():
+        t0 = time.monotonic()
+        for i, (offset, sender, text) in enumerate(traffic):
+            delay = t0 + offset - time.monotonic()
+            if delay > 0 and stop.wait(delay):
+                return
+            rid = "" if _is_command(text) else str(i)
+            body = text if not rid else f"{text} [rid:{rid}]"
+            now = datetime.now(timezone.utc)
+            msg = FakeMessage(f"SMin{i:08d}", sender, agent.FROM_WA, body, now)
+            with rec.lock:
+                rec.injected[msg.sid] = (time.monotonic(), now, rid)
+            fake.inject(msg)
+
+        # Wait for every message to finish and every reply to go out.
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline and not stop.is_set():
+            with rec.lock:
+                done = all(sid in rec.finished for sid in rec.injected)
+            if done and agent._outbound_sender.pending() == 0:
+                break
+            time.sleep(0.2)
+        time.sleep(1)  # let the last in-progress send complete
+        _thread.interrupt_main()
+
+    injector = threading.Thread(target=inject, name="replay-inject", daemon=True)
+    t_start = time.monotonic()
+    injector.start()
+    try:
+        agent.main()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        atexit.unregister(agent.shutdown)
+        watermark = agent._state().get_last_processed_time()
+        agent.shutdown()
+    t_end = time.monotonic()
+
+    return report(args, rec, fake, watermark, t_end - t_start, metrics.snapshot())
+
+
+def report(args, rec: Recorder, fake: FakeMessages, watermark, wall: float,
+           snapshot: dict) -> dict:
+    first_reply: dict[str, float] = {}
+    reply_count: dict[str, int] = {}
+    for t, _, body in fake.sent:
+        for m in RID_RE.finditer(body):
+            rid = m.group(1)
+            first_reply.setdefault(rid, t)
+            reply_count[rid] = reply_count.get(rid, 0) + 1
+
+    e2e, wait, handle = [], [], []
+    dropped, fallbacks = [], 0
+    for sid, (t_in, _, rid) in rec.injected.items():
+        if sid in rec.shed:
+            continue
+        if sid not in rec.finished:
+            dropped.append(sid)
+            continue
+        wait.append(rec.started[sid] - t_in)
+        handle.append(rec.finished[sid] - rec.started[sid])
+        if rid:
+            if rid in first_reply:
+                e2e.append(first_reply[rid] - t_in)
+            else:
+                fallbacks += 1
+
+    newest = max((date for _, date, _ in rec.injected.values()), default=None)
+    handled = len(rec.finished) - len(rec.shed)
+    span = (
+        max(rec.finished.values()) - min(t for t, _, _ in rec.injected.values())
+        if rec.finished else 0.0
+    )
+    return {
+        "messages": len(rec.injected),
+        "handled": handled,
+        "dropped": len(dropped),
+        "shed": len(rec.shed),
+        "duplicated_handling": sum(1 for n in rec.handled_count.values() if n > 1),
+        "duplicated_replies": sum(1 for n in reply_count.values() if n > 1)
+        if not args.stream else None,
+        "fallback_replies": fallbacks,
+        "replies_sent": len(fake.sent),
+        "twilio_errors": fake.errors,
+        "polls": fake.polls,
+        "throughput_per_sec": handled / span if span else 0.0,
+        "wall_seconds": wall,
+        "latency_e2e": percentiles(e2e),
+        "latency_queue_wait": percentiles(wait),
+        "latency_handle": percentiles(handle),
+        "watermark": {
+            "final": watermark.isoformat() if watermark else None,
+            "newest_message": newest.isoformat() if newest else None,
+            "caught_up": bool(watermark and newest and watermark >= newest),
+            "advances": len(rec.watermarks),
+            "monotonic": all(a < b for a, b in zip(rec.watermarks, rec.watermarks[1:])),
+            "violations": rec.violations[:20],
+        },
+        "metrics": snapshot,
+    }
+
+
+def print_report(r: dict) -> None:
+    print()
+    print(f"messages        {r['messages']:>8}   handled {r['handled']}"
+          f"   dropped {r['dropped']}   shed {r['shed']}"
+          f"   duplicated {r['duplicated_handling']}")
+    print(f"replies sent    {r['replies_sent']:>8}   fallbacks {r['fallback_replies']}"
+          f"   twilio errors {r['twilio_errors']}   polls {r['polls']}")
+    if r["duplicated_replies"] is not None:
+        print(f"dup replies     {r['duplicated_replies']:>8}")
+    print(f"throughput      {r['throughput_per_sec']:>8.2f} msg/s"
+          f"   wall {r['wall_seconds']:.1f}s")
+    print()
+    print(f"{'latency (s)':<16}{'n':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for label, key in (("end-to-end", "latency_e2e"),
+                       ("queue wait", "latency_queue_wait"),
+                       ("handling", "latency_handle")):
+        p = r[key]
+        if not p["n"]:
+            print(f"{label:<16}{0:>7}")
+            continue
+        print(f"{label:<16}{p['n']:>7}{p['p50']:>9.2f}{p['p90']:>9.2f}"
+              f"{p['p99']:>9.2f}{p['max']:>9.2f}")
+    w = r["watermark"]
+    print()
+    print(f"watermark       caught up: {w['caught_up']}   monotonic: {w['monotonic']}"
+          f"   advances: {w['advances']}   violations: {len(w['violations'])}")
+    for v in w["violations"]:
+        print(f"  ! {v}")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Offline end-to-end load replay for the agent.")
+    src = ap.add_argument_group("traffic")
+    src.add_argument("--trail", help="Replay inbound messages from this trail.jsonl(.gz)")
+    src.add_argument("--speed", type=float, default=1.0, help="Compress trail time by this factor")
+    src.add_argument("--scale", type=int, default=1, help="Replay the trail N times over distinct senders")
+    src.add_argument("--senders", type=int, default=20, help="Synthetic: number of senders")
+    src.add_argument("--rate", type=float, default=1.0, help="Synthetic: messages per second")
+    src.add_argument("--duration", type=float, default=60, help="Synthetic: seconds of traffic")
+    src.add_argument("--command-rate", type=float, default=0.02, help="Synthetic: share of --id commands")
+    src.add_argument("--seed", type=int, default=1)
+
+    oc = ap.add_argument_group("fake opencode")
+    oc.add_argument("--llm-median", type=float, default=5.0, help="Median reply latency (s)")
+    oc.add_argument("--llm-sigma", type=float, default=0.5, help="Lognormal sigma of latency")
+    oc.add_argument("--fail-rate", type=float, default=0.0)
+    oc.add_argument("--timeout-rate", type=float, default=0.0)
+    oc.add_argument("--reply-chars", type=int, default=600, help="Mean reply length")
+    oc.add_argument("--opencode-timeout", type=float, default=30)
+
+    tw = ap.add_argument_group("fake twilio")
+    tw.add_argument("--twilio-latency", type=float, default=0.05, help="Seconds per create()")
+    tw.add_argument("--twilio-error-rate", type=float, default=0.0, help="Share of 429s on create()")
+
+    ag = ap.add_argument_group("agent")
+    ag.add_argument("--concurrency", type=int, default=4)
+    ag.add_argument("--coalesce-window", type=float, default=2,
+                    help="Seconds to wait for more messages from a sender (0: no wait)")
+    ag.add_argument("--max-opencode", type=int, default=0,
+                    help="Concurrent opencode calls (default: --concurrency)")
+    ag.add_argument("--sender-rate-per-min", type=float, default=0,
+                    help="Per-sender admission rate (0: off)")
+    ag.add_argument("--max-queue", type=int, default=0,
+                    help="Pending messages before shedding (0: off)")
+    ag.add_argument("--reply-budget", type=float, default=0,
+                    help="Seconds a reply may take before it is shed (0: off)")
+    ag.add_argument("--outbound-rate", type=float, default=1 / 3)
+    ag.add_argument("--outbound-burst", type=float, default=1)
+    ag.add_argument("--poll-min", type=float, default=2)
+    ag.add_argument("--poll-max", type=float, default=30)
+    ag.add_argument("--state-backend", choices=["json", "sqlite"], default="json")
+    ag.add_argument("--stream", action="store_true", help="Stream replies paragraph by paragraph")
+
+    ap.add_argument("--drain-timeout", type=float, default=300,
+                    help="Max seconds to wait for the backlog after the last message")
+    ap.add_argument("--json", dest="json_out", help="Write the full report here")
+    ap.add_argument("-v", "--verbose", action="store_true", help="Show the agent's INFO logs")
+    args = ap.parse_args()
+
+    if args.trail:
+        traffic = load_trail(os.path.abspath(args.trail), args.speed, args.scale)
+    else:
+        traffic = synthetic(args.senders, args.rate, args.duration,
+                            args.command_rate, args.seed)
+    if not traffic:
+        raise SystemExit("No traffic to replay")
+    json_out = os.path.abspath(args.json_out) if args.json_out else None
+    print(f"Replaying {len(traffic)} messages over {traffic[-1][0]:.0f}s", file=sys.stderr)
+
+    result = run(args, traffic)
+    print_report(result)
+    if json_out:
+        with open(json_out, "w") as f:
+            json.dump(result, f, indent=2, default=str)
+
+    ok = (
+        not result["dropped"]
+        and not result["duplicated_handling"]
+        and result["watermark"]["caught_up"]
+        and not result["watermark"]["violations"]
+    )
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -7,18 +7,54 @@ Examples:
   echo "Tell me a joke" | python runopencode.py
   python runopencode.py --input "Hello" --model openai/gpt-5.2 --variant medium
   python runopencode.py --input "Hello" --raw
+  python runopencode.py --input "Write a story" --stream
+  python runopencode.py --batch prompts.jsonl --output results.jsonl --workers 4
+  python runopencode.py --input "Daily summary format?" --cache
+  python runopencode.py --cache-stats
+
+Batch input is one JSON object per line: {"prompt": "..."} plus optional
+"model", "variant", "session", "timeout" and "id". Results are appended to
+--output as each item finishes (completion order), tagged with the item's
+"index" (0-based position among the non-blank input lines). Re-running the
+same command skips items that already have a successful result.
+
+--cache (or RUNOPENCODE_CACHE=1) reuses earlier answers to the same
+prompt/model/variant/format from an on-disk cache (default
+~/.cache/runopencode). Entries expire after --cache-ttl seconds, and the
+least recently used are evicted past --cache-max-mb. Calls with --session
+are never cached; --no-cache bypasses the cache for one call. A cached
+--format json answer is replayed without its sessionID fields, so the
+session it came from is never handed to another caller.
+
+--stream prints the answer as opencode produces it instead of after the
+run, cleaned the same way as the buffered answer (ANSI codes, "> build"
+lines and surrounding blank lines removed) in constant memory. With
+--format json the NDJSON lines are passed through as they arrive.
+Streamed calls skip the cache.
 """
 
 from __future__ import annotations
 
 import argparse
+import codecs
+import fcntl
+import hashlib
+import json
 import os
 import re
 import subprocess
 import sys
-from typing import Optional
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, Optional
 
 ANSI_RE = re.compile(r"\x1b\[[0-9;?]*[ -/]*[@-~]")
+# An escape sequence cut off at the end of a chunk.
+ANSI_PARTIAL_RE = re.compile(r"\x1b(\[[0-9;?]*[ -/]*)?\Z")
+# A line start that could still become a "> build" line.
+BUILD_PREFIX_RE = re.compile(r"\s*(>\s*(b(u(i(l(d)?)?)?)?)?)?\Z", re.IGNORECASE)
 BUILD_LINE_RE = re.compile(r"^\s*>\s*build\b", re.IGNORECASE)
 
 
@@ -31,24 +67,130 @@ def extract_answer(text: str) -> str:
     Heuristic:
     - Strip ANSI
     - Remove opencode metadata lines (e.g., '> build · ...') wherever they appear
-    - Trim leading/trailing blank lines
+    - Trim leading/trailing blank lines (by index, in one pass each way)
+
+    AnswerCleaner does the same incrementally for streamed output.
     """
     txt = strip_ansi(text).replace("\r\n", "\n").replace("\r", "\n")
-    lines = [ln.rstrip() for ln in txt.split("\n")]
+    lines = [
+        ln for ln in (raw.rstrip() for raw in txt.split("\n"))
+        if not BUILD_LINE_RE.match(ln)
+    ]
 
-    cleaned_lines: list[str] = []
-    for ln in lines:
-        if BUILD_LINE_RE.match(ln):
-            continue
-        cleaned_lines.append(ln)
+    start, end = 0, len(lines)
+    while start < end and not lines[start]:
+        start += 1
+    while end > start and not lines[end - 1]:
+        end -= 1
+
+    return "\n".join(lines[start:end]).strip()
+
+
+class AnswerCleaner:
+    """
+    extract_answer as a single pass over chunks of output: feed() returns
+    the cleaned text that is certain so far, finish() the rest. Concatenated,
+    they equal extract_answer(all chunks joined).
+
+    Only what cannot be decided yet is held back: an escape sequence or
+    "\r" split at a chunk boundary, a line start that might turn out to be
+    "> build", trailing whitespace, and blank lines (dropped if nothing
+    follows). Memory stays bounded by MAX_HOLD however long the output is.
+    """
 
-    # trim leading/trailing empties
-    while cleaned_lines and cleaned_lines[0].strip() == "":
-        cleaned_lines.pop(0)
-    while cleaned_lines and cleaned_lines[-1].strip() == "":
-        cleaned_lines.pop()
+    MAX_HOLD = 64 * 1024
 
-    return "\n".join(cleaned_lines).strip()
+    def __init__(self):
+        self._carry = ""       # undecoded escape sequence / "\r" from last chunk
+        self._line = ""        # held part of the current line
+        self._mid_line = False  # some of the current line was already emitted
+        self._skip = False      # the current line is a "> build" line
+        self._started = False   # any text emitted at all
+        self._blanks = 0        # blank lines held since the last text
+
+    def feed(self, chunk: str) -> str:
+        text = self._carry + chunk
+        self._carry = ""
+        esc = text.rfind("\x1b")
+        if esc >= 0 and ANSI_PARTIAL_RE.match(text, esc):
+            text, self._carry = text[:esc], text[esc:]
+        text = strip_ansi(text)
+        if text.endswith("\r"):
+            text, self._carry = text[:-1], "\r" + self._carry
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+        out: list[str] = []
+        *lines, tail = text.split("\n")
+        end_line = self._end_line
+        for ln in lines:
+            if self._line:
+                ln, self._line = self._line + ln, ""
+            end_line(ln, out)
+        self._line += tail
+        self._partial(out)
+        return "".join(out)
+
+    def finish(self) -> str:
+        out: list[str] = []
+        if self._carry:
+            # A cut-off escape sequence is kept as text, like strip_ansi does.
+            self._line += self._carry.replace("\r", "\n")
+            self._carry = ""
+            *lines, self._line = self._line.split("\n")
+            for ln in lines:
+                self._end_line(ln, out)
+        line, self._line = self._line, ""
+        self._end_line(line, out)
+        self._blanks = 0
+        return "".join(out)
+
+    def _emit(self, text: str, out: list[str]) -> None:
+        if not self._mid_line:
+            if not self._started:
+                text = text.lstrip()
+                if not text:
+                    return
+                self._started = True
+            else:
+                out.append("\n" * (1 + self._blanks))
+                self._blanks = 0
+            self._mid_line = True
+        out.append(text)
+
+    def _end_line(self, line: str, out: list[str]) -> None:
+        """Finish the current line, whose held part plus rest is `line`."""
+        line = line.rstrip()
+        if self._skip:
+            self._skip = False
+        elif self._mid_line:
+            out.append(line)
+        elif BUILD_LINE_RE.match(line):
+            pass
+        elif line:
+            self._emit(line, out)
+        elif self._started:
+            self._blanks += 1
+        self._mid_line = False
+
+    def _partial(self, out: list[str]) -> None:
+        """Emit the undecided current line as far as it is safe to."""
+        line = self._line
+        if self._skip:
+            self._line = ""
+            return
+        if not self._mid_line:
+            if BUILD_PREFIX_RE.match(line) and len(line) < self.MAX_HOLD:
+                return
+            if BUILD_LINE_RE.match(line):
+                self._skip = True
+                self._line = ""
+                return
+        body = line.rstrip()
+        if len(line) - len(body) >= self.MAX_HOLD:
+            body = line
+        if body:
+            self._emit(body, out)
+            self._line = line[len(body):]
 
 
 def read_prompt(cli_input: Optional[str]) -> str:
@@ -63,51 +205,774 @@ def read_prompt(cli_input: Optional[str]) -> str:
     raise SystemExit("No input provided. Use --input or pipe via stdin.")
 
 
+# ---------------------------------------------------------------------------
+# Importable API (used by whatsapp/agent.py to call opencode directly)
+# ---------------------------------------------------------------------------
+
+DEFAULT_MODEL = "openai/gpt-5.2"
+DEFAULT_VARIANT = "medium"
+DEFAULT_TIMEOUT = 120
+
+
+def build_command(
+    prompt: str,
+    model: str = DEFAULT_MODEL,
+    variant: str = DEFAULT_VARIANT,
+    session: Optional[str] = None,
+    fmt: Optional[str] = None,
+    opencode: str = "opencode",
+) -> list[str]:
+    """Argument vector for `opencode run`."""
+    cmd = [
+        opencode,
+        "run",
+        prompt,
+        f"--model={model}",
+        f"--variant={variant}",
+    ]
+
+    if session:
+        cmd.append(f"--session={session}")
+
+    if fmt:
+        cmd.append(f"--format={fmt}")
+
+    return cmd
+
+
+def build_env(base: Optional[dict] = None) -> dict:
+    """Environment for opencode with fancy terminal output discouraged."""
+    env = dict(os.environ if base is None else base)
+    # Encourage non-fancy output (still safe if opencode ignores)
+    env.setdefault("TERM", "dumb")
+    env.setdefault("NO_COLOR", "1")
+    env.setdefault("CLICOLOR", "0")
+    return env
+
+
+def run_opencode(
+    prompt: str,
+    model: str = DEFAULT_MODEL,
+    variant: str = DEFAULT_VARIANT,
+    session: Optional[str] = None,
+    fmt: Optional[str] = None,
+    opencode: str = "opencode",
+    timeout: float = DEFAULT_TIMEOUT,
+    on_start: Optional[Callable[[subprocess.Popen], None]] = None,
+) -> subprocess.CompletedProcess:
+    """
+    Run `opencode run` once and capture its output.
+    Raises FileNotFoundError / subprocess.TimeoutExpired like subprocess.run.
+    on_start, if given, receives the Popen right after it is spawned (e.g.
+    so another thread can kill an abandoned run).
+    """
+    cmd = build_command(prompt, model, variant, session, fmt, opencode)
+    with subprocess.Popen(
+        cmd,
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=build_env(),
+        stdin=subprocess.DEVNULL,
+    ) as proc:
+        if on_start:
+            on_start(proc)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        except BaseException:
+            proc.kill()
+            raise
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+def stream_output(
+    prompt: str,
+    model: str = DEFAULT_MODEL,
+    variant: str = DEFAULT_VARIANT,
+    session: Optional[str] = None,
+    fmt: Optional[str] = None,
+    opencode: str = "opencode",
+    timeout: float = DEFAULT_TIMEOUT,
+    on_start: Optional[Callable[[subprocess.Popen], None]] = None,
+    chunk_size: int = 65536,
+) -> Iterator[tuple[str, str]]:
+    """
+    Run `opencode run` and yield ("stdout", text) chunks as soon as they
+    arrive. stderr is spooled to a temporary file and, once the run has
+    exited cleanly, yielded as ("stderr", text) chunks.
+
+    Raises like stream_json_events. on_start is as for run_opencode.
+    """
+    cmd = build_command(prompt, model, variant, session, fmt, opencode)
+    with tempfile.TemporaryFile(mode="w+b") as err:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=err,
+            env=build_env(),
+            stdin=subprocess.DEVNULL,
+        )
+        if on_start:
+            on_start(proc)
+        timed_out = threading.Event()
+
+        def expire() -> None:
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        try:
+            while True:
+                data = proc.stdout.read1(chunk_size)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    yield "stdout", text
+                if not data:
+                    break
+            proc.wait()
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        err.seek(0)
+        if proc.returncode != 0:
+            stderr = err.read().decode("utf-8", errors="replace")
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            data = err.read(chunk_size)
+            text = decoder.decode(data, final=not data)
+            if text:
+                yield "stderr", text
+            if not data:
+                break
+
+
+def stream_answer(prompt: str, **kwargs) -> Iterator[str]:
+    """
+    The answer from stream_output, cleaned like extract_answer and yielded
+    as it arrives, in constant memory. If stdout carried no answer, the
+    cleaned stderr is used instead (as the buffered CLI falls back to it).
+    """
+    cleaner = AnswerCleaner()
+    answered = False
+    source = "stdout"
+    for stream, chunk in stream_output(prompt, **kwargs):
+        if stream != source:
+            # stdout is complete; stderr only matters if it said nothing.
+            text = cleaner.finish()
+            if text:
+                answered = True
+                yield text
+            if answered:
+                return
+            cleaner, source = AnswerCleaner(), stream
+        text = cleaner.feed(chunk)
+        if text:
+            answered = True
+            yield text
+    text = cleaner.finish()
+    if text:
+        yield text
+
+
+def stream_json_events(
+    prompt: str,
+    model: str = DEFAULT_MODEL,
+    variant: str = DEFAULT_VARIANT,
+    session: Optional[str] = None,
+    opencode: str = "opencode",
+    timeout: float = DEFAULT_TIMEOUT,
+    on_start: Optional[Callable[[subprocess.Popen], None]] = None,
+) -> Iterator[dict]:
+    """
+    Run `opencode run --format=json` and yield each NDJSON event as soon as
+    its line arrives. Non-JSON lines are skipped.
+
+    Raises subprocess.TimeoutExpired if the run exceeds `timeout`, and
+    subprocess.CalledProcessError (with stderr) on a non-zero exit. Closing
+    the generator early kills the process. on_start is as for run_opencode.
+    """
+    cmd = build_command(prompt, model, variant, session, "json", opencode)
+    with tempfile.TemporaryFile(mode="w+") as err:
+        proc = subprocess.Popen(
+            cmd,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=err,
+            env=build_env(),
+            stdin=subprocess.DEVNULL,
+        )
+        if on_start:
+            on_start(proc)
+        timed_out = threading.Event()
+
+        def expire() -> None:
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        try:
+            for line in proc.stdout:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+            proc.wait()
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if proc.returncode != 0:
+            err.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=err.read())
+
+
+def parse_json_events(stdout: str) -> tuple[str, Optional[str]]:
+    """
+    Extract the answer from `--format json` NDJSON output.
+    Returns (joined text parts, first sessionID seen). Bad lines are skipped.
+    """
+    response_parts: list[str] = []
+    session_id = None
+
+    for line in stdout.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+
+        # Capture session ID from any event
+        if not session_id:
+            session_id = data.get("sessionID")
+
+        # Collect text parts
+        if data.get("type") == "text":
+            text = data.get("part", {}).get("text")
+            if text:
+                response_parts.append(text)
+
+    return "".join(response_parts).strip(), session_id
+
+
+# ---------------------------------------------------------------------------
+# Response cache (stateless calls only)
+# ---------------------------------------------------------------------------
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "runopencode"
+)
+DEFAULT_CACHE_TTL = 24 * 3600
+DEFAULT_CACHE_MAX_MB = 100
+
+
+def strip_session_ids(stdout: str) -> str:
+    """NDJSON output with every "sessionID" field removed (other lines as is)."""
+
+    def strip(value):
+        if isinstance(value, dict):
+            return {k: strip(v) for k, v in value.items() if k != "sessionID"}
+        if isinstance(value, list):
+            return [strip(v) for v in value]
+        return value
+
+    lines = []
+    for line in stdout.splitlines(keepends=True):
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            lines.append(line)
+            continue
+        lines.append(json.dumps(strip(event)) + ("\n" if line.endswith("\n") else ""))
+    return "".join(lines)
+
+
+class ResponseCache:
+    """
+    One JSON file per (prompt hash, model, variant, format) key holding a
+    successful run's stdout/stderr. File mtime is the last-use time: hits
+    touch it, and eviction removes the least recently used files once the
+    directory exceeds max_bytes. Hit/miss counters live in stats.json,
+    updated under an flock so concurrent runs don't lose counts.
+    """
+
+    STATS_FILE = "stats.json"
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CACHE_DIR,
+        ttl: float = DEFAULT_CACHE_TTL,
+        max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(prompt: str, model: str, variant: str, fmt: Optional[str]) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return hashlib.sha256(
+            json.dumps([prompt_hash, model, variant, fmt or ""]).encode("utf-8")
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self._count("misses")
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            self._remove(path)
+            self._count("misses")
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count("hits")
+        return entry
+
+    def put(self, key: str, stdout: str, stderr: str) -> None:
+        entry = {"created": time.time(), "stdout": stdout, "stderr": stderr}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self._evict()
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """(mtime, size, path) of every cache entry."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or name == self.STATS_FILE:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self) -> None:
+        """Drop expired entries, then least recently used ones past max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.ttl
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and mtime >= cutoff:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _count(self, field: str) -> None:
+        path = os.path.join(self.directory, self.STATS_FILE)
+        try:
+            with open(path, "a+", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    stats = json.loads(f.read() or "{}")
+                except json.JSONDecodeError:
+                    stats = {}
+                stats[field] = stats.get(field, 0) + 1
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(stats))
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, self.STATS_FILE), "r") as f:
+                counts = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            counts = {}
+        entries = self._entries()
+        hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+        return {
+            "directory": self.directory,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+        }
+
+
+def run_opencode_cached(
+    prompt: str,
+    model: str = DEFAULT_MODEL,
+    variant: str = DEFAULT_VARIANT,
+    session: Optional[str] = None,
+    fmt: Optional[str] = None,
+    opencode: str = "opencode",
+    timeout: float = DEFAULT_TIMEOUT,
+    cache: Optional[ResponseCache] = None,
+) -> subprocess.CompletedProcess:
+    """
+    run_opencode, answered from `cache` when possible. Only stateless calls
+    (no session) are looked up or stored, and only successful runs with
+    output are stored. A json-format hit carries no session ID: the stored
+    run's session belongs to whoever made it, and continuing it would
+    append to their conversation.
+    """
+    if cache is None or session:
+        return run_opencode(prompt, model, variant, session, fmt, opencode, timeout)
+
+    key = cache.key(prompt, model, variant, fmt)
+    entry = cache.get(key)
+    if entry is not None:
+        cmd = build_command(prompt, model, variant, session, fmt, opencode)
+        stdout = entry["stdout"]
+        if fmt == "json":
+            stdout = strip_session_ids(stdout)
+        return subprocess.CompletedProcess(cmd, 0, stdout, entry["stderr"])
+
+    proc = run_opencode(prompt, model, variant, session, fmt, opencode, timeout)
+    if proc.returncode == 0 and (proc.stdout or "").strip():
+        try:
+            cache.put(key, proc.stdout, proc.stderr or "")
+        except OSError as e:
+            print(f"WARNING: could not write response cache: {e}", file=sys.stderr)
+    return proc
+
+
+# ---------------------------------------------------------------------------
+# Batch mode
+# ---------------------------------------------------------------------------
+
+def read_batch(path: str) -> Iterator[tuple[int, dict]]:
+    """(index, item) for each non-blank line; unparseable lines yield {"error": ...}."""
+    with open(path, "r", encoding="utf-8") as f:
+        index = 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+                if isinstance(item, str):
+                    item = {"prompt": item}
+                if not isinstance(item, dict) or not str(item.get("prompt") or "").strip():
+                    item = {"error": "item has no prompt"}
+                elif item.get("timeout") and not valid_timeout(item["timeout"]):
+                    item = {**item, "error": f"invalid timeout: {item['timeout']!r}"}
+            except json.JSONDecodeError as e:
+                item = {"error": f"invalid JSON: {e}"}
+            yield index, item
+            index += 1
+
+
+def valid_timeout(value) -> bool:
+    try:
+        return 0 < float(value) < float("inf")
+    except (TypeError, ValueError):
+        return False
+
+
+def completed_indexes(output: str) -> set[int]:
+    """Indexes that already have a successful result in `output`."""
+    done: set[int] = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # e.g. a line cut short by a crash
+            if rec.get("ok") and isinstance(rec.get("index"), int):
+                done.add(rec["index"])
+    return done
+
+
+def run_batch_item(
+    index: int,
+    item: dict,
+    model: str = DEFAULT_MODEL,
+    variant: str = DEFAULT_VARIANT,
+    opencode: str = "opencode",
+    timeout: float = DEFAULT_TIMEOUT,
+    cache: Optional[ResponseCache] = None,
+) -> dict:
+    """Run one batch item with --format=json; never raises."""
+    result = {"index": index}
+    if "id" in item:
+        result["id"] = item["id"]
+    if "error" in item:
+        return {**result, "ok": False, "error": item["error"]}
+
+    model = item.get("model") or model
+    variant = item.get("variant") or variant
+    timeout = float(item.get("timeout") or timeout)
+    result.update(model=model, variant=variant)
+    start = time.monotonic()
+    try:
+        proc = run_opencode_cached(
+            str(item["prompt"]).strip(),
+            model=model,
+            variant=variant,
+            session=item.get("session"),
+            fmt="json",
+            opencode=opencode,
+            timeout=timeout,
+            cache=cache,
+        )
+    except FileNotFoundError:
+        return {**result, "ok": False, "error": f"'{opencode}' not found"}
+    except subprocess.TimeoutExpired:
+        return {**result, "ok": False, "error": f"timed out after {timeout:g}s",
+                "elapsed": round(time.monotonic() - start, 3)}
+
+    result["elapsed"] = round(time.monotonic() - start, 3)
+    if proc.returncode != 0:
+        err = strip_ansi((proc.stderr or proc.stdout or "").strip())[:500]
+        return {**result, "ok": False, "returncode": proc.returncode,
+                "error": err or f"opencode exited {proc.returncode}"}
+
+    answer, session_id = parse_json_events(proc.stdout or "")
+    if not answer:
+        return {**result, "ok": False, "session_id": session_id,
+                "error": "no text in opencode output"}
+    return {**result, "ok": True, "session_id": session_id, "answer": answer}
+
+
+def run_batch(
+    path: str,
+    output: str,
+    workers: int = 4,
+    model: str = DEFAULT_MODEL,
+    variant: str = DEFAULT_VARIANT,
+    opencode: str = "opencode",
+    timeout: float = DEFAULT_TIMEOUT,
+    cache: Optional[ResponseCache] = None,
+) -> int:
+    """
+    Run every pending item of a batch file on `workers` concurrent opencode
+    processes, appending each result to `output` as it completes. Input is
+    read lazily, so at most `workers` items are in memory at a time.
+    Returns the number of failed items.
+    """
+    done = completed_indexes(output)
+    if done:
+        print(f"Resuming: {len(done)} items already done", file=sys.stderr)
+
+    pending = ((i, item) for i, item in read_batch(path) if i not in done)
+    ok = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool, \
+            open(output, "a", encoding="utf-8") as out:
+        running: set = set()
+        exhausted = False
+        while running or not exhausted:
+            while not exhausted and len(running) < workers:
+                nxt = next(pending, None)
+                if nxt is None:
+                    exhausted = True
+                    break
+                running.add(pool.submit(
+                    run_batch_item, *nxt,
+                    model=model, variant=variant, opencode=opencode,
+                    timeout=timeout, cache=cache,
+                ))
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                rec = future.result()
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                out.flush()
+                if rec["ok"]:
+                    ok += 1
+                else:
+                    failed += 1
+                status = "ok" if rec["ok"] else f"FAILED: {rec['error'][:100]}"
+                print(
+                    f"[{ok + failed}] #{rec['index']} {status}"
+                    f" ({rec.get('elapsed', 0):.1f}s)",
+                    file=sys.stderr,
+                )
+
+    print(f"Batch finished: {ok} ok, {failed} failed -> {output}", file=sys.stderr)
+    return failed
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def stream_main(prompt: str, args) -> int:
+    """--stream: write the answer (or raw NDJSON) to stdout as it arrives."""
+    kwargs = dict(
+        model=args.model,
+        variant=args.variant,
+        session=args.session,
+        fmt=args.format,
+        opencode=args.opencode,
+        timeout=args.timeout,
+    )
+    if args.format == "json":
+        chunks = (text for stream, text in stream_output(prompt, **kwargs) if stream == "stdout")
+    else:
+        chunks = stream_answer(prompt, **kwargs)
+
+    wrote = False
+    try:
+        for text in chunks:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            wrote = True
+    except FileNotFoundError:
+        print(
+            f"ERROR: '{args.opencode}' not found in PATH (or provide --opencode).",
+            file=sys.stderr,
+        )
+        return 127
+    except subprocess.TimeoutExpired:
+        print("\nERROR: opencode timed out." if wrote else "ERROR: opencode timed out.",
+              file=sys.stderr)
+        return 124
+    except subprocess.CalledProcessError as e:
+        if wrote:
+            print()
+        print(
+            strip_ansi(e.stderr or "").strip() or f"ERROR: opencode exited {e.returncode}",
+            file=sys.stderr,
+        )
+        return e.returncode
+
+    if wrote:
+        print()
+    elif args.format != "json":
+        print("I ran the request but didn’t get a readable answer. Try --raw to debug.")
+    return 0
+
+
 def main() -> int:
     ap = argparse.ArgumentParser()
     ap.add_argument("--input", "-i", help="Prompt text. If omitted, reads from stdin.")
-    ap.add_argument("--model", default="openai/gpt-5.2")
-    ap.add_argument("--variant", default="medium")
+    ap.add_argument("--model", default=DEFAULT_MODEL)
+    ap.add_argument("--variant", default=DEFAULT_VARIANT)
     ap.add_argument("--session", help="Session ID for conversation continuity.")
     ap.add_argument("--format", help="Output format (e.g., 'json' for structured NDJSON).")
     ap.add_argument("--opencode", default="opencode", help="Path to opencode binary.")
-    ap.add_argument("--timeout", type=int, default=120)
+    ap.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT)
     ap.add_argument(
         "--raw",
         action="store_true",
         help="Print raw cleaned output (stdout+stderr) for debugging.",
     )
+    ap.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print the cleaned answer as it arrives instead of after the run.",
+    )
+    ap.add_argument("--batch", metavar="FILE.jsonl", help="Run every prompt in a JSONL file.")
+    ap.add_argument(
+        "--output", "-o",
+        help="Batch results file (default: <batch>.out.jsonl). Existing results are resumed.",
+    )
+    ap.add_argument(
+        "--workers", "-j", type=int, default=4,
+        help="Concurrent opencode processes in batch mode.",
+    )
+    ap.add_argument(
+        "--cache", action="store_true",
+        default=os.environ.get("RUNOPENCODE_CACHE", "0") == "1",
+        help="Reuse cached answers for calls without --session (or RUNOPENCODE_CACHE=1).",
+    )
+    ap.add_argument("--no-cache", action="store_true", help="Bypass the response cache.")
+    ap.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    ap.add_argument(
+        "--cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+        help="Seconds a cached answer stays valid.",
+    )
+    ap.add_argument(
+        "--cache-max-mb", type=float, default=DEFAULT_CACHE_MAX_MB,
+        help="Evict least recently used answers beyond this size.",
+    )
+    ap.add_argument("--cache-stats", action="store_true", help="Print cache stats and exit.")
     args = ap.parse_args()
 
-    prompt = read_prompt(args.input)
-
-    cmd = [
-        args.opencode,
-        "run",
-        prompt,
-        f"--model={args.model}",
-        f"--variant={args.variant}",
-    ]
+    cache = None
+    if args.cache_stats or (args.cache and not args.no_cache):
+        cache = ResponseCache(
+            args.cache_dir,
+            ttl=args.cache_ttl,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024),
+        )
+    if args.cache_stats:
+        print(json.dumps(cache.stats(), indent=2))
+        return 0
 
-    if args.session:
-        cmd.append(f"--session={args.session}")
+    if args.batch:
+        output = args.output or os.path.splitext(args.batch)[0] + ".out.jsonl"
+        failed = run_batch(
+            args.batch,
+            output,
+            workers=max(1, args.workers),
+            model=args.model,
+            variant=args.variant,
+            opencode=args.opencode,
+            timeout=args.timeout,
+            cache=cache,
+        )
+        return 1 if failed else 0
 
-    if args.format:
-        cmd.append(f"--format={args.format}")
+    prompt = read_prompt(args.input)
 
-    env = os.environ.copy()
-    # Encourage non-fancy output (still safe if opencode ignores)
-    env.setdefault("TERM", "dumb")
-    env.setdefault("NO_COLOR", "1")
-    env.setdefault("CLICOLOR", "0")
+    if args.stream and not args.raw:
+        return stream_main(prompt, args)
 
     try:
-        proc = subprocess.run(
-            cmd,
-            text=True,
-            capture_output=True,
-            env=env,
+        proc = run_opencode_cached(
+            prompt,
+            model=args.model,
+            variant=args.variant,
+            session=args.session,
+            fmt=args.format,
+            opencode=args.opencode,
             timeout=args.timeout,
+            cache=cache,
         )
     except FileNotFoundError:
         print(
@@ -0,0 +1,65 @@
+"""
+runopencode_test.py — response cache checks, run against
+whatsapp/fake_opencode.py in place of the opencode CLI.
+
+  python runopencode_test.py      (or: python -m pytest runopencode_test.py)
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+
+from runopencode import (
+    ResponseCache,
+    parse_json_events,
+    run_batch_item,
+    run_opencode_cached,
+)
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whatsapp", "fake_opencode.py")
+MISSING = "/nonexistent/opencode"  # a call that is not a cache hit fails to start
+
+
+def test_json_cache_hit_does_not_hand_out_the_first_session():
+    with tempfile.TemporaryDirectory() as d:
+        cache = ResponseCache(d)
+        first = run_opencode_cached("hello", fmt="json", opencode=FAKE, cache=cache)
+        text, session = parse_json_events(first.stdout)
+        assert session == "ses_cold_1"
+
+        hit = run_opencode_cached("hello", fmt="json", opencode=MISSING, cache=cache)
+        assert hit.returncode == 0
+        assert parse_json_events(hit.stdout) == (text, None)
+        assert "sessionID" not in hit.stdout
+        events = [json.loads(line) for line in hit.stdout.splitlines()]
+        assert [e["type"] for e in events] == ["step_start", "text", "step_finish"]
+
+
+def test_batch_item_answered_from_cache_has_no_session():
+    with tempfile.TemporaryDirectory() as d:
+        cache = ResponseCache(d)
+        first = run_batch_item(0, {"prompt": "hello"}, opencode=FAKE, cache=cache)
+        assert first["ok"] and first["session_id"] == "ses_cold_1"
+
+        hit = run_batch_item(1, {"prompt": "hello"}, opencode=MISSING, cache=cache)
+        assert hit["ok"] and hit["answer"] == first["answer"]
+        assert hit["session_id"] is None
+
+
+def test_calls_with_a_session_bypass_the_cache():
+    with tempfile.TemporaryDirectory() as d:
+        cache = ResponseCache(d)
+        run_opencode_cached("hello", fmt="json", opencode=FAKE, cache=cache)
+        resumed = run_opencode_cached(
+            "hello", session="ses_mine", fmt="json", opencode=FAKE, cache=cache
+        )
+        assert parse_json_events(resumed.stdout)[1] == "ses_mine"
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(f"ok  {name}")
@@ -1,4 +1,10 @@
-exports.handler = function (context, event, callback) {
+// Fields forwarded to the agent's webhook receiver (whatsapp/webhook.py).
+const FORWARD_FIELDS = [
+  "AccountSid", "MessageSid", "SmsMessageSid", "From", "To", "Body",
+  "NumMedia", "ProfileName", "WaId",
+];
+
+exports.handler = async function (context, event, callback) {
   // Log inbound so you can see it in Twilio Logs if needed
   console.log("INBOUND:", JSON.stringify({
     from: event.From,
@@ -7,6 +13,34 @@ exports.handler = function (context, event, callback) {
     messageSid: event.MessageSid,
   }));
 
+  // Push mode: forward to the agent, re-signed with the account auth token
+  // so the receiver can validate X-Twilio-Signature against AGENT_WEBHOOK_URL.
+  // The agent's reconciliation poll picks up anything this fails to deliver.
+  const url = context.AGENT_WEBHOOK_URL;
+  if (url) {
+    const params = {};
+    for (const key of FORWARD_FIELDS) {
+      if (event[key] !== undefined) params[key] = String(event[key]);
+    }
+    const signature = Twilio.getExpectedTwilioSignature(
+      context.AUTH_TOKEN, url, params
+    );
+    try {
+      const res = await fetch(url, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/x-www-form-urlencoded",
+          "X-Twilio-Signature": signature,
+        },
+        body: new URLSearchParams(params).toString(),
+        signal: AbortSignal.timeout(5000),
+      });
+      if (!res.ok) console.log("FORWARD FAILED:", res.status);
+    } catch (err) {
+      console.log("FORWARD ERROR:", err.message);
+    }
+  }
+
   // Return empty TwiML = no WhatsApp auto-reply
   const twiml = new Twilio.twiml.MessagingResponse();
   return callback(null, twiml);
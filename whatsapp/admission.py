@@ -0,0 +1,162 @@
+"""
+admission.py — admission control in front of the opencode backend.
+
+Two checkpoints keep one busy or abusive sender, or a general overload,
+from making everyone wait:
+
+  check(sender, queued)   when a message arrives, before it is queued:
+                          rejects it if the sender's token bucket is empty
+                          or the dispatch queue is already max_queue deep
+  slot(deadline)          around each opencode call: waits for one of
+                          max_concurrent slots, but only while the call
+                          could still finish by `deadline` (judged from a
+                          moving average of recent call durations)
+
+Both raise / return a reason instead of blocking, so the caller can send a
+quick "busy, try again shortly" reply rather than let requests time out.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from outbound import TokenBucket
+
+RATE_LIMITED = "rate_limited"
+QUEUE_FULL = "queue_full"
+DEADLINE = "deadline"
+
+
+class Overloaded(Exception):
+    """A request was refused; `reason` is one of the module constants."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrent: int = 4,
+        max_queue: int = 0,
+        sender_rate: float = 0,
+        sender_burst: float = 5,
+        ewma_alpha: float = 0.2,
+    ):
+        """
+        max_queue and sender_rate (messages/second per sender) of 0 turn
+        that check off. max_concurrent caps opencode calls in flight (0:
+        no cap).
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._running = 0
+        self._waiting = 0
+        self._buckets: dict[str, TokenBucket] = {}
+        self._last_seen: dict[str, float] = {}
+        self._next_sweep = 0.0
+        self._expected: Optional[float] = None
+
+    # -- arrival ------------------------------------------------------------
+
+    def check(self, sender: str, queued: int) -> Optional[str]:
+        """
+        Called once per arriving message. Returns None to admit it, or the
+        reason it should be turned away.
+        """
+        if self.max_queue and queued >= self.max_queue:
+            return QUEUE_FULL
+        if self.sender_rate:
+            with self._lock:
+                self._sweep_idle()
+                self._last_seen[sender] = time.monotonic()
+                bucket = self._buckets.get(sender)
+                if bucket is None:
+                    bucket = self._buckets[sender] = TokenBucket(
+                        self.sender_rate, self.sender_burst
+                    )
+            if not bucket.try_acquire():
+                return RATE_LIMITED
+        return None
+
+    def _sweep_idle(self) -> None:
+        """
+        Drop buckets of senders quiet for long enough to have refilled;
+        a new full bucket is the same thing. Caller holds the lock.
+        """
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        refill = self.sender_burst / self.sender_rate
+        self._next_sweep = now + refill
+        for sender in [s for s, t in self._last_seen.items() if now - t >= refill]:
+            del self._last_seen[sender]
+            del self._buckets[sender]
+
+    # -- execution ----------------------------------------------------------
+
+    def expected_duration(self) -> float:
+        """Moving average of recent call durations (0 until one finishes)."""
+        with self._lock:
+            return self._expected or 0.0
+
+    @contextmanager
+    def slot(
+        self, deadline: Optional[float] = None, measure: bool = True
+    ) -> Iterator[Optional[float]]:
+        """
+        Hold one of max_concurrent call slots for the duration of the block.
+        `deadline` is a time.time() by which the call must finish; the block
+        receives the seconds left until then (or None without a deadline).
+        Raises Overloaded(DEADLINE) if a slot cannot be had early enough for
+        a typical call to finish in time. With measure=False the block's
+        duration is left out of the moving average (for background calls
+        that are not replies, e.g. session summaries).
+        """
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= (self._expected or 0):
+                        raise Overloaded(DEADLINE)
+                    if self.max_concurrent <= 0 or self._running < self.max_concurrent:
+                        break
+                    wait = None if remaining is None else remaining - (self._expected or 0)
+                    self._cond.wait(wait)
+            finally:
+                self._waiting -= 1
+            self._running += 1
+
+        start = time.monotonic()
+        ok = False
+        try:
+            yield None if deadline is None else deadline - time.time()
+            ok = True
+        finally:
+            elapsed = time.monotonic() - start
+            with self._cond:
+                self._running -= 1
+                if ok and measure:
+                    self._expected = (
+                        elapsed if self._expected is None
+                        else self._expected + self.ewma_alpha * (elapsed - self._expected)
+                    )
+                self._cond.notify()
+
+    def running(self) -> int:
+        with self._lock:
+            return self._running
+
+    def waiting(self) -> int:
+        with self._lock:
+            return self._waiting
@@ -1,12 +1,54 @@
-
 import os
 import time
-import json
+import atexit
+import contextlib
+import signal
+import socket
 import logging
+import queue
 import subprocess
 import sys
-from datetime import datetime, timezone, timedelta
-from twilio.rest import Client
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from datetime import datetime, timezone
+
+# runopencode.py lives at the repo root, one level above this file.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import runopencode
+
+import metrics
+import tracing
+from admission import AdmissionController, Overloaded, RATE_LIMITED
+from cluster import Cluster
+from dispatcher import SenderDispatcher
+from inbound import InboundCursor, SeenSids
+from journal import (
+    DISPATCHED,
+    DONE,
+    FINISHED,
+    RANK,
+    RECEIVED,
+    RESPONSE_READY,
+    SENT,
+    JournalMessage,
+    MessageJournal,
+)
+from opencode_backend import (
+    BackendTimeout,
+    CancelToken,
+    Cancelled,
+    FallbackBackend,
+    OpencodeBackend,
+    OpencodeError,
+    ServerPoolBackend,
+    SubprocessBackend,
+)
+from outbound import OutboundSender
+from profiling import Profiler
+from session_catalog import DEFAULT_ROOT as OPENCODE_SESSION_ROOT, SessionCatalog
+from sqlite_store import SqliteStore
+from state_store import StateStore
+from trail_writer import TrailWriter
 
 # Configure logging
 logging.basicConfig(
@@ -21,24 +63,184 @@ AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
 FROM_WA = os.environ.get("TWILIO_WHATSAPP_FROM", "whatsapp:<YOUR_TWILIO_NUMBER>")
 
 # Global paths
-WRAPPER_SCRIPT = os.path.expanduser("~/instructions/runopencode.py")
 OPENCODE_PATH = "/usr/bin/opencode"
-PYTHON_PATH = sys.executable
 
 # State file (stores last_processed_time + per-user session mappings)
 STATE_FILE = "agent_state.json"
 
+# Storage backend: "json" (agent_state.json + trail.jsonl) or "sqlite"
+# (WAL database holding state and trail; imports the JSON files once).
+STATE_BACKEND = os.environ.get("AGENT_STATE_BACKEND", "json").lower()
+STATE_DB = os.environ.get("AGENT_STATE_DB", "agent_state.db")
+
 # Identity + audit trail
 # Resolve relative to this file so systemd/cwd changes don't break it.
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 IDENTITY_FILE = os.path.join(SCRIPT_DIR, "HAL_IDENTITY.md")
 TRAIL_FILE = "trail.jsonl"
+# trail.jsonl rotates into gzip segments past this size or at day change;
+# only the newest TRAIL_RETENTION segments are kept.
+TRAIL_ROTATE_MB = int(os.environ.get("AGENT_TRAIL_ROTATE_MB", "50"))
+TRAIL_RETENTION = int(os.environ.get("AGENT_TRAIL_RETENTION", "30"))
+
+# opencode model settings
+MODEL = "openai/gpt-5.2"
+VARIANT = "medium"
+OPENCODE_TIMEOUT = 120
+
+# opencode backend: "subprocess" (cold `opencode run` per message) or
+# "server" (pool of warm `opencode serve` workers, falling back to
+# subprocess when the pool is unavailable). Streamed replies always use
+# the subprocess path.
+OPENCODE_BACKEND = os.environ.get("AGENT_OPENCODE_BACKEND", "subprocess").lower()
+OPENCODE_WORKERS = int(os.environ.get("AGENT_OPENCODE_WORKERS", "2"))
+
+# Stream opencode's NDJSON and send each finished paragraph immediately,
+# instead of one reply after the whole run completes.
+STREAM_REPLIES = os.environ.get("AGENT_STREAM_REPLIES", "0") == "1"
+
+# Inbound mode: "poll" (default) or "webhook" (push receiver + slow
+# reconciliation poll). The webhook URL is what Twilio signs, so set
+# AGENT_WEBHOOK_PUBLIC_URL when running behind a tunnel or proxy.
+INBOUND_MODE = os.environ.get("AGENT_INBOUND_MODE", "poll").lower()
+WEBHOOK_HOST = os.environ.get("AGENT_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("AGENT_WEBHOOK_PORT", "8088"))
+WEBHOOK_PATH = os.environ.get("AGENT_WEBHOOK_PATH", "/whatsapp")
+WEBHOOK_PUBLIC_URL = os.environ.get("AGENT_WEBHOOK_PUBLIC_URL")
+RECONCILE_INTERVAL = int(os.environ.get("AGENT_RECONCILE_INTERVAL", "60"))
+
+# Polling: every page in the window is read, already-handled MessageSids
+# (persisted LRU) are skipped, and the interval backs off from MIN to MAX
+# seconds while nobody is talking.
+POLL_MIN_INTERVAL = float(os.environ.get("AGENT_POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.environ.get("AGENT_POLL_MAX_INTERVAL", "30"))
+POLL_OVERLAP = 60
+SEEN_SIDS_FILE = "inbound_seen.txt"
+SEEN_SIDS_MAX = 5000
+
+# Durable per-MessageSid journal of each message's stage (received ->
+# dispatched -> response_ready -> sent). On restart, interrupted messages
+# are handled again and stored replies re-sent without a second model
+# call. Finished entries are kept JOURNAL_RETENTION seconds. The SQLite
+# backend keeps the journal in its database instead.
+JOURNAL_FILE = "inbound_journal.jsonl"
+JOURNAL_RETENTION = 24 * 3600
+
+# Multi-instance mode (needs the SQLite backend): agents sharing STATE_DB
+# split senders between them by hash of the sender, with heartbeats and
+# leases in the database. Only the holder of the inbound lease polls or
+# runs the webhook receiver; it hands each message to its sender's owner.
+# An instance silent for CLUSTER_TTL seconds is presumed dead and its
+# senders move to the others. INSTANCE_ID should be stable across restarts
+# (the templated systemd unit uses its instance name).
+CLUSTER = os.environ.get("AGENT_CLUSTER", "0") == "1"
+INSTANCE_ID = os.environ.get("AGENT_INSTANCE") or f"{socket.gethostname()}-{os.getpid()}"
+CLUSTER_TTL = float(os.environ.get("AGENT_CLUSTER_TTL", "15"))
+CLUSTER_TICK = 1.0  # seconds between checks for newly assigned work
+
+# Different senders are handled in parallel, up to this many at once;
+# messages from one sender are always handled in order.
+MAX_CONCURRENCY = int(os.environ.get("AGENT_MAX_CONCURRENCY", "4"))
+
+# Rapid-fire messages from one sender are merged into a single prompt:
+# everything queued behind a sender's pending message. Chat commands are
+# never merged. A COALESCE_WINDOW above 0 also waits for messages arriving
+# within that many seconds of the previous one (at most COALESCE_MAX_WAIT
+# in total), at the cost of that much latency on every reply; off by default.
+COALESCE_WINDOW = float(os.environ.get("AGENT_COALESCE_WINDOW", "0"))
+COALESCE_MAX_WAIT = float(os.environ.get("AGENT_COALESCE_MAX_WAIT", "10"))
+
+# Admission control (0 turns a check off). Each sender may send
+# SENDER_RATE_PER_MIN messages a minute on average, bursting to
+# SENDER_BURST; at most MAX_OPENCODE opencode calls run at once; a message
+# arriving while MAX_QUEUE are already pending gets a quick "busy" reply;
+# and a call that can no longer finish within REPLY_BUDGET seconds of the
+# message reaching the agent is dropped instead of started. Chat commands are
+# never shed.
+SENDER_RATE_PER_MIN = float(os.environ.get("AGENT_SENDER_RATE_PER_MIN", "10"))
+SENDER_BURST = float(os.environ.get("AGENT_SENDER_BURST", "6"))
+MAX_OPENCODE = int(os.environ.get("AGENT_MAX_OPENCODE", str(MAX_CONCURRENCY)))
+MAX_QUEUE = int(os.environ.get("AGENT_MAX_QUEUE", "50"))
+REPLY_BUDGET = float(os.environ.get("AGENT_REPLY_BUDGET", "300"))
+SHED_NOTICE_INTERVAL = 60  # seconds between "busy" notices to one sender
+BUSY_REPLY = "I'm handling a lot of messages right now \u2014 please try again shortly."
+RATE_LIMIT_REPLY = (
+    "You're sending messages faster than I can answer. "
+    "Please wait a moment and try again."
+)
+
+# Outbound pacing for the sending number. The sandbox allows one message
+# every 3 seconds; production WhatsApp senders can go much higher. 0 turns
+# pacing off (Twilio's own limits and 429 retries still apply).
+OUTBOUND_RATE = float(os.environ.get("AGENT_OUTBOUND_RATE", str(1 / 3)))
+OUTBOUND_BURST = float(os.environ.get("AGENT_OUTBOUND_BURST", "1"))
+
+# Metrics: Prometheus text on http://METRICS_HOST:METRICS_PORT/metrics
+# when a port is set, and/or a JSON snapshot (with p50/p90/p99) rewritten
+# to STATS_FILE every STATS_INTERVAL seconds. Both are off by default.
+METRICS_HOST = os.environ.get("AGENT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.environ.get("AGENT_METRICS_PORT")
+STATS_FILE = os.environ.get("AGENT_STATS_FILE")
+STATS_INTERVAL = float(os.environ.get("AGENT_STATS_INTERVAL", "60"))
+
+# Tracing: with TRACE_FILE set, each message gets a span tree (root keyed
+# by its MessageSid; state I/O, opencode spawn/run/parse, each Twilio
+# chunk, trail appends) written as OpenTelemetry JSON lines. TRACE_SAMPLE
+# is the fraction of traces kept. Off by default.
+TRACE_FILE = os.environ.get("AGENT_TRACE_FILE")
+TRACE_SAMPLE = float(os.environ.get("AGENT_TRACE_SAMPLE", "1"))
+
+# Profiling: PROFILE lists "cpu" (sampled cProfile of main-loop passes and
+# message handling) and/or "mem" (tracemalloc). Reports are written to
+# PROFILE_DIR every PROFILE_INTERVAL seconds. Off by default.
+PROFILE = {p.strip() for p in os.environ.get("AGENT_PROFILE", "").lower().split(",") if p.strip()}
+PROFILE_DIR = os.environ.get("AGENT_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.environ.get("AGENT_PROFILE_INTERVAL", "300"))
+PROFILE_SAMPLE = float(os.environ.get("AGENT_PROFILE_SAMPLE", "0.1"))
+
+# Session compaction: once a session has had COMPACT_MAX_TURNS turns, or
+# COMPACT_MAX_CHARS of prompt + response text, the sender rolls over to a
+# fresh session seeded with a summary of the old one (0 disables a limit).
+# The old session keeps its aliases and can still be resumed.
+COMPACT_MAX_TURNS = int(os.environ.get("AGENT_COMPACT_MAX_TURNS", "40"))
+COMPACT_MAX_CHARS = int(os.environ.get("AGENT_COMPACT_MAX_CHARS", "150000"))
+COMPACT_SUMMARY_MAX_CHARS = 4000
+COMPACT_SUMMARY_PROMPT = (
+    "We are about to continue this conversation in a fresh session. Write a "
+    "compact summary of it for your future self: who the user is, key facts, "
+    "decisions made, open tasks and stated preferences. Under 300 words. "
+    "Reply with the summary only."
+)
+
+# Index of opencode's stored sessions (used by --resume and --sessions),
+# persisted so restarts only rescan project directories that changed.
+SESSION_CATALOG_FILE = "session_catalog.json"
 
 # Chat commands
 RESET_COMMANDS = {"--new", "!reset", "!new"}
 RESUME_PREFIX = "--resume"
 RENAME_PREFIX = "--rename"
 ID_COMMAND = "--id"
+SESSIONS_COMMAND = "--sessions"
+SESSIONS_LIST_LIMIT = 10
+
+
+def is_command(text: str) -> bool:
+    """True if text is one of the chat commands handled in handle_message."""
+    lower = (text or "").strip().lower()
+    return (
+        lower in (ID_COMMAND, SESSIONS_COMMAND)
+        or lower in RESET_COMMANDS
+        or lower.startswith((RENAME_PREFIX, RESUME_PREFIX))
+    )
+
+
+def resume_argument(text: str) -> str:
+    """The session ID or alias of a --resume command ("id:" prefix dropped)."""
+    raw = text.strip()[len(RESUME_PREFIX):].strip()
+    if raw.lower().startswith("id:"):
+        raw = raw[3:].strip()
+    return raw
 
 
 def load_identity_text() -> str:
@@ -51,23 +253,52 @@ def load_identity_text() -> str:
     return ""
 
 
-def build_prompt(identity_text: str, user_text: str) -> str:
+def build_prompt(identity_text: str, user_text: str, summary=None) -> str:
+    """First prompt of a session; `summary` carries over a compacted session."""
+    context = ""
+    if summary:
+        context = (
+            "Summary of the conversation so far (continued from a previous "
+            f"session):\n{summary}\n\n"
+        )
     if not identity_text:
-        return user_text
+        return f"{context}User message:\n{user_text}" if context else user_text
     return (
         f"{identity_text}\n\n"
         "Instructions: Follow the principles and behavior rules above. "
         "Reply to the user message.\n\n"
+        f"{context}"
         f"User message:\n{user_text}"
     )
 
 
+_trail_writer = None
+_trail_writer_lock = threading.Lock()
+
+
+def _trail() -> TrailWriter:
+    """The process-wide TrailWriter for TRAIL_FILE, started on first use."""
+    global _trail_writer
+    with _trail_writer_lock:
+        if _trail_writer is None:
+            _trail_writer = TrailWriter(
+                TRAIL_FILE,
+                rotate_bytes=TRAIL_ROTATE_MB * 1024 * 1024,
+                retention=TRAIL_RETENTION,
+            )
+        return _trail_writer
+
+
 def append_trail(event: dict) -> None:
     try:
         event = dict(event)
         event.setdefault("ts", datetime.now(timezone.utc).isoformat())
-        with open(TRAIL_FILE, "a", encoding="utf-8") as f:
-            f.write(json.dumps(event, ensure_ascii=True) + "\n")
+        with metrics.timer("agent_trail_append_seconds"), \
+                tracing.child("append_trail", action=event.get("action") or "reply"):
+            if STATE_BACKEND == "sqlite":
+                _state().append_trail(event)
+            else:
+                _trail().append(event)
     except Exception as e:
         logging.error(f"Error writing trail: {e}")
 
@@ -76,72 +307,285 @@ def append_trail(event: dict) -> None:
 # State management (last_processed_time + session mappings)
 # ---------------------------------------------------------------------------
 
-def _load_state() -> dict:
-    """Load the full state dict from disk."""
+_state_store = None
+_state_store_lock = threading.Lock()
+
+
+def _state():
+    """The process-wide state backend (StateStore or SqliteStore), opened on first use."""
+    global _state_store
+    with _state_store_lock:
+        if _state_store is None:
+            if STATE_BACKEND == "sqlite":
+                store = SqliteStore(STATE_DB)
+                try:
+                    store.migrate_from_files(STATE_FILE, TRAIL_FILE)
+                except Exception as e:
+                    logging.error(f"State migration into {STATE_DB} failed: {e}")
+                _state_store = store
+            else:
+                _state_store = StateStore(STATE_FILE)
+        return _state_store
+
+
+_message_journal = None
+_message_journal_lock = threading.Lock()
+
+
+def _journal():
+    """The process-wide work journal (MessageJournal, or the SqliteStore)."""
+    global _message_journal
+    with _message_journal_lock:
+        if _message_journal is None:
+            if STATE_BACKEND == "sqlite":
+                _message_journal = _state()
+            else:
+                _message_journal = MessageJournal(JOURNAL_FILE)
+        return _message_journal
+
+
+def journal(sid: str, stage: str, **fields) -> None:
+    """Record a message's stage in the journal; failures are logged, not raised."""
     try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                return json.load(f)
+        with tracing.child("journal", sid=sid, stage=stage):
+            _journal().journal_record(sid, stage, **fields)
     except Exception as e:
-        logging.error(f"Error reading state file: {e}")
-    return {}
+        logging.error(f"Error writing journal for {sid} ({stage}): {e}")
 
 
-def _save_state(state: dict) -> None:
-    """Write the full state dict to disk."""
-    try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-    except Exception as e:
-        logging.error(f"Error saving state file: {e}")
+def journal_on_delivery(futures: list, sids: list) -> None:
+    """
+    Mark `sids` sent once every reply future has delivered. If any send
+    failed (or could not be queued), they stay at response_ready and the
+    stored reply is re-sent on the next start.
+    """
+    if None in futures:
+        return
+    if not futures:
+        for sid in sids:
+            journal(sid, SENT)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for sid in sids:
+            journal(sid, SENT)
+
+    for future in futures:
+        future.add_done_callback(on_done)
 
 
 def get_last_processed_time():
-    state = _load_state()
-    lpt = state.get('last_processed_time')
+    lpt = _state().get_last_processed_time()
     if lpt:
-        return datetime.fromisoformat(lpt)
+        return lpt
     return datetime.now(timezone.utc)
 
 
 def save_last_processed_time(dt):
-    state = _load_state()
-    state['last_processed_time'] = dt.isoformat()
-    _save_state(state)
+    _state().set_last_processed_time(dt)
 
 
 def get_session_id(phone: str):
     """Look up stored opencode session ID for a phone number."""
-    state = _load_state()
-    return state.get('sessions', {}).get(phone)
+    return _state().get_session(phone)
 
 
 def save_session_id(phone: str, session_id: str) -> None:
     """Persist an opencode session ID for a phone number."""
-    state = _load_state()
-    sessions = state.setdefault('sessions', {})
-    sessions[phone] = session_id
-    _save_state(state)
+    _state().set_session(phone, session_id)
     logging.info(f"Saved session {session_id} for {phone}")
 
 
 def clear_session(phone: str) -> None:
     """Delete a user's session mapping so the next message starts fresh."""
-    state = _load_state()
-    sessions = state.get('sessions', {})
-    if phone in sessions:
-        old = sessions.pop(phone)
-        _save_state(state)
+    old = _state().pop_session(phone)
+    if old:
         logging.info(f"Cleared session {old} for {phone}")
 
 
+_session_catalog = None
+_session_catalog_lock = threading.Lock()
+
+
+def _catalog() -> SessionCatalog:
+    """The process-wide opencode session catalog, built on first use."""
+    global _session_catalog
+    with _session_catalog_lock:
+        if _session_catalog is None:
+            _session_catalog = SessionCatalog(
+                OPENCODE_SESSION_ROOT, index_path=SESSION_CATALOG_FILE
+            )
+            logging.info(f"Session catalog: {len(_session_catalog)} sessions indexed")
+        return _session_catalog
+
+
+def needs_compaction(usage: dict) -> bool:
+    """True once a session's usage passes either compaction limit."""
+    if COMPACT_MAX_TURNS and usage["turns"] >= COMPACT_MAX_TURNS:
+        return True
+    chars = usage["prompt_chars"] + usage["response_chars"]
+    return bool(COMPACT_MAX_CHARS and chars >= COMPACT_MAX_CHARS)
+
+
+_admission_controller = None
+_admission_lock = threading.Lock()
+
+
+def _admission() -> AdmissionController:
+    """The process-wide AdmissionController, created on first use."""
+    global _admission_controller
+    with _admission_lock:
+        if _admission_controller is None:
+            _admission_controller = AdmissionController(
+                max_concurrent=MAX_OPENCODE,
+                max_queue=MAX_QUEUE,
+                sender_rate=SENDER_RATE_PER_MIN / 60,
+                sender_burst=SENDER_BURST,
+            )
+        return _admission_controller
+
+
+# Compactions run one at a time on their own thread, off the sender's lane,
+# so the reply that triggered one is not followed by a wait. The sender's
+# next message waits only if theirs is still running; --new and --resume
+# cancel it instead.
+_compactor = None
+_compactor_lock = threading.Lock()
+_compactions: dict[str, tuple[Future, CancelToken]] = {}
+_compactions_lock = threading.Lock()
+
+
+def _compaction_pool() -> ThreadPoolExecutor:
+    global _compactor
+    with _compactor_lock:
+        if _compactor is None:
+            _compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compact")
+        return _compactor
+
+
+def compact_session(phone: str, session_id: str, cancel: CancelToken) -> bool:
+    """
+    Roll `phone` over from session_id to a fresh session: ask the old
+    session for a summary and keep it as a carryover that seeds the
+    sender's next message (together with the identity prompt). Returns
+    False, leaving the mapping alone, if no summary could be produced or
+    the compaction was cancelled meanwhile.
+    """
+    try:
+        # A slot like any call, but summaries stay out of the reply-time
+        # average that deadline shedding is judged by.
+        with _admission().slot(measure=False):
+            summary, _ = _opencode_backend().run(
+                COMPACT_SUMMARY_PROMPT, session_id=session_id,
+                timeout=OPENCODE_TIMEOUT, cancel=cancel,
+            )
+    except Cancelled:
+        logging.info(f"Compaction of {session_id} for {phone} cancelled")
+        return False
+    except Exception as e:
+        logging.error(f"Could not summarize {session_id} for compaction: {e}")
+        return False
+    summary = (summary or "").strip()[:COMPACT_SUMMARY_MAX_CHARS]
+    if not summary:
+        return False
+    with _compactions_lock:
+        # cancel_compaction() unregisters under this lock, so a --new or
+        # --resume either lands before this check or after the rollover.
+        if _compactions.get(phone, (None, None))[1] is not cancel:
+            return False
+        clear_session(phone)
+        _state().set_carryover(phone, session_id, summary)
+    metrics.inc("agent_session_compactions_total")
+    logging.info(f"Compacted {session_id} for {phone} ({len(summary)} char summary)")
+    return True
+
+
+def compact_and_notify(msg, session_id: str, usage: dict, cancel: CancelToken) -> None:
+    """Compact msg.from_'s session and, if it rolled over, tell the sender."""
+    previous = format_session_display(session_id)
+    with tracing.span("compact_session", sender=msg.from_, session=session_id):
+        if not compact_session(msg.from_, session_id, cancel):
+            return
+    send_whatsapp(
+        msg.from_,
+        "This conversation is getting long, so your next message "
+        "will continue in a fresh session with a summary of it.\n"
+        f"(Previous: {previous} \u2014 use --resume to go back.)"
+    )
+    append_trail({
+        "from": msg.from_,
+        "to": msg.to,
+        "action": "session_compact",
+        "old_session": session_id,
+        **usage,
+    })
+
+
+def start_compaction(msg, session_id: str, usage: dict) -> None:
+    """Run compact_and_notify in the background for msg.from_."""
+    phone = msg.from_
+    token = CancelToken()
+    pool = _compaction_pool()
+    with _compactions_lock:
+        future = pool.submit(compact_and_notify, msg, session_id, usage, token)
+        _compactions[phone] = (future, token)
+
+    def forget(f: Future) -> None:
+        with _compactions_lock:
+            if _compactions.get(phone, (None, None))[0] is f:
+                del _compactions[phone]
+        if f.exception() is not None:
+            logging.error(f"Compaction for {phone} failed: {f.exception()}")
+
+    future.add_done_callback(forget)
+
+
+def wait_for_compaction(phone: str) -> None:
+    """Block until phone's background compaction, if still running, is over."""
+    with _compactions_lock:
+        entry = _compactions.get(phone)
+    if entry is None or entry[0].done():
+        return
+    logging.info(f"Waiting for the session compaction for {phone}")
+    with tracing.child("wait_compaction"):
+        wait_futures([entry[0]])
+
+
+def cancel_compaction(phone: str) -> bool:
+    """Abandon phone's background compaction, if any. True if one was running."""
+    with _compactions_lock:
+        entry = _compactions.pop(phone, None)
+    if entry is None or entry[0].done():
+        return False
+    logging.info(f"Cancelling session compaction for {phone}")
+    entry[1].cancel()
+    return True
+
+
 def session_exists_on_disk(session_id: str) -> bool:
     """Check whether opencode has a stored session file for this ID."""
-    import glob
-    pattern = os.path.expanduser(
-        f"~/.local/share/opencode/storage/session/*/{session_id}.json"
-    )
-    return len(glob.glob(pattern)) > 0
+    return _catalog().exists(session_id)
+
+
+def format_session_list(current=None) -> str:
+    """The most recent stored sessions, with aliases, for --sessions."""
+    sessions = _catalog().list(SESSIONS_LIST_LIMIT)
+    if not sessions:
+        return "No stored sessions."
+    lines = ["Recent sessions:"]
+    for info in sessions:
+        marker = "*" if info.session_id == current else "-"
+        updated = datetime.fromtimestamp(info.mtime, timezone.utc).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"{marker} {format_session_display(info.session_id)} ({updated})")
+    return "\n".join(lines)
 
 
 # ---------------------------------------------------------------------------
@@ -150,26 +594,18 @@ def session_exists_on_disk(session_id: str) -> bool:
 
 def get_alias(name: str):
     """Look up a session ID by its alias. Returns None if not found."""
-    state = _load_state()
-    return state.get('aliases', {}).get(name.lower())
+    return _state().get_alias(name)
 
 
 def set_alias(name: str, session_id: str) -> None:
     """Map a human-readable alias to a session ID."""
-    state = _load_state()
-    aliases = state.setdefault('aliases', {})
-    aliases[name.lower()] = session_id
-    _save_state(state)
+    _state().set_alias(name, session_id)
     logging.info(f"Alias '{name}' -> {session_id}")
 
 
 def get_alias_for_session(session_id: str):
     """Reverse lookup: find the alias for a session ID, if any."""
-    state = _load_state()
-    for name, sid in state.get('aliases', {}).items():
-        if sid == session_id:
-            return name
-    return None
+    return _state().alias_for_session(session_id)
 
 
 def resolve_session_or_alias(value: str):
@@ -192,119 +628,770 @@ def format_session_display(session_id: str) -> str:
 
 
 # ---------------------------------------------------------------------------
-# opencode wrapper call — now with session + JSON support
+# opencode call — session + JSON support via the runopencode API
 # ---------------------------------------------------------------------------
 
-def call_opencode_wrapper(prompt, session_id=None):
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _opencode_backend() -> OpencodeBackend:
+    """The process-wide opencode backend, created on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            cold = SubprocessBackend(OPENCODE_PATH, MODEL, VARIANT)
+            if OPENCODE_BACKEND == "server":
+                pool = ServerPoolBackend(
+                    OPENCODE_PATH, MODEL, size=OPENCODE_WORKERS, variant=VARIANT
+                )
+                _backend = FallbackBackend(pool, cold)
+                logging.info(f"Using {OPENCODE_WORKERS} warm opencode server workers")
+            else:
+                _backend = cold
+        return _backend
+
+
+def _call_timeout(remaining) -> float:
+    """OPENCODE_TIMEOUT, cut short to whatever is left of the reply budget."""
+    return OPENCODE_TIMEOUT if remaining is None else max(1.0, min(OPENCODE_TIMEOUT, remaining))
+
+
+def call_opencode_wrapper(prompt, session_id=None, cancel=None, deadline=None):
     """
-    Calls runopencode.py with --format=json (and optionally --session).
-    Parses NDJSON output to extract the response text and session ID.
-    Returns (response_text, session_id_from_output).
+    Runs the prompt on the configured opencode backend (a cold
+    `opencode run --format=json` per call, or a warm `opencode serve` pool),
+    optionally continuing --session. The call waits for an admission slot
+    and must finish by `deadline` (a time.time()), if given.
+    Returns (response_text, session_id_from_output), or (None, None) if
+    the call was abandoned through `cancel`.
     """
     try:
         logging.info(
-            f"Calling wrapper with prompt length: {len(prompt)}"
+            f"Calling opencode with prompt length: {len(prompt)}"
             f" (session: {session_id or 'new'})"
         )
 
-        cmd = [
-            PYTHON_PATH,
-            WRAPPER_SCRIPT,
-            "--input", prompt,
-            "--model", "openai/gpt-5.2",
-            "--variant", "medium",
-            "--opencode", OPENCODE_PATH,
-            "--format", "json",
-        ]
-
-        if session_id:
-            cmd.extend(["--session", session_id])
-
-        start_t = time.time()
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=130,
-            stdin=subprocess.DEVNULL,
-        )
-        duration = time.time() - start_t
-
-        if result.returncode != 0:
-            logging.error(
-                f"Wrapper failed (code {result.returncode}): "
-                f"{result.stderr[:300]}"
-            )
-            return ("I'm here \u2014 can you rephrase that?", None)
+        queued_ns = time.time_ns()
+        with _admission().slot(deadline) as remaining:
+            tracing.record("admission.wait", queued_ns, time.time_ns())
+            start_t = time.time()
+            with metrics.timer("agent_opencode_seconds", mode="call"), \
+                    tracing.span("call_opencode_wrapper", backend=OPENCODE_BACKEND,
+                                 session=session_id, prompt_len=len(prompt)) as span:
+                response, output_session_id = _opencode_backend().run(
+                    prompt, session_id=session_id,
+                    timeout=_call_timeout(remaining), cancel=cancel,
+                )
+                if span:
+                    span.set(output_session=output_session_id, output_len=len(response))
+            duration = time.time() - start_t
 
-        stdout = result.stdout.strip()
         logging.info(
-            f"Wrapper returned in {duration:.1f}s. Output len: {len(stdout)}"
+            f"opencode returned in {duration:.1f}s. Output len: {len(response)}"
         )
 
-        if not stdout:
-            logging.warning("Wrapper returned empty response.")
-            return ("I'm here \u2014 can you rephrase that?", None)
+        if not response:
+            logging.warning("No text parts found in opencode output.")
+            metrics.inc("agent_fallback_replies_total", reason="empty")
+            return ("I'm here \u2014 can you rephrase that?", output_session_id)
 
-        # Parse NDJSON lines
-        response_parts = []
-        output_session_id = None
+        return (response, output_session_id)
+
+    except Cancelled:
+        logging.info("opencode call cancelled.")
+        return (None, None)
+    except Overloaded as e:
+        logging.warning(f"Shedding opencode call ({e.reason}).")
+        metrics.inc("agent_shed_total", reason=e.reason)
+        return (BUSY_REPLY, None)
+    except BackendTimeout:
+        logging.error("opencode timed out.")
+        metrics.inc("agent_opencode_timeouts_total")
+        metrics.inc("agent_fallback_replies_total", reason="timeout")
+        return ("Thinking took too long. Please try again.", None)
+    except OpencodeError as e:
+        logging.error(f"opencode failed: {e}")
+        metrics.inc("agent_fallback_replies_total", reason="error")
+        return ("I'm here \u2014 can you rephrase that?", None)
+    except Exception as e:
+        logging.error(f"Error calling opencode: {e}")
+        metrics.inc("agent_fallback_replies_total", reason="exception")
+        return ("System error processing request.", None)
 
-        for line in stdout.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                data = json.loads(line)
 
-                # Capture session ID from any event
-                if not output_session_id:
-                    output_session_id = data.get("sessionID")
+class ReplyStreamer:
+    """
+    Collects streamed text parts and sends each finished paragraph (text
+    up to a blank line) right away. The first paragraph of a new session
+    carries the session header.
+    """
 
-                # Collect text parts
-                if data.get("type") == "text":
-                    part = data.get("part", {})
-                    text = part.get("text")
-                    if text:
-                        response_parts.append(text)
+    def __init__(self, to: str, new_session: bool):
+        self.to = to
+        self.new_session = new_session
+        self.session_id = None
+        self.sent = False
+        self.finished = False
+        self.futures = []  # one per paragraph queued for sending
+        self._buf = ""
+
+    def on_text(self, text: str, session_id=None) -> None:
+        self.session_id = self.session_id or session_id
+        self._buf += text
+        *done, self._buf = self._buf.split("\n\n")
+        for para in done:
+            self._send(para)
+
+    def finish(self) -> None:
+        self._send(self._buf)
+        self._buf = ""
+        self.finished = True
+
+    def _send(self, para: str) -> None:
+        para = para.strip()
+        if not para:
+            return
+        if not self.sent and self.new_session and self.session_id:
+            para = f"[New session: {self.session_id}]\n\n{para}"
+        self.sent = True
+        self.futures.append(send_whatsapp(self.to, para))
+
+
+def call_opencode_streaming(prompt, streamer: ReplyStreamer, session_id=None,
+                            cancel=None, deadline=None):
+    """
+    Streaming variant of call_opencode_wrapper: reads opencode's NDJSON
+    events as they arrive and feeds text parts to `streamer`, which sends
+    paragraphs as they complete. streamer.finished is set only when the
+    whole reply went out; otherwise the caller should send the returned
+    fallback text. Admission and `deadline` work as in
+    call_opencode_wrapper. Returns (response_text, session_id_from_output),
+    or (None, None) if the call was abandoned through `cancel`.
+    """
+    try:
+        logging.info(
+            f"Streaming opencode with prompt length: {len(prompt)}"
+            f" (session: {session_id or 'new'})"
+        )
+
+        first_t = None
+        response_parts = []
+        output_session_id = None
 
-            except json.JSONDecodeError:
-                logging.warning(f"Failed to parse JSON line: {line[:100]}...")
+        queued_ns = time.time_ns()
+        with _admission().slot(deadline) as remaining:
+            tracing.record("admission.wait", queued_ns, time.time_ns())
+            with tracing.span("call_opencode_streaming", session=session_id,
+                              prompt_len=len(prompt)) as span:
+                start_t = time.time()
+
+                def on_start(proc):
+                    if span:
+                        tracing.record("opencode.spawn", span.start, time.time_ns(),
+                                       pid=proc.pid)
+                    if cancel:
+                        cancel.on_cancel(proc.kill)
+
+                for data in runopencode.stream_json_events(
+                    prompt,
+                    model=MODEL,
+                    variant=VARIANT,
+                    session=session_id,
+                    opencode=OPENCODE_PATH,
+                    timeout=_call_timeout(remaining),
+                    on_start=on_start,
+                ):
+                    # Capture session ID from the first event that carries one
+                    if not output_session_id:
+                        output_session_id = data.get("sessionID")
+
+                    if data.get("type") == "text":
+                        text = data.get("part", {}).get("text")
+                        if text:
+                            if first_t is None:
+                                first_t = time.time() - start_t
+                                if span:
+                                    span.set(first_text_s=first_t)
+                            response_parts.append(text)
+                            streamer.on_text(text, output_session_id)
 
+        duration = time.time() - start_t
+        metrics.observe("agent_opencode_seconds", duration, mode="stream")
         response = "".join(response_parts).strip()
+        logging.info(
+            f"opencode stream finished in {duration:.1f}s"
+            f" (first text at {first_t or 0:.1f}s). Output len: {len(response)}"
+        )
 
         if not response:
             logging.warning("No text parts found in JSON output.")
+            metrics.inc("agent_fallback_replies_total", reason="empty")
             return ("I'm here \u2014 can you rephrase that?", output_session_id)
 
+        streamer.finish()
         return (response, output_session_id)
 
+    except Overloaded as e:
+        logging.warning(f"Shedding opencode stream ({e.reason}).")
+        metrics.inc("agent_shed_total", reason=e.reason)
+        return (BUSY_REPLY, None)
     except subprocess.TimeoutExpired:
-        logging.error("Wrapper timed out.")
+        logging.error("opencode timed out.")
+        metrics.inc("agent_opencode_timeouts_total")
+        metrics.inc("agent_fallback_replies_total", reason="timeout")
         return ("Thinking took too long. Please try again.", None)
+    except subprocess.CalledProcessError as e:
+        if cancel and cancel.cancelled:
+            logging.info("opencode stream cancelled.")
+            return (None, None)
+        logging.error(
+            f"opencode failed (code {e.returncode}): {(e.stderr or '')[:300]}"
+        )
+        metrics.inc("agent_fallback_replies_total", reason="error")
+        return ("I'm here \u2014 can you rephrase that?", None)
     except Exception as e:
-        logging.error(f"Error calling wrapper: {e}")
+        logging.error(f"Error calling opencode: {e}")
+        metrics.inc("agent_fallback_replies_total", reason="exception")
         return ("System error processing request.", None)
 
 
-def send_whatsapp(to, body):
-    try:
-        client = Client(ACCOUNT_SID, AUTH_TOKEN)
-        # Split message if too long
-        max_len = 1500
-        chunks = [body[i:i+max_len] for i in range(0, len(body), max_len)]
-
-        for chunk in chunks:
-            message = client.messages.create(
-                from_=FROM_WA,
-                body=chunk,
-                to=to
+_outbound_sender = None
+_outbound_lock = threading.Lock()
+
+
+def _outbound() -> OutboundSender:
+    """The process-wide OutboundSender (shared Twilio client + sender thread)."""
+    global _outbound_sender
+    with _outbound_lock:
+        if _outbound_sender is None:
+            _outbound_sender = OutboundSender(
+                ACCOUNT_SID, AUTH_TOKEN, FROM_WA,
+                rate=OUTBOUND_RATE, burst=OUTBOUND_BURST,
             )
-            logging.info(f"Sent message {message.sid} to {to}")
-            time.sleep(1)  # Rate limit
+        return _outbound_sender
 
+
+def send_whatsapp(to, body, urgent=False):
+    """
+    Queue a reply for delivery and return immediately. Returns a Future
+    that resolves to the sent message SIDs (or None if queueing failed).
+    Urgent replies (command answers) skip ahead of queued ones.
+    """
+    try:
+        return _outbound().send(to, body, urgent=urgent)
     except Exception as e:
         logging.error(f"Failed to send WhatsApp: {e}")
+        return None
+
+
+# Cancel tokens for each sender's running opencode call. The lock also
+# covers saving a new session's ID, so a --new/--resume either cancels the
+# call before it saves or runs after it (and then replaces the session).
+_inflight_calls: dict[str, CancelToken] = {}
+_inflight_lock = threading.Lock()
+
+
+def cancel_inflight(phone: str) -> bool:
+    """Abandon phone's running opencode call, if any. True if one was running."""
+    with _inflight_lock:
+        token = _inflight_calls.pop(phone, None)
+    if token is None:
+        return False
+    logging.info(f"Cancelling in-flight opencode call for {phone}")
+    token.cancel()
+    metrics.inc("agent_opencode_cancelled_total")
+    return True
+
+
+# A command queued behind its sender's running call (see dispatcher.py)
+# only runs once that call is over, so --new and a valid --resume cancel
+# the call as they arrive. SIDs of the commands that did, so their reply
+# can still say so.
+_preempted: set[str] = set()
+
+
+def preempt(msg) -> None:
+    """Cancel the sender's running call and compaction if msg replaces the session."""
+    text = (msg.body or "").strip()
+    lower = text.lower()
+    if lower.startswith(RESUME_PREFIX):
+        raw = resume_argument(text)
+        target_id = resolve_session_or_alias(raw) if raw else None
+        if not target_id or not session_exists_on_disk(target_id):
+            return
+    elif lower not in RESET_COMMANDS:
+        return
+    cancel_compaction(msg.from_)
+    if cancel_inflight(msg.from_):
+        with _inflight_lock:
+            _preempted.add(msg.sid)
+
+
+def was_preempted(sid: str) -> bool:
+    with _inflight_lock:
+        if sid in _preempted:
+            _preempted.discard(sid)
+            return True
+        return False
+
+
+# When each queued message reached this agent (time.time()), by SID. The
+# reply budget runs from here, so a backlog left by downtime is answered
+# rather than shed; only time spent queued here counts against it.
+_arrivals: dict[str, float] = {}
+_arrivals_lock = threading.Lock()
+
+
+def note_arrival(sid: str) -> None:
+    with _arrivals_lock:
+        _arrivals.setdefault(sid, time.time())
+
+
+def pop_arrival(sids: list) -> float:
+    """Earliest arrival among `sids` (now if unknown), forgetting them."""
+    now = time.time()
+    with _arrivals_lock:
+        return min([_arrivals.pop(sid, now) for sid in sids] or [now])
+
+
+_shed_notices: dict[str, float] = {}
+
+
+def shed_message(msg_date, msg, reason: str) -> None:
+    """
+    Turn away a message refused at arrival: count it, log it to the trail
+    and (at most once per SHED_NOTICE_INTERVAL per sender) tell the sender.
+    """
+    logging.warning(f"Shedding message {msg.sid} from {msg.from_} ({reason})")
+    metrics.inc("agent_shed_total", reason=reason)
+    now = time.monotonic()
+    last = _shed_notices.get(msg.from_)
+    if last is None or now - last >= SHED_NOTICE_INTERVAL:
+        _shed_notices[msg.from_] = now
+        reply = RATE_LIMIT_REPLY if reason == RATE_LIMITED else BUSY_REPLY
+        send_whatsapp(msg.from_, reply, urgent=True)
+    append_trail({
+        "from": msg.from_,
+        "to": msg.to,
+        "inbound_ts": msg_date.isoformat(),
+        "inbound": (msg.body or "").strip(),
+        "action": "shed",
+        "reason": reason,
+    })
+
+
+# ---------------------------------------------------------------------------
+# Message handling
+# ---------------------------------------------------------------------------
+
+def handle_message(msg_date, msg, identity_text: str) -> None:
+    """Process one inbound message: chat command or opencode round-trip."""
+    user_text = (msg.body or "").strip()
+    user_lower = user_text.lower()
+    # Set when the dispatcher merged several messages into this one.
+    parts = getattr(msg, "parts", None)
+    arrived = pop_arrival([p.sid for p in parts] if parts else [msg.sid])
+    logging.info(f"Received message from {msg.from_}: {user_text}")
+
+    # ---- Command: --id ----
+    if user_lower == ID_COMMAND:
+        cur = get_session_id(msg.from_)
+        if cur:
+            reply = f"Current session: {format_session_display(cur)}"
+        else:
+            reply = "No active session. Send a message to start one."
+        send_whatsapp(msg.from_, reply, urgent=True)
+        return
+
+    # ---- Command: --sessions ----
+    if user_lower == SESSIONS_COMMAND:
+        send_whatsapp(
+            msg.from_, format_session_list(get_session_id(msg.from_)), urgent=True
+        )
+        return
+
+    # ---- Command: --rename <alias> ----
+    if user_lower.startswith(RENAME_PREFIX):
+        alias = user_text[len(RENAME_PREFIX):].strip()
+        cur = get_session_id(msg.from_)
+        if not cur:
+            send_whatsapp(msg.from_, "No active session to rename.", urgent=True)
+        elif not alias:
+            send_whatsapp(msg.from_, "Usage: --rename <name>", urgent=True)
+        else:
+            set_alias(alias, cur)
+            send_whatsapp(
+                msg.from_,
+                f'Session renamed to "{alias}"\n({cur})',
+                urgent=True,
+            )
+        append_trail({
+            "from": msg.from_,
+            "to": msg.to,
+            "inbound_ts": msg_date.isoformat(),
+            "inbound": user_text,
+            "action": "session_rename",
+            "session_id": cur,
+            "alias": alias or None,
+        })
+        return
+
+    # ---- Command: --new / !reset / !new ----
+    if user_lower in RESET_COMMANDS:
+        cancel_compaction(msg.from_)
+        cancelled = cancel_inflight(msg.from_) or was_preempted(msg.sid)
+        old_session = get_session_id(msg.from_)
+        clear_session(msg.from_)
+        _state().pop_carryover(msg.from_)
+        reply = "Session cleared. Send a message to start fresh."
+        if cancelled:
+            reply += "\n(Stopped the reply that was in progress.)"
+        if old_session:
+            reply += f"\n(Previous: {format_session_display(old_session)})"
+        send_whatsapp(msg.from_, reply, urgent=True)
+        append_trail({
+            "from": msg.from_,
+            "to": msg.to,
+            "inbound_ts": msg_date.isoformat(),
+            "inbound": user_text,
+            "action": "session_reset",
+            "old_session": old_session,
+            "cancelled_inflight": cancelled,
+        })
+        return
+
+    # ---- Command: --resume <session_id or alias> ----
+    if user_lower.startswith(RESUME_PREFIX):
+        raw = resume_argument(user_text)
+        cancelled = False
+        if not raw:
+            send_whatsapp(msg.from_, "Usage: --resume <session_id or alias>", urgent=True)
+        else:
+            target_id = resolve_session_or_alias(raw)
+            if not target_id:
+                send_whatsapp(msg.from_, f'Alias "{raw}" not found.', urgent=True)
+            elif not session_exists_on_disk(target_id):
+                send_whatsapp(
+                    msg.from_, f"Session {target_id} not found on disk.", urgent=True
+                )
+            else:
+                cancel_compaction(msg.from_)
+                cancelled = cancel_inflight(msg.from_) or was_preempted(msg.sid)
+                save_session_id(msg.from_, target_id)
+                # An explicit resume starts the compaction count over and
+                # drops any summary waiting to seed a new session.
+                _state().reset_session_usage(target_id)
+                _state().pop_carryover(msg.from_)
+                reply = f"Session resumed: {format_session_display(target_id)}\nSend a message to continue."
+                if cancelled:
+                    reply += "\n(Stopped the reply that was in progress.)"
+                send_whatsapp(msg.from_, reply, urgent=True)
+        append_trail({
+            "from": msg.from_,
+            "to": msg.to,
+            "inbound_ts": msg_date.isoformat(),
+            "inbound": user_text,
+            "action": "session_resume",
+            "target_input": raw if raw else None,
+            "cancelled_inflight": cancelled,
+        })
+        return
+
+    # ---- Normal message processing ----
+    # A compaction started by the previous reply decides which session
+    # this message goes to.
+    wait_for_compaction(msg.from_)
+    existing_session = get_session_id(msg.from_)
+    is_new_session = not existing_session
+
+    # Build the prompt:
+    # - First message (no session yet): include identity, plus the summary
+    #   of the previous session if it was compacted
+    # - Continuing session: just the user text (identity is in history)
+    carryover = None
+    if existing_session:
+        prompt = user_text
+    else:
+        carryover = _state().get_carryover(msg.from_)
+        prompt = build_prompt(
+            identity_text, user_text, summary=carryover and carryover["summary"]
+        )
+
+    # The reply budget runs from when the message reached the agent.
+    deadline = arrived + REPLY_BUDGET if REPLY_BUDGET else None
+    token = CancelToken()
+    with _inflight_lock:
+        _inflight_calls[msg.from_] = token
+
+    streamer = None
+    response, output_session_id = None, None
+    try:
+        if STREAM_REPLIES:
+            streamer = ReplyStreamer(msg.from_, is_new_session)
+            response, output_session_id = call_opencode_streaming(
+                prompt, streamer, session_id=existing_session, cancel=token,
+                deadline=deadline,
+            )
+        else:
+            response, output_session_id = call_opencode_wrapper(
+                prompt, session_id=existing_session, cancel=token,
+                deadline=deadline,
+            )
+    finally:
+        with _inflight_lock:
+            if _inflight_calls.get(msg.from_) is token:
+                del _inflight_calls[msg.from_]
+            # Save session mapping if this was a new session (unless a
+            # --new/--resume abandoned the call meanwhile)
+            if not token.cancelled and is_new_session and output_session_id:
+                save_session_id(msg.from_, output_session_id)
+                if carryover:
+                    _state().pop_carryover(msg.from_)
+
+    if token.cancelled:
+        # The journal marks this message done once the handler returns.
+        logging.info(f"Dropping abandoned reply for {msg.from_}")
+        append_trail({
+            "from": msg.from_,
+            "to": msg.to,
+            "inbound_ts": msg_date.isoformat(),
+            "inbound": user_text,
+            "action": "cancelled",
+            "session_id": existing_session,
+        })
+        return
+
+    # Prepend session header on first message of a session
+    session_id = output_session_id or existing_session
+    if is_new_session and session_id:
+        response = f"[New session: {session_id}]\n\n{response}"
+
+    append_trail({
+        "from": msg.from_,
+        "to": msg.to,
+        "inbound_ts": msg_date.isoformat(),
+        "inbound": user_text,
+        "model": MODEL,
+        "session_id": session_id,
+        "new_session": is_new_session,
+        "coalesced_sids": [p.sid for p in parts] if parts else None,
+        "prompt_len": len(prompt),
+        "response_len": len(response or ""),
+        "response": response,
+    })
+
+    # Store the reply before sending it, so a restart re-sends this text
+    # rather than asking the model again.
+    part_sids = [p.sid for p in parts] if parts else [msg.sid]
+    journal(
+        msg.sid, RESPONSE_READY,
+        response=response, session_id=session_id, new_session=is_new_session,
+        parts=part_sids,
+    )
+    for sid in part_sids:
+        if sid != msg.sid:
+            journal(sid, RESPONSE_READY, head=msg.sid)
+
+    # A streamed reply has already gone out paragraph by paragraph.
+    futures = list(streamer.futures) if streamer else []
+    if not (streamer and streamer.finished):
+        futures.append(send_whatsapp(msg.from_, response))
+    journal_on_delivery(futures, part_sids)
+
+    if output_session_id:
+        usage = _state().add_session_usage(
+            output_session_id, len(prompt), len(response or "")
+        )
+        if needs_compaction(usage):
+            start_compaction(msg, output_session_id, usage)
+
+
+# ---------------------------------------------------------------------------
+# Inbound: polling + webhook queue
+# ---------------------------------------------------------------------------
+
+def resume_entry(entry: dict, dispatcher: SenderDispatcher) -> None:
+    """
+    Pick up an unfinished journal entry: a message that never got a reply
+    is dispatched again, and a stored reply is re-sent as it is.
+    """
+    with tracing.root("recover", entry["sid"], stage=entry["stage"]):
+        _resume_entry(entry, dispatcher)
+
+
+def _resume_entry(entry: dict, dispatcher: SenderDispatcher) -> None:
+    sid = entry["sid"]
+    if entry["stage"] != RESPONSE_READY:
+        logging.info(f"Journal: re-dispatching {sid} ({entry['stage']})")
+        metrics.inc("agent_journal_recovered_total", stage=entry["stage"])
+        msg = JournalMessage.from_entry(entry)
+        note_arrival(sid)
+        dispatcher.submit(msg.date_sent, msg)
+        return
+
+    head = entry.get("head")
+    if head:
+        # Merged into another message, which carries the reply.
+        head_entry = _journal().journal_get(head)
+        if not head_entry or head_entry["stage"] in FINISHED:
+            journal(sid, DONE)
+        return
+
+    logging.info(f"Journal: re-sending stored reply for {sid}")
+    metrics.inc("agent_journal_recovered_total", stage=RESPONSE_READY)
+    # The session mapping is written behind, so it may not have made
+    # it to disk before the crash.
+    if (entry.get("new_session") and entry.get("session_id")
+            and not get_session_id(entry["from"])):
+        save_session_id(entry["from"], entry["session_id"])
+    future = send_whatsapp(entry["from"], entry["response"])
+    journal_on_delivery([future], entry.get("parts") or [sid])
+    append_trail({
+        "from": entry["from"],
+        "to": entry.get("to"),
+        "inbound_ts": entry.get("date"),
+        "action": "redelivered",
+        "session_id": entry.get("session_id"),
+    })
+
+
+def recover_journal(dispatcher: SenderDispatcher) -> None:
+    """Resume everything the last run left unfinished."""
+    for entry in _journal().journal_unfinished():
+        resume_entry(entry, dispatcher)
+
+
+def take_cluster_work(cluster: Cluster, dispatcher: SenderDispatcher, admit) -> None:
+    """
+    Dispatch the work the leader assigned to this instance, and drop rows
+    for messages this instance has finished.
+    """
+    for row in cluster.claim():
+        sid = row["sid"]
+        if dispatcher.in_flight(sid):
+            continue
+        entry = _journal().journal_get(sid)
+        if entry and entry["stage"] in FINISHED:
+            cluster.finish(sid)
+        elif entry and RANK[entry["stage"]] > RANK[RECEIVED]:
+            # Handed over from an instance that died mid-way.
+            resume_entry(entry, dispatcher)
+        else:
+            msg = JournalMessage.from_entry(row)
+            admit(msg.date_sent, msg)
+    for sid in cluster.claimed():
+        entry = _journal().journal_get(sid)
+        if entry and entry["stage"] in FINISHED:
+            cluster.finish(sid)
+
+
+def drain_inbox(inbox: queue.Queue, timeout: float):
+    """
+    Block up to `timeout` seconds for pushed messages, then take whatever
+    else is already queued. Returns [(msg_date, msg), ...].
+    """
+    pushed = []
+    try:
+        msg = inbox.get(timeout=max(0.0, timeout))
+        pushed.append((msg.date_sent, msg))
+        while True:
+            msg = inbox.get_nowait()
+            pushed.append((msg.date_sent, msg))
+    except queue.Empty:
+        pass
+    return pushed
+
+
+def start_webhook_receiver(inbox: queue.Queue):
+    """Start the signed-webhook HTTP receiver; returns the server or None."""
+    try:
+        from webhook import BackgroundServer, create_app
+        app = create_app(
+            AUTH_TOKEN, inbox,
+            path=WEBHOOK_PATH,
+            public_url=WEBHOOK_PUBLIC_URL,
+        )
+        server = BackgroundServer(app, WEBHOOK_HOST, WEBHOOK_PORT, name="webhook")
+        server.start()
+        logging.info(
+            f"Webhook receiver listening on {WEBHOOK_HOST}:{server.port}{WEBHOOK_PATH}"
+        )
+        return server
+    except Exception as e:
+        logging.error(f"Webhook receiver failed to start, polling only: {e}")
+        return None
+
+
+_stats_dumper = None
+
+
+_profiler = None
+
+
+def start_tracing() -> None:
+    """Start span output and the profiler, if configured."""
+    global _profiler
+    if TRACE_FILE:
+        tracing.enable(
+            TRACE_FILE, sample=TRACE_SAMPLE,
+            resource={"service.instance.id": INSTANCE_ID},
+            rotate_bytes=TRAIL_ROTATE_MB * 1024 * 1024, retention=TRAIL_RETENTION,
+        )
+        logging.info(f"Tracing {TRACE_SAMPLE:.0%} of messages to {TRACE_FILE}")
+    if PROFILE:
+        _profiler = Profiler(
+            PROFILE_DIR, cpu="cpu" in PROFILE, memory="mem" in PROFILE,
+            interval=PROFILE_INTERVAL, sample=PROFILE_SAMPLE,
+        )
+        _profiler.start()
+        logging.info(f"Profiling ({', '.join(sorted(PROFILE))}) into {PROFILE_DIR}/")
+
+
+def profile():
+    """Profile the `with` block if profiling is on (sampled)."""
+    return _profiler.profile() if _profiler else contextlib.nullcontext()
+
+
+def start_metrics() -> None:
+    """Start the /metrics endpoint and stats file writer, if configured."""
+    global _stats_dumper
+    if METRICS_PORT:
+        try:
+            server = metrics.serve(METRICS_HOST, int(METRICS_PORT))
+            logging.info(
+                f"Metrics on http://{METRICS_HOST}:{server.server_address[1]}/metrics"
+            )
+        except Exception as e:
+            logging.error(f"Metrics endpoint failed to start: {e}")
+    if STATS_FILE:
+        _stats_dumper = metrics.StatsDumper(STATS_FILE, interval=STATS_INTERVAL)
+        _stats_dumper.start()
+
+
+_cluster = None
+
+
+def shutdown() -> None:
+    """Stop opencode workers and flush buffered trail, state and stats on exit."""
+    if _backend is not None:
+        _backend.close()
+    if _outbound_sender is not None:
+        _outbound_sender.close()
+    if _trail_writer is not None:
+        _trail_writer.close()
+    if _cluster is not None:
+        _cluster.stop()
+    if _message_journal is not None and _message_journal is not _state_store:
+        _message_journal.close()
+    if _state_store is not None:
+        _state_store.close()
+        logging.info("State flushed.")
+    if _stats_dumper is not None:
+        _stats_dumper.stop()
+    if _profiler is not None:
+        _profiler.stop()
+    tracing.disable()
 
 
 def main():
@@ -313,184 +1400,214 @@ def main():
         logging.error("Twilio credentials not found")
         return
 
+    if CLUSTER and STATE_BACKEND != "sqlite":
+        logging.error("AGENT_CLUSTER=1 needs AGENT_STATE_BACKEND=sqlite (shared state)")
+        return
+
     identity_text = load_identity_text()
     if identity_text:
         logging.info(f"Loaded identity from {IDENTITY_FILE} ({len(identity_text)} chars)")
     else:
         logging.warning(f"No identity loaded (missing/empty {IDENTITY_FILE})")
 
-    client = Client(ACCOUNT_SID, AUTH_TOKEN)
+    # Polling shares the outbound sender's client and connection pool.
+    client = _outbound().client
+
+    # systemd stops the service with SIGTERM; raise SystemExit instead so
+    # atexit runs and pending state reaches disk.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    atexit.register(shutdown)
+    start_tracing()
+
+    # Start warm workers (if configured) before the first message needs them.
+    _opencode_backend()
+    # Index stored sessions now so the first --resume doesn't pay for it.
+    _catalog()
 
     last_processed = get_last_processed_time()
     logging.info(f"Resuming from {last_processed}")
 
-    while True:
-        try:
-            # Poll for messages
-            messages = client.messages.list(
-                date_sent_after=last_processed - timedelta(minutes=5),
-                to=FROM_WA,
-                limit=50
-            )
-
-            new_messages = []
-            for msg in reversed(messages):
-                if msg.direction != 'inbound':
-                    continue
+    seen_file = f"inbound_seen.{INSTANCE_ID}.txt" if CLUSTER else SEEN_SIDS_FILE
+    seen = SeenSids(seen_file, maxlen=SEEN_SIDS_MAX)
+    cursor = InboundCursor(
+        client, FROM_WA, seen,
+        # A lost push can be up to a reconciliation interval older than
+        # the newest pushed message, which may already be the watermark.
+        overlap=POLL_OVERLAP + (RECONCILE_INTERVAL if INBOUND_MODE == "webhook" else 0),
+        min_interval=POLL_MIN_INTERVAL,
+        max_interval=POLL_MAX_INTERVAL,
+    )
 
-                if msg.date_sent:
-                    msg_date = msg.date_sent.astimezone(timezone.utc)
-                else:
-                    continue
+    # In webhook mode the poll becomes a slow reconciliation pass that only
+    # catches what the push path missed (e.g. while the receiver was down).
+    # None: not started yet; False: failed to start, polling only.
+    inbox: queue.Queue = queue.Queue()
+    webhook = None
+
+    def process(msg_date, msg):
+        metrics.inc("agent_messages_total")
+        parts = getattr(msg, "parts", None) or [msg]
+        if len(parts) > 1:
+            metrics.inc("agent_coalesced_messages_total", len(parts))
+        # The trace starts when the user sent the message; inbound.wait
+        # covers the poll delay and the wait on the sender's lane.
+        now_ns = time.time_ns()
+        sent_ns = min(int(msg_date.timestamp() * 1e9), now_ns)
+        with tracing.root(
+            "message", msg.sid, start=sent_ns, sender=msg.from_,
+            parts=len(parts), command=is_command(msg.body),
+        ), profile():
+            tracing.record("inbound.wait", sent_ns, now_ns)
+            for part in parts:
+                journal(part.sid, DISPATCHED)
+            try:
+                with metrics.timer("agent_handle_seconds"):
+                    handle_message(msg_date, msg, identity_text)
+            finally:
+                # Commands, cancelled calls and failed handlers end here; a
+                # model reply has already moved on to response_ready.
+                for part in parts:
+                    entry = _journal().journal_get(part.sid)
+                    if entry and RANK[entry["stage"]] < RANK[RESPONSE_READY]:
+                        journal(part.sid, DONE)
+        for part in parts:
+            seen.add(part.sid)
+
+    def can_merge(msg):
+        return not is_command(msg.body)
+
+    # In cluster mode the leader moves the shared watermark as it hands
+    # messages out; the lanes' own watermark only covers local work.
+    dispatcher = SenderDispatcher(
+        process,
+        max_workers=MAX_CONCURRENCY,
+        watermark=last_processed,
+        on_watermark=None if CLUSTER else save_last_processed_time,
+        on_dequeue=lambda wait: metrics.observe("agent_dispatch_wait_seconds", wait),
+        can_merge=can_merge,
+        coalesce_window=COALESCE_WINDOW,
+        max_coalesce_wait=COALESCE_MAX_WAIT,
+        # Commands skip the queue: the fast lane if the sender has nothing
+        # queued or running, else next on the sender's own lane (admit()
+        # cancels a running call first for --new / --resume).
+        is_urgent=lambda msg: is_command(msg.body),
+    )
+    metrics.gauge("agent_dispatch_pending", dispatcher.pending_count)
+    metrics.gauge("agent_outbound_pending", _outbound().pending)
+    metrics.gauge("agent_opencode_running", _admission().running)
+    metrics.gauge("agent_opencode_waiting", _admission().waiting)
+
+    def admit(msg_date, msg):
+        """Queue a message on this instance's lanes, unless admission refuses it."""
+        if not is_command(msg.body):
+            reason = _admission().check(msg.from_, dispatcher.pending_count())
+            if reason:
+                shed_message(msg_date, msg, reason)
+                journal(msg.sid, DONE)
+                seen.add(msg.sid)
+                dispatcher.skip(msg_date, msg)
+                return
+        else:
+            preempt(msg)
+        note_arrival(msg.sid)
+        dispatcher.submit(msg_date, msg)
+
+    global _cluster
+    cluster = None
+    if CLUSTER:
+        cluster = _cluster = Cluster(STATE_DB, INSTANCE_ID, ttl=CLUSTER_TTL)
+        cluster.start()
+        metrics.gauge("agent_cluster_pending", cluster.pending)
+        logging.info(
+            f"Cluster instance {INSTANCE_ID}; live: {', '.join(cluster.live_instances())}"
+        )
 
-                if msg_date <= last_processed:
-                    continue
+    start_metrics()
+    logging.info(f"Dispatching with up to {MAX_CONCURRENCY} concurrent senders")
 
-                new_messages.append((msg_date, msg))
+    # In cluster mode unfinished work comes back through the work table.
+    try:
+        pruned = _journal().journal_prune(JOURNAL_RETENTION)
+        if pruned:
+            logging.info(f"Journal: pruned {pruned} finished entries")
+        if not cluster:
+            recover_journal(dispatcher)
+    except Exception as e:
+        logging.error(f"Journal recovery failed: {e}")
 
-            for msg_date, msg in new_messages:
-                user_text = (msg.body or "").strip()
-                user_lower = user_text.lower()
-                logging.info(f"Received message from {msg.from_}: {user_text}")
+    next_poll = 0.0
+    leader = False
 
-                # ---- Command: --id ----
-                if user_lower == ID_COMMAND:
-                    cur = get_session_id(msg.from_)
-                    if cur:
-                        reply = f"Current session: {format_session_display(cur)}"
-                    else:
-                        reply = "No active session. Send a message to start one."
-                    send_whatsapp(msg.from_, reply)
-                    last_processed = msg_date
-                    save_last_processed_time(last_processed)
-                    continue
-
-                # ---- Command: --rename <alias> ----
-                if user_lower.startswith(RENAME_PREFIX):
-                    alias = user_text[len(RENAME_PREFIX):].strip()
-                    cur = get_session_id(msg.from_)
-                    if not cur:
-                        send_whatsapp(msg.from_, "No active session to rename.")
-                    elif not alias:
-                        send_whatsapp(msg.from_, "Usage: --rename <name>")
+    while True:
+        try:
+            with profile():
+                if cluster:
+                    take_cluster_work(cluster, dispatcher, admit)
+                    if cluster.is_leader() != leader:
+                        leader = not leader
+                        if leader:
+                            # The previous leader may have moved the watermark.
+                            last_processed = get_last_processed_time()
+                            next_poll = 0.0
+                        elif webhook:
+                            webhook.stop()
+                        webhook = None
+                inbound = not cluster or leader
+
+                if inbound and INBOUND_MODE == "webhook" and webhook is None:
+                    webhook = start_webhook_receiver(inbox) or False
+
+                wait = next_poll - time.time() if inbound else CLUSTER_TICK
+                if cluster:
+                    wait = min(wait, CLUSTER_TICK)
+                new_messages = drain_inbox(inbox, wait)
+                pushed = bool(new_messages)
+
+                if inbound and time.time() >= next_poll:
+                    if not cluster:
+                        last_processed = dispatcher.watermark or last_processed
+                    with metrics.timer("agent_poll_seconds"), tracing.span("poll") as span:
+                        polled = cursor.poll(last_processed)
+                        if span:
+                            span.set(messages=len(polled))
+                    new_messages.extend(polled)
+                    new_messages.sort(key=lambda m: m[0])
+                    seen.save()
+                    if webhook:
+                        interval = RECONCILE_INTERVAL
                     else:
-                        set_alias(alias, cur)
-                        send_whatsapp(
-                            msg.from_,
-                            f'Session renamed to "{alias}"\n({cur})'
-                        )
-                    append_trail({
-                        "from": msg.from_,
-                        "to": msg.to,
-                        "inbound_ts": msg_date.isoformat(),
-                        "inbound": user_text,
-                        "action": "session_rename",
-                        "session_id": cur,
-                        "alias": alias or None,
-                    })
-                    last_processed = msg_date
-                    save_last_processed_time(last_processed)
-                    continue
-
-                # ---- Command: --new / !reset / !new ----
-                if user_lower in RESET_COMMANDS:
-                    old_session = get_session_id(msg.from_)
-                    clear_session(msg.from_)
-                    reply = "Session cleared. Send a message to start fresh."
-                    if old_session:
-                        reply += f"\n(Previous: {format_session_display(old_session)})"
-                    send_whatsapp(msg.from_, reply)
-                    append_trail({
-                        "from": msg.from_,
-                        "to": msg.to,
-                        "inbound_ts": msg_date.isoformat(),
-                        "inbound": user_text,
-                        "action": "session_reset",
-                        "old_session": old_session,
-                    })
-                    last_processed = msg_date
-                    save_last_processed_time(last_processed)
-                    continue
-
-                # ---- Command: --resume <session_id or alias> ----
-                if user_lower.startswith(RESUME_PREFIX):
-                    raw = user_text[len(RESUME_PREFIX):].strip()
-                    # Strip optional "id:" prefix
-                    if raw.lower().startswith("id:"):
-                        raw = raw[3:].strip()
-                    if not raw:
-                        send_whatsapp(msg.from_, "Usage: --resume <session_id or alias>")
+                        backlog = cluster.pending() if cluster else dispatcher.pending_count()
+                        active = bool(polled) or pushed or backlog > 0
+                        interval = cursor.next_interval(active)
+                    next_poll = time.time() + interval
+
+                # Handled SIDs are skipped here, and anything already in the
+                # journal is in flight or finished, so each message runs once.
+                handed_off = None
+                for msg_date, msg in new_messages:
+                    if (msg.sid in seen or dispatcher.in_flight(msg.sid)
+                            or _journal().journal_get(msg.sid)):
+                        continue
+                    fields = {"from": msg.from_, "to": msg.to, "body": msg.body,
+                              "date": msg_date.isoformat()}
+                    # Hand off before journaling, so a crash in between means
+                    # the message is assigned again rather than forgotten.
+                    owner = cluster and cluster.assign(msg.sid, msg.from_, fields["date"], fields)
+                    journal(msg.sid, RECEIVED, **fields)
+                    if owner:
+                        seen.add(msg.sid)
+                        handed_off = max(handed_off or msg_date, msg_date)
                     else:
-                        target_id = resolve_session_or_alias(raw)
-                        if not target_id:
-                            send_whatsapp(msg.from_, f'Alias "{raw}" not found.')
-                        elif not session_exists_on_disk(target_id):
-                            send_whatsapp(msg.from_, f"Session {target_id} not found on disk.")
-                        else:
-                            save_session_id(msg.from_, target_id)
-                            send_whatsapp(
-                                msg.from_,
-                                f"Session resumed: {format_session_display(target_id)}\nSend a message to continue."
-                            )
-                    append_trail({
-                        "from": msg.from_,
-                        "to": msg.to,
-                        "inbound_ts": msg_date.isoformat(),
-                        "inbound": user_text,
-                        "action": "session_resume",
-                        "target_input": raw if raw else None,
-                    })
-                    last_processed = msg_date
-                    save_last_processed_time(last_processed)
-                    continue
-
-                # ---- Normal message processing ----
-                existing_session = get_session_id(msg.from_)
-                is_new_session = not existing_session
-
-                # Build the prompt:
-                # - First message (no session yet): include identity
-                # - Continuing session: just the user text (identity is in history)
-                if existing_session:
-                    prompt = user_text
-                else:
-                    prompt = build_prompt(identity_text, user_text)
-
-                response, output_session_id = call_opencode_wrapper(
-                    prompt, session_id=existing_session
-                )
+                        admit(msg_date, msg)
 
-                # Save session mapping if this was a new session
-                if is_new_session and output_session_id:
-                    save_session_id(msg.from_, output_session_id)
-
-                # Prepend session header on first message of a session
-                session_id = output_session_id or existing_session
-                if is_new_session and session_id:
-                    response = f"[New session: {session_id}]\n\n{response}"
-
-                append_trail({
-                    "from": msg.from_,
-                    "to": msg.to,
-                    "inbound_ts": msg_date.isoformat(),
-                    "inbound": user_text,
-                    "model": "openai/gpt-5.2",
-                    "session_id": session_id,
-                    "new_session": is_new_session,
-                    "prompt_len": len(prompt),
-                    "response_len": len(response or ""),
-                    "response": response,
-                })
-
-                send_whatsapp(msg.from_, response)
-
-                last_processed = msg_date
-                save_last_processed_time(last_processed)
+                if handed_off and handed_off > last_processed:
+                    last_processed = handed_off
+                    save_last_processed_time(last_processed)
 
         except Exception as e:
             logging.error(f"Error in main loop: {e}")
-
-        time.sleep(5)
+            next_poll = time.time() + POLL_MIN_INTERVAL
+            time.sleep(POLL_MIN_INTERVAL)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,273 @@
+"""
+cluster.py — lease-based multi-instance mode for the WhatsApp agent.
+
+Several agent processes on one host share one SQLite database (the SQLite
+state backend's AGENT_STATE_DB, on a local filesystem) and split the work
+between them. WAL mode coordinates writers through shared memory, which
+does not work across hosts or over NFS/SMB: there the lease could be held
+twice and the database corrupted, so this is a single-host mode.
+
+  instances   every process heartbeats here; one that stops for `ttl`
+              seconds is considered dead
+  leases      the "inbound" lease: its holder is the only instance that
+              polls Twilio or runs the webhook receiver (the leader)
+  work        messages the leader has handed to their owner; a row stays
+              until its owner has finished the message
+
+A sender's owner is picked by rendezvous hashing of msg.from_ over the
+live instances, so adding or losing an instance only moves the senders
+that hashed to it. While a sender still has work queued, new messages
+follow that work to the same instance, so one sender is never handled in
+two places at once. When an instance dies, the leader hands its rows to
+the new owners, and a dead leader's lease is taken over once it expires.
+The inbound journal (journal.py) decides on the new owner whether a
+handed-over message needs a model call or just a re-send.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    instance_id TEXT PRIMARY KEY,
+    host        TEXT,
+    pid         INTEGER,
+    heartbeat   REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name    TEXT PRIMARY KEY,
+    holder  TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS work (
+    sid        TEXT PRIMARY KEY,
+    sender     TEXT NOT NULL,
+    owner      TEXT NOT NULL,
+    claimed    INTEGER NOT NULL DEFAULT 0,
+    date       TEXT NOT NULL,
+    message    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS work_by_owner ON work(owner, claimed, date);
+CREATE INDEX IF NOT EXISTS work_by_sender ON work(sender);
+"""
+
+INBOUND_LEASE = "inbound"
+
+
+def rendezvous_owner(sender: str, instances: list[str]) -> Optional[str]:
+    """The instance with the highest hash(instance, sender)."""
+    if not instances:
+        return None
+    return max(
+        instances,
+        key=lambda i: hashlib.sha1(f"{i}\0{sender}".encode()).digest(),
+    )
+
+
+class Cluster:
+    """
+    One shared connection in autocommit mode, like SqliteStore. A daemon
+    thread heartbeats every ttl/3 seconds, renews or takes the inbound
+    lease, and (on the leader) reassigns work owned by dead instances.
+    """
+
+    def __init__(self, path: str, instance_id: str, ttl: float = 15.0):
+        self.path = path
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._leader = threading.Event()
+        self._stop = threading.Event()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(SCHEMA)
+        self._thread = threading.Thread(
+            target=self._run, name="cluster", daemon=True
+        )
+
+    # -- lifecycle ----------------------------------------------------------
+
+    def start(self) -> None:
+        # Work this instance had taken before a restart is taken again.
+        with self._lock:
+            self._conn.execute(
+                "UPDATE work SET claimed = 0 WHERE owner = ?", (self.instance_id,)
+            )
+        self.tick()
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Leave the cluster: give up the lease so others take over at once."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM leases WHERE name = ? AND holder = ?",
+                (INBOUND_LEASE, self.instance_id),
+            )
+            self._conn.execute(
+                "DELETE FROM instances WHERE instance_id = ?", (self.instance_id,)
+            )
+            self._conn.close()
+        self._leader.clear()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.tick()
+            except Exception as e:
+                logging.error(f"Cluster heartbeat failed: {e}")
+
+    def tick(self) -> None:
+        """Heartbeat, renew or take the inbound lease, and rebalance if leader."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO instances VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(instance_id) DO UPDATE SET "
+                "host = excluded.host, pid = excluded.pid, heartbeat = excluded.heartbeat",
+                (self.instance_id, socket.gethostname(), os.getpid(), now),
+            )
+            # Take the lease if it is free, expired, or already ours.
+            holder = self._conn.execute(
+                "INSERT INTO leases VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET "
+                "holder = excluded.holder, expires = excluded.expires "
+                "WHERE leases.holder = excluded.holder OR leases.expires < ? "
+                "RETURNING holder",
+                (INBOUND_LEASE, self.instance_id, now + self.ttl, now),
+            ).fetchone()
+        was_leader = self._leader.is_set()
+        if holder:
+            self._leader.set()
+            if not was_leader:
+                logging.info(f"Instance {self.instance_id} took the inbound lease")
+            moved = self.reassign_orphans()
+            if moved:
+                logging.info(f"Reassigned {moved} messages from dead instances")
+        elif was_leader:
+            self._leader.clear()
+            logging.warning(f"Instance {self.instance_id} lost the inbound lease")
+
+    def is_leader(self) -> bool:
+        return self._leader.is_set()
+
+    def live_instances(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT instance_id FROM instances WHERE heartbeat >= ? "
+                "ORDER BY instance_id",
+                (time.time() - self.ttl,),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    # -- leader: hand out work ------------------------------------------------
+
+    def assign(self, sid: str, sender: str, date: str, message: dict) -> Optional[str]:
+        """
+        Queue a message for its sender's owner; returns the owner. A sender
+        with work still queued stays with that instance while it is alive.
+        Work the sender has queued on dead instances moves to the owner in
+        the same transaction, so no two instances hold one sender's work.
+        """
+        live = self.live_instances()
+        if not live:
+            return None
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                owner = self._owner_for(sender, live)
+                self._move_orphans(sender, owner, live)
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO work (sid, sender, owner, date, message) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (sid, sender, owner, date, json.dumps(message, ensure_ascii=True)),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return owner
+
+    def reassign_orphans(self) -> int:
+        """Move work owned by dead instances to the senders' new owners."""
+        live = self.live_instances()
+        if not live:
+            return 0
+        marks = ", ".join("?" * len(live))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    f"SELECT DISTINCT sender FROM work WHERE owner NOT IN ({marks})",
+                    live,
+                ).fetchall()
+                for (sender,) in rows:
+                    self._move_orphans(sender, self._owner_for(sender, live), live)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def _owner_for(self, sender: str, live: list[str]) -> str:
+        """The live instance already holding sender's work, else its hash owner."""
+        marks = ", ".join("?" * len(live))
+        row = self._conn.execute(
+            f"SELECT owner FROM work WHERE sender = ? AND owner IN ({marks}) LIMIT 1",
+            (sender, *live),
+        ).fetchone()
+        return row[0] if row else rendezvous_owner(sender, live)
+
+    def _move_orphans(self, sender: str, owner: str, live: list[str]) -> None:
+        marks = ", ".join("?" * len(live))
+        self._conn.execute(
+            f"UPDATE work SET owner = ?, claimed = 0 "
+            f"WHERE sender = ? AND owner NOT IN ({marks})",
+            (owner, sender, *live),
+        )
+
+    # -- owner: take and finish work ------------------------------------------
+
+    def claim(self) -> list[dict]:
+        """Work assigned to this instance and not yet taken, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "UPDATE work SET claimed = 1 WHERE owner = ? AND claimed = 0 "
+                "RETURNING sid, message",
+                (self.instance_id,),
+            ).fetchall()
+        claimed = [{"sid": sid, **json.loads(message)} for sid, message in rows]
+        return sorted(claimed, key=lambda m: m.get("date") or "")
+
+    def claimed(self) -> list[str]:
+        """SIDs this instance has taken and not finished."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sid FROM work WHERE owner = ? AND claimed = 1",
+                (self.instance_id,),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def finish(self, sid: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM work WHERE sid = ?", (sid,))
+
+    def pending(self) -> int:
+        """Messages handed out cluster-wide and not yet finished."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM work").fetchone()[0]
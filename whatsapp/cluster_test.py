@@ -0,0 +1,177 @@
+"""
+cluster_test.py — deterministic checks of multi-instance work assignment.
+
+Two or three Cluster objects share a temporary database, as separate
+processes would; heartbeats are written by calling tick() (or by editing
+the instances table) instead of by the background thread. A sender's work
+must go to its rendezvous owner, stay with whichever live instance already
+holds some of it, and move as a whole, unclaimed, once that instance dies.
+Journal records written through SqliteStore from two connections must
+never move a message back to an earlier stage.
+
+  python cluster_test.py      (or: python -m pytest cluster_test.py)
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from cluster import Cluster, rendezvous_owner
+from journal import DISPATCHED, RECEIVED, SENT
+from sqlite_store import SqliteStore
+
+NAMES = ("inst-a", "inst-b", "inst-c")
+
+
+def join(path: str, *names: str) -> list[Cluster]:
+    nodes = [Cluster(path, name, ttl=60) for name in names]
+    for node in nodes:
+        node.tick()
+    return nodes
+
+
+def kill(path: str, name: str) -> None:
+    """Make an instance look like it stopped heartbeating long ago."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("UPDATE instances SET heartbeat = 0 WHERE instance_id = ?", (name,))
+    conn.close()
+
+
+def owners(path: str) -> dict[str, tuple[str, int]]:
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT sid, owner, claimed FROM work").fetchall()
+    conn.close()
+    return {sid: (owner, claimed) for sid, owner, claimed in rows}
+
+
+def sender_owned_by(
+    name: str, instances: list[str], then: str = "", start: int = 0
+) -> str:
+    """
+    A sender that rendezvous hashing gives to `name`, and (with `then`) to
+    `then` once it joins.
+    """
+    for i in range(start, start + 1000):
+        sender = f"whatsapp:+1555{i:07d}"
+        if rendezvous_owner(sender, instances) == name and (
+            not then or rendezvous_owner(sender, [*instances, then]) == then
+        ):
+            return sender
+    raise AssertionError(f"no sender hashes to {name}")
+
+
+def close(nodes: list[Cluster]) -> None:
+    for node in nodes:
+        node.stop()
+
+
+def test_work_goes_to_the_hash_owner_and_stays_there():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "state.db")
+        nodes = join(path, *NAMES[:2])
+        try:
+            leader = nodes[0]
+            assert leader.is_leader() and not nodes[1].is_leader()
+            sender = sender_owned_by("inst-b", list(NAMES[:2]), then="inst-c")
+            assert leader.assign("m1", sender, "1", {}) == "inst-b"
+
+            # A new instance that the sender now hashes to does not take
+            # over while inst-b still holds queued work for them.
+            nodes += join(path, "inst-c")
+            assert rendezvous_owner(sender, leader.live_instances()) == "inst-c"
+            other = sender_owned_by("inst-c", list(NAMES), start=1000)
+            assert leader.assign("m2", other, "2", {}) == "inst-c"
+            assert leader.assign("m3", sender, "3", {}) == "inst-b"
+            assert [m["sid"] for m in nodes[1].claim()] == ["m1", "m3"]
+        finally:
+            close(nodes)
+
+
+def test_assign_moves_a_dead_owners_work_with_the_new_message():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "state.db")
+        nodes = join(path, *NAMES)
+        try:
+            leader = nodes[0]
+            sender = sender_owned_by("inst-c", list(NAMES))
+            leader.assign("m1", sender, "1", {"n": 1})
+            leader.assign("m2", sender, "2", {"n": 2})
+            assert [m["sid"] for m in nodes[2].claim()] == ["m1", "m2"]
+
+            kill(path, "inst-c")
+            owner = leader.assign("m3", sender, "3", {"n": 3})
+            assert owner == rendezvous_owner(sender, ["inst-a", "inst-b"])
+            # Claimed or not, all of the sender's work moved, and must be
+            # taken again by the new owner.
+            assert owners(path) == {sid: (owner, 0) for sid in ("m1", "m2", "m3")}
+            new = nodes[NAMES.index(owner)]
+            assert [m["sid"] for m in new.claim()] == ["m1", "m2", "m3"]
+            assert new.claim() == []
+        finally:
+            close(nodes)
+
+
+def test_leader_reassigns_orphans_without_new_messages():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "state.db")
+        nodes = join(path, *NAMES)
+        try:
+            leader = nodes[0]
+            senders = [sender_owned_by(n, list(NAMES)) for n in NAMES]
+            for i, sender in enumerate(senders):
+                leader.assign(f"m{i}", sender, str(i), {})
+            nodes[1].claim()
+
+            kill(path, "inst-b")
+            assert leader.reassign_orphans() == 1
+            moved = owners(path)
+            assert moved["m0"] == ("inst-a", 0) and moved["m2"] == ("inst-c", 0)
+            assert moved["m1"] == (rendezvous_owner(senders[1], ["inst-a", "inst-c"]), 0)
+            assert leader.reassign_orphans() == 0
+
+            leader.finish("m0")
+            assert leader.pending() == 2
+        finally:
+            close(nodes)
+
+
+def test_journal_is_not_rolled_back_by_a_concurrent_writer():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "state.db")
+        store = SqliteStore(path)
+        other = SqliteStore(path)  # another instance's connection
+        try:
+            store.journal_record("m1", RECEIVED, date="1", body="hi")
+            # Another process is in the middle of a write when this one
+            # records an earlier stage it still believed current.
+            other._conn.execute("BEGIN IMMEDIATE")
+            result = []
+            writer = threading.Thread(
+                target=lambda: result.append(store.journal_record("m1", DISPATCHED))
+            )
+            writer.start()
+            time.sleep(0.1)
+            other._conn.execute(
+                "UPDATE journal SET stage = ?, entry = json_set(entry, '$.stage', ?) "
+                "WHERE sid = ?", (SENT, SENT, "m1"),
+            )
+            other._conn.execute("COMMIT")
+            writer.join(5)
+
+            assert result == [False]
+            assert store.journal_get("m1")["stage"] == SENT
+            assert other.journal_get("m1")["body"] == "hi"
+        finally:
+            store.close()
+            other.close()
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(f"ok  {name}")
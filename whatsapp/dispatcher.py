@@ -0,0 +1,298 @@
+"""
+dispatcher.py — concurrent per-sender dispatch for the WhatsApp agent.
+
+Each sender (msg.from_) gets its own FIFO lane. Lanes run on a shared
+thread pool, so different senders are served in parallel (up to
+max_workers at once) while messages from the same sender are handled
+strictly in arrival order.
+
+The watermark (last_processed_time) only moves past a message once it and
+every older message have finished, so a crash never skips work that was
+still in flight.
+
+Optionally, runs of mergeable messages (as decided by can_merge, e.g. "not
+a chat command") at the head of a lane are coalesced into one
+CoalescedMessage: everything already queued behind the head is merged, and
+with coalesce_window > 0 the lane also waits until no new message has
+arrived for that long (but never longer than max_coalesce_wait in total).
+A non-mergeable message ends the run, so commands keep their place.
+
+Messages flagged by is_urgent (chat commands that only touch local state)
+are never stuck behind a long queue, yet stay ordered against their
+sender's other messages. While the sender has nothing queued or running on
+its lane, an urgent message runs, in arrival order, on a separate
+single-thread fast lane, so it is answered straight away however much slow
+work other senders have; the sender's later messages wait on their lane
+until it has finished. Otherwise it goes to the front of the sender's lane
+(behind urgent messages already there) and runs as soon as the current
+one finishes. They still count towards the watermark.
+"""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Optional
+
+
+@dataclass
+class CoalescedMessage:
+    """Several inbound messages from one sender, handled as one."""
+    sid: str
+    from_: str
+    to: str
+    body: str
+    date_sent: datetime
+    parts: list = field(default_factory=list)
+    direction: str = "inbound"
+
+    @classmethod
+    def merge(cls, msgs: list) -> "CoalescedMessage":
+        last = msgs[-1]
+        return cls(
+            sid=last.sid,
+            from_=last.from_,
+            to=last.to,
+            body="\n".join((m.body or "").strip() for m in msgs),
+            date_sent=last.date_sent,
+            parts=list(msgs),
+        )
+
+
+class SenderDispatcher:
+    """
+    handler(msg_date, msg) is called on a worker thread. on_watermark(dt) is
+    called (under the dispatcher lock, so in order) whenever the safe
+    watermark advances. on_dequeue(seconds), if given, receives how long
+    each message waited on its lane before its handler started.
+
+    With can_merge set, a coalesced batch reaches the handler as (newest
+    msg_date, CoalescedMessage); msg.parts lists the original messages.
+    With is_urgent set, matching messages go to the fast lane, or to the
+    front of their sender's lane if it has work (see the module docstring).
+
+    A handler that raises is logged and counted as finished; it is not
+    retried, so one bad message cannot pin the watermark forever.
+    """
+
+    def __init__(
+        self,
+        handler: Callable,
+        max_workers: int = 4,
+        watermark: Optional[datetime] = None,
+        on_watermark: Optional[Callable[[datetime], None]] = None,
+        on_dequeue: Optional[Callable[[float], None]] = None,
+        can_merge: Optional[Callable[[object], bool]] = None,
+        coalesce_window: float = 0,
+        max_coalesce_wait: float = 10,
+        is_urgent: Optional[Callable[[object], bool]] = None,
+    ):
+        self._handler = handler
+        self._on_watermark = on_watermark
+        self._on_dequeue = on_dequeue
+        self._can_merge = can_merge
+        self._coalesce_window = coalesce_window
+        self._max_coalesce_wait = max_coalesce_wait
+        self._is_urgent = is_urgent
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="lane"
+        )
+        self._fast = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fast")
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._lanes: dict[str, deque] = {}
+        self._running: set[str] = set()     # senders with a task on the pool
+        self._armed: set[str] = set()       # running senders waiting on a coalesce timer
+        self._urgent: dict[str, int] = {}   # sender -> messages on the fast lane
+        self._pending: list = []            # heap of (msg_date, seq)
+        self._done: set[int] = set()        # finished seqs still in the heap
+        self._inflight: set[str] = set()    # SIDs submitted, not finished
+        self._watermark = watermark
+
+    @property
+    def watermark(self) -> Optional[datetime]:
+        with self._lock:
+            return self._watermark
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending) - len(self._done)
+
+    def in_flight(self, sid: str) -> bool:
+        with self._lock:
+            return sid in self._inflight
+
+    def submit(self, msg_date: datetime, msg) -> bool:
+        """Queue a message on its sender's lane. False if already in flight."""
+        sender = msg.from_
+        with self._lock:
+            if msg.sid in self._inflight:
+                return False
+            entry = (next(self._seq), msg_date, msg, time.monotonic())
+            self._inflight.add(msg.sid)
+            heapq.heappush(self._pending, (msg_date, entry[0]))
+            lane = self._lanes.get(sender)
+            if self._is_urgent and self._is_urgent(msg):
+                if lane is None:
+                    self._urgent[sender] = self._urgent.get(sender, 0) + 1
+                    self._fast.submit(self._run_urgent, *entry)
+                    return True
+                # Run next on the lane, after urgent messages already in front.
+                front = 0
+                while front < len(lane) and self._is_urgent(lane[front][2]):
+                    front += 1
+                lane.insert(front, entry)
+                if sender in self._armed:
+                    # Don't let it sit out a coalesce wait.
+                    self._armed.discard(sender)
+                    self._pool.submit(self._run_next, sender)
+                return True
+            self._lanes.setdefault(sender, deque()).append(entry)
+            self._start(sender)
+        return True
+
+    def _start(self, sender: str) -> None:
+        """
+        Run sender's lane unless it is already running or an urgent message
+        of theirs has yet to finish on the fast lane. Caller holds the lock.
+        """
+        if sender in self._running or self._urgent.get(sender):
+            return
+        self._running.add(sender)
+        self._pool.submit(self._run_next, sender)
+
+    def skip(self, msg_date: datetime, msg) -> None:
+        """
+        Account for a message that will not be handled (e.g. shed by
+        admission control), so the watermark can move past it.
+        """
+        with self._lock:
+            seq = next(self._seq)
+            heapq.heappush(self._pending, (msg_date, seq))
+            self._finish(seq, msg.sid)
+
+    def _take(self, sender: str) -> Optional[list]:
+        """
+        Pop the next batch off a lane: the head, plus the run of mergeable
+        messages behind a mergeable head. Returns None, leaving the lane
+        untouched and arming a timer, if the run should wait for more
+        messages first. Caller holds the lock.
+        """
+        lane = self._lanes[sender]
+        batch = [lane.popleft()]
+        if self._can_merge is None or not self._can_merge(batch[0][2]):
+            return batch
+        while lane and self._can_merge(lane[0][2]):
+            batch.append(lane.popleft())
+
+        # Something non-mergeable is queued behind the run: go now.
+        if lane:
+            return batch
+        now = time.monotonic()
+        wait = min(
+            self._coalesce_window - (now - batch[-1][3]),
+            self._max_coalesce_wait - (now - batch[0][3]),
+        )
+        if wait <= 0:
+            return batch
+        lane.extendleft(reversed(batch))
+        self._armed.add(sender)
+        timer = threading.Timer(wait, self._resubmit, (sender,))
+        timer.daemon = True
+        timer.start()
+        return None
+
+    def _resubmit(self, sender: str) -> None:
+        with self._lock:
+            if sender not in self._armed:
+                return  # an urgent message already restarted the lane
+            self._armed.discard(sender)
+            try:
+                self._pool.submit(self._run_next, sender)
+            except RuntimeError:
+                pass  # pool already shut down
+
+    def _run_next(self, sender: str) -> None:
+        """Handle the next batch of one lane, then requeue the lane if non-empty.
+
+        Requeueing (rather than draining the lane in a loop) keeps a chatty
+        sender from holding a worker while others wait.
+        """
+        with self._lock:
+            batch = self._take(sender)
+        if batch is None:
+            return
+
+        if len(batch) == 1:
+            _, msg_date, msg, _ = batch[0]
+        else:
+            msg_date = batch[-1][1]
+            msg = CoalescedMessage.merge([m for _, _, m, _ in batch])
+            logging.info(f"Coalesced {len(batch)} messages from {sender}")
+        try:
+            if self._on_dequeue:
+                now = time.monotonic()
+                for _, _, _, queued_at in batch:
+                    self._on_dequeue(now - queued_at)
+            self._handler(msg_date, msg)
+        except Exception as e:
+            logging.error(f"Handler failed for {msg.sid} from {sender}: {e}")
+        finally:
+            with self._lock:
+                for seq, _, part, _ in batch:
+                    self._finish(seq, part.sid)
+                if self._lanes[sender]:
+                    self._pool.submit(self._run_next, sender)
+                else:
+                    del self._lanes[sender]
+                    self._running.discard(sender)
+
+    def _run_urgent(self, seq: int, msg_date: datetime, msg, queued_at: float) -> None:
+        sender = msg.from_
+        try:
+            if self._on_dequeue:
+                self._on_dequeue(time.monotonic() - queued_at)
+            self._handler(msg_date, msg)
+        except Exception as e:
+            logging.error(f"Handler failed for {msg.sid} from {sender}: {e}")
+        finally:
+            with self._lock:
+                self._finish(seq, msg.sid)
+                self._urgent[sender] -= 1
+                if not self._urgent[sender]:
+                    del self._urgent[sender]
+                    if self._lanes.get(sender):
+                        self._start(sender)
+
+    def _finish(self, seq: int, sid: str) -> None:
+        """Mark seq done and advance the watermark. Caller holds the lock."""
+        self._inflight.discard(sid)
+        self._done.add(seq)
+
+        advanced = None
+        while self._pending and self._pending[0][1] in self._done:
+            msg_date, done_seq = heapq.heappop(self._pending)
+            self._done.discard(done_seq)
+            # Polls skip anything <= watermark, so never advance onto a
+            # timestamp an unfinished message still shares.
+            if not self._pending or self._pending[0][0] > msg_date:
+                advanced = msg_date
+
+        if advanced and (self._watermark is None or advanced > self._watermark):
+            self._watermark = advanced
+            if self._on_watermark:
+                try:
+                    self._on_watermark(advanced)
+                except Exception as e:
+                    logging.error(f"Watermark callback failed: {e}")
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._fast.shutdown(wait=wait)
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,279 @@
+"""
+dispatcher_test.py — deterministic checks of SenderDispatcher.
+
+The watermark may only move past a message once it and every older one
+(merged and skipped ones included) have finished, and urgent messages
+(chat commands) may skip the queue but never run before, or alongside,
+their sender's lane work. Handlers here block until the test releases
+them, so completion order is fixed.
+
+  python dispatcher_test.py      (or: python -m pytest dispatcher_test.py)
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from dispatcher import SenderDispatcher
+
+T0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+WAIT = 5  # seconds; only reached if a check is about to fail
+
+
+def at(seconds: int) -> datetime:
+    return T0 + timedelta(seconds=seconds)
+
+
+@dataclass
+class Msg:
+    sid: str
+    from_: str
+    body: str = "hi"
+    to: str = "whatsapp:+10000000000"
+    date_sent: datetime = T0
+
+
+class Gate:
+    """A handler that blocks each message until release(sid)."""
+
+    def __init__(self):
+        self.started: dict[str, threading.Event] = {}
+        self.released: dict[str, threading.Event] = {}
+        self.calls: list = []
+        self.threads: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _events(self, sid: str) -> tuple[threading.Event, threading.Event]:
+        with self._lock:
+            return (self.started.setdefault(sid, threading.Event()),
+                    self.released.setdefault(sid, threading.Event()))
+
+    def __call__(self, msg_date, msg) -> None:
+        started, released = self._events(msg.sid)
+        with self._lock:
+            self.calls.append(msg)
+            self.threads[msg.sid] = threading.current_thread().name
+        started.set()
+        assert released.wait(WAIT), f"{msg.sid} never released"
+
+    def wait_started(self, sid: str) -> None:
+        assert self._events(sid)[0].wait(WAIT), f"{sid} never started"
+
+    def release(self, sid: str) -> None:
+        self._events(sid)[1].set()
+
+    def is_started(self, sid: str) -> bool:
+        return self._events(sid)[0].is_set()
+
+    def order(self) -> list[str]:
+        with self._lock:
+            return [m.sid for m in self.calls]
+
+
+class Watermarks:
+    """on_watermark callback that lets a test wait for a given value."""
+
+    def __init__(self):
+        self.seen: list[datetime] = []
+        self._cond = threading.Condition()
+
+    def __call__(self, dt: datetime) -> None:
+        with self._cond:
+            self.seen.append(dt)
+            self._cond.notify_all()
+
+    def wait_for(self, dt: datetime) -> None:
+        with self._cond:
+            assert self._cond.wait_for(lambda: dt in self.seen, WAIT), \
+                f"watermark never reached {dt}: {self.seen}"
+
+
+def make(gate: Gate, marks: Watermarks, **kwargs) -> SenderDispatcher:
+    return SenderDispatcher(gate, max_workers=4, on_watermark=marks, **kwargs)
+
+
+def test_out_of_order_finish_holds_the_watermark():
+    gate, marks = Gate(), Watermarks()
+    d = make(gate, marks)
+    try:
+        d.submit(at(1), Msg("a1", "alice"))
+        d.submit(at(2), Msg("b2", "bob"))
+        gate.wait_started("a1")
+        gate.wait_started("b2")
+
+        gate.release("b2")
+        d.submit(at(3), Msg("b3", "bob"))
+        gate.wait_started("b3")  # b2 has finished; a1 is still running
+        assert d.watermark is None
+
+        gate.release("a1")
+        marks.wait_for(at(2))  # a1 and b2 done, b3 still running
+        assert d.watermark == at(2)
+
+        gate.release("b3")
+        marks.wait_for(at(3))
+        assert marks.seen == sorted(marks.seen)
+    finally:
+        d.shutdown()
+
+
+def test_shared_timestamp_is_not_passed_until_all_finish():
+    gate, marks = Gate(), Watermarks()
+    d = make(gate, marks)
+    try:
+        d.submit(at(1), Msg("a1", "alice"))
+        d.submit(at(1), Msg("b1", "bob"))
+        gate.wait_started("a1")
+        gate.wait_started("b1")
+        gate.release("a1")
+        d.submit(at(2), Msg("a2", "alice"))
+        gate.wait_started("a2")
+        # Polls skip anything <= watermark, and b1 shares a1's timestamp.
+        assert d.watermark is None
+
+        gate.release("b1")
+        marks.wait_for(at(1))
+        assert d.watermark == at(1)
+        gate.release("a2")
+        marks.wait_for(at(2))
+    finally:
+        d.shutdown()
+
+
+def test_coalesced_and_skipped_messages_hold_the_watermark():
+    gate, marks = Gate(), Watermarks()
+    d = make(gate, marks, can_merge=lambda m: not m.body.startswith("--"))
+    try:
+        d.submit(at(1), Msg("a1", "alice"))
+        gate.wait_started("a1")
+        d.submit(at(2), Msg("a2", "alice", body="one"))
+        d.submit(at(3), Msg("a3", "alice", body="two"))
+        d.skip(at(4), Msg("shed4", "alice"))
+        assert d.pending_count() == 3
+
+        gate.release("a1")
+        marks.wait_for(at(1))
+        gate.wait_started("a3")  # a2 and a3 are handled as one, under a3's SID
+        merged = gate.calls[-1]
+        assert [p.sid for p in merged.parts] == ["a2", "a3"]
+        assert merged.body == "one\ntwo"
+        # The skipped message is done, but the merged ones before it are not.
+        assert d.watermark == at(1)
+        assert d.in_flight("a2") and d.in_flight("a3")
+
+        gate.release("a3")
+        marks.wait_for(at(4))
+        assert d.pending_count() == 0
+        assert not d.in_flight("a2")
+    finally:
+        d.shutdown()
+
+
+def test_skip_alone_advances_the_watermark():
+    gate, marks = Gate(), Watermarks()
+    d = make(gate, marks)
+    try:
+        d.skip(at(5), Msg("shed5", "alice"))
+        assert d.watermark == at(5)
+        assert marks.seen == [at(5)]
+    finally:
+        d.shutdown()
+
+
+def is_command(msg) -> bool:
+    return msg.body.startswith("--")
+
+
+def make_urgent(gate: Gate, marks: Watermarks, **kwargs) -> SenderDispatcher:
+    return make(gate, marks, is_urgent=is_command,
+                can_merge=lambda m: not is_command(m), **kwargs)
+
+
+def settle() -> None:
+    """Give a wrongly scheduled handler the chance to start."""
+    time.sleep(0.1)
+
+
+def test_command_with_an_idle_lane_takes_the_fast_lane_and_holds_later_messages():
+    gate, marks = Gate(), Watermarks()
+    d = make_urgent(gate, marks)
+    try:
+        d.submit(at(1), Msg("c1", "alice", body="--resume X"))
+        gate.wait_started("c1")
+        assert gate.threads["c1"].startswith("fast")
+
+        d.submit(at(2), Msg("a2", "alice"))
+        d.submit(at(2), Msg("b2", "bob"))
+        gate.wait_started("b2")  # other senders are not held
+        settle()
+        assert not gate.is_started("a2")  # would run in the old session
+
+        gate.release("c1")
+        gate.wait_started("a2")
+        gate.release("a2")
+        gate.release("b2")
+        marks.wait_for(at(2))
+    finally:
+        d.shutdown()
+
+
+def test_command_behind_lane_work_runs_next_and_alone():
+    gate, marks = Gate(), Watermarks()
+    d = make_urgent(gate, marks)
+    try:
+        d.submit(at(1), Msg("a1", "alice"))
+        gate.wait_started("a1")
+        d.submit(at(2), Msg("a2", "alice"))
+        d.submit(at(3), Msg("c3", "alice", body="--rename work"))
+        d.submit(at(4), Msg("c4", "alice", body="--id"))
+        settle()
+        # The first message's session is not saved yet: no command may run.
+        assert gate.order() == ["a1"]
+
+        # Bob's commands are not stuck behind Alice.
+        d.submit(at(5), Msg("c5", "bob", body="--id"))
+        gate.wait_started("c5")
+        gate.release("c5")
+
+        gate.release("a1")
+        gate.wait_started("c3")
+        settle()
+        assert gate.order() == ["a1", "c5", "c3"]
+        gate.release("c3")
+        gate.wait_started("c4")
+        gate.release("c4")
+        gate.wait_started("a2")
+        gate.release("a2")
+        marks.wait_for(at(5))
+        assert gate.order() == ["a1", "c5", "c3", "c4", "a2"]
+        assert not any(gate.threads[s].startswith("fast") for s in ("c3", "c4"))
+    finally:
+        d.shutdown()
+
+
+def test_command_does_not_wait_out_a_coalesce_window():
+    gate, marks = Gate(), Watermarks()
+    d = make_urgent(gate, marks, coalesce_window=60, max_coalesce_wait=60)
+    try:
+        d.submit(at(1), Msg("a1", "alice"))
+        settle()
+        assert not gate.is_started("a1")  # waiting for more to merge
+        d.submit(at(2), Msg("c2", "alice", body="--new"))
+        gate.wait_started("c2")
+        gate.release("c2")
+        settle()
+        assert gate.order() == ["c2"]  # a1 is back inside its window
+        assert d.in_flight("a1")
+    finally:
+        gate.release("a1")
+        d.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(f"ok  {name}")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+fake_opencode.py — a stand-in for the opencode CLI, for offline checks.
+
+  fake_opencode.py serve --hostname 127.0.0.1 --port N
+      An http.server with the endpoints ServerPoolBackend uses: GET /config,
+      POST /session, POST /session/<id>/message and POST /session/<id>/abort.
+  fake_opencode.py run <prompt> --model=... --variant=... [--session=...] --format=json
+      Prints `opencode run --format=json` NDJSON events.
+
+Replies say who answered and with what, e.g. "serve:41234 variant=medium
+session=ses_41234_1 hello", so a check can tell which worker (or the cold
+path) ran a prompt.
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def serve(host: str, port: int) -> None:
+    ids = itertools.count(1)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/config":
+                self._reply(200, {})
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            parts = self.path.strip("/").split("/")
+            if parts == ["session"]:
+                with lock:
+                    self._reply(200, {"id": f"ses_{port}_{next(ids)}"})
+            elif len(parts) == 3 and parts[0] == "session" and parts[2] == "message":
+                prompt = "".join(p.get("text", "") for p in body.get("parts", []))
+                text = (f"serve:{port} variant={body.get('variant')} "
+                        f"session={parts[1]} {prompt}")
+                self._reply(200, {"parts": [{"type": "text", "text": text}]})
+            elif len(parts) == 3 and parts[0] == "session" and parts[2] == "abort":
+                self._reply(200, True)
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+
+def run(prompt: str, variant: str, session: str) -> None:
+    session = session or "ses_cold_1"
+    text = f"run variant={variant} session={session} {prompt}"
+    for event in (
+        {"type": "step_start", "part": {}},
+        {"type": "text", "part": {"type": "text", "text": text}},
+        {"type": "step_finish", "part": {}},
+    ):
+        sys.stdout.write(json.dumps({**event, "sessionID": session}) + "\n")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Fake opencode CLI for offline checks.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    s = sub.add_parser("serve")
+    s.add_argument("--hostname", default="127.0.0.1")
+    s.add_argument("--port", type=int, required=True)
+    r = sub.add_parser("run")
+    r.add_argument("prompt")
+    r.add_argument("--model")
+    r.add_argument("--variant")
+    r.add_argument("--session")
+    r.add_argument("--format")
+    args = ap.parse_args()
+    if args.command == "serve":
+        serve(args.hostname, args.port)
+    else:
+        run(args.prompt, args.variant, args.session)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
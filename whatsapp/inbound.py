@@ -0,0 +1,132 @@
+"""
+inbound.py — inbound message cursor for the polling path.
+
+Each poll walks every page Twilio returns for the window (no fixed limit,
+so bursts and catch-up after downtime are not truncated) and drops
+messages that were already handled, by MessageSid. Handled SIDs live in a
+bounded LRU that is saved to disk, so webhook-delivered messages are not
+replayed by the poll after a restart either.
+
+Inside the window, messages are deduplicated by SID only, never by date:
+pushed messages carry our receive time, which can be later than the true
+DateSent of a message whose push was lost. The window starts at the
+watermark or at the start of the last successful poll, whichever is
+earlier, minus the overlap, so anything that reached Twilio since the last
+poll is looked at again.
+
+The poll interval adapts: it snaps to min_interval while conversations are
+active and doubles on every idle poll up to max_interval.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from state_store import atomic_write
+
+
+class SeenSids:
+    """Bounded, thread-safe LRU of handled MessageSids, persisted to `path`."""
+
+    def __init__(self, path: str, maxlen: int = 5000):
+        self.path = path
+        self.maxlen = maxlen
+        self._lock = threading.Lock()
+        self._sids: OrderedDict = OrderedDict()
+        self._dirty = False
+        try:
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    for line in f:
+                        if line.strip():
+                            self._sids[line.strip()] = None
+        except Exception as e:
+            logging.error(f"Error reading {path}: {e}")
+        while len(self._sids) > maxlen:
+            self._sids.popitem(last=False)
+
+    def __contains__(self, sid: str) -> bool:
+        with self._lock:
+            return sid in self._sids
+
+    def add(self, sid: str) -> None:
+        with self._lock:
+            self._sids[sid] = None
+            self._sids.move_to_end(sid)
+            if len(self._sids) > self.maxlen:
+                self._sids.popitem(last=False)
+            self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            data = "\n".join(self._sids) + "\n"
+            self._dirty = False
+        try:
+            atomic_write(self.path, data)
+        except Exception as e:
+            logging.error(f"Error saving {self.path}: {e}")
+
+
+class InboundCursor:
+    def __init__(
+        self,
+        client,
+        to: str,
+        seen: SeenSids,
+        overlap: float = 60,
+        min_interval: float = 2,
+        max_interval: float = 30,
+        page_size: int = 100,
+    ):
+        self.client = client
+        self.to = to
+        self.seen = seen
+        self.overlap = timedelta(seconds=overlap)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.page_size = page_size
+        self.interval = min_interval
+        self.last_poll: Optional[datetime] = None
+
+    def poll(self, watermark: datetime) -> list:
+        """
+        Inbound messages not handled yet, oldest first, as
+        [(msg_date, msg), ...]. The query reaches back `overlap` seconds
+        before the watermark (or the last poll, if earlier) to tolerate
+        clock skew, late indexing and lost pushes; the caller also skips
+        SIDs it has journaled or has in flight.
+        """
+        started = datetime.now(timezone.utc)
+        since = watermark if self.last_poll is None else min(watermark, self.last_poll)
+        new_messages = []
+        for msg in self.client.messages.stream(
+            date_sent_after=since - self.overlap,
+            to=self.to,
+            page_size=self.page_size,
+        ):
+            if msg.direction != 'inbound' or not msg.date_sent:
+                continue
+            msg_date = msg.date_sent.astimezone(timezone.utc)
+            if msg.sid in self.seen:
+                continue
+            new_messages.append((msg_date, msg))
+        self.last_poll = started
+
+        # Twilio returns newest first.
+        new_messages.reverse()
+        return new_messages
+
+    def next_interval(self, active: bool) -> float:
+        """Seconds until the next poll: fast while active, backing off when idle."""
+        if active:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return self.interval
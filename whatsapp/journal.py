@@ -0,0 +1,179 @@
+"""
+journal.py — durable inbound work journal, keyed by MessageSid.
+
+Every inbound message moves through these stages, and each move is made
+durable (appended and fsynced) before the agent goes on:
+
+  received        seen by the poll or webhook, before dispatch
+  dispatched      handed to a worker; the opencode call may be running
+  response_ready  the reply text (and new session ID) is stored
+  sent            Twilio accepted every chunk of the reply
+  done            finished without a model reply (command, shed, cancelled)
+
+On restart, journal_unfinished() lists what a crash interrupted: a message still
+at received/dispatched is handled again, while one at response_ready is
+re-sent from the stored text without calling the model a second time.
+The watermark and the seen-SID list then only decide what to poll for,
+not whether work was lost.
+
+The journal is an append-only JSONL file of {sid, stage, ...} records,
+replayed into memory on open. journal_prune() rewrites it (atomically)
+without finished entries older than the given age; the same happens, with
+the last age used, whenever the log has doubled since it was last
+rewritten (each message adds a few lines, so this is amortized).
+
+SqliteStore provides the same journal_* methods on a table, for the
+SQLite backend.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from state_store import atomic_write
+
+RECEIVED = "received"
+DISPATCHED = "dispatched"
+RESPONSE_READY = "response_ready"
+SENT = "sent"
+DONE = "done"
+
+# Stages only move forward; sent and done are both final.
+RANK = {RECEIVED: 0, DISPATCHED: 1, RESPONSE_READY: 2, SENT: 3, DONE: 3}
+FINISHED = (SENT, DONE)
+
+
+@dataclass
+class JournalMessage:
+    """An inbound message rebuilt from its journal entry after a restart."""
+    sid: str
+    from_: str
+    to: str
+    body: str
+    date_sent: datetime
+    direction: str = "inbound"
+
+    @classmethod
+    def from_entry(cls, entry: dict) -> "JournalMessage":
+        return cls(
+            sid=entry["sid"],
+            from_=entry.get("from"),
+            to=entry.get("to"),
+            body=entry.get("body") or "",
+            date_sent=datetime.fromisoformat(entry["date"]),
+        )
+
+
+def advance(entry: Optional[dict], sid: str, stage: str, fields: dict) -> Optional[dict]:
+    """
+    The entry after moving it to `stage` with `fields` merged in, or None
+    if it is already at or past that stage.
+    """
+    if entry is not None and RANK[entry["stage"]] >= RANK[stage]:
+        return None
+    entry = dict(entry or {"sid": sid})
+    entry.update(fields)
+    entry["stage"] = stage
+    entry["updated"] = time.time()
+    return entry
+
+
+class MessageJournal:
+    def __init__(self, path: str, retention: float = 86400, fsync: bool = True):
+        self.path = path
+        self.retention = retention
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict] = {}
+        self._lines = 0  # records in the file, live or superseded
+        if self._load():
+            self._compact()
+        self._base = self._lines  # lines right after the last rewrite
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self) -> bool:
+        """Replay the log into memory. True if it had a bad (e.g. torn) line."""
+        if not os.path.exists(self.path):
+            return False
+        bad = False
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-append.
+                    logging.warning(f"Skipping bad journal line: {line[:100]!r}")
+                    bad = True
+                    continue
+                self._entries.setdefault(record["sid"], {}).update(record)
+                self._lines += 1
+        return bad
+
+    def _compact(self) -> None:
+        """Rewrite the log with one line per live entry. Caller holds the lock."""
+        cutoff = time.time() - self.retention
+        self._entries = {
+            sid: e for sid, e in self._entries.items()
+            if e["stage"] not in FINISHED or e.get("updated", 0) >= cutoff
+        }
+        data = "".join(
+            json.dumps(e, ensure_ascii=True) + "\n" for e in self._entries.values()
+        )
+        atomic_write(self.path, data)
+        self._lines = self._base = len(self._entries)
+
+    # -- journal interface (shared with SqliteStore) -------------------------
+
+    def journal_record(self, sid: str, stage: str, **fields) -> bool:
+        """
+        Durably move sid to `stage`, merging `fields` into its entry.
+        False (and nothing written) if it was already at or past that stage.
+        """
+        with self._lock:
+            entry = advance(self._entries.get(sid), sid, stage, fields)
+            if entry is None:
+                return False
+            record = {"sid": sid, "stage": stage, "updated": entry["updated"], **fields}
+            self._file.write(json.dumps(record, ensure_ascii=True) + "\n")
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._entries[sid] = entry
+            self._lines += 1
+            if self._lines > max(1000, 2 * self._base):
+                self._file.close()
+                self._compact()
+                self._file = open(self.path, "a", encoding="utf-8")
+            return True
+
+    def journal_prune(self, older_than: float) -> int:
+        """Forget finished entries last updated more than older_than seconds ago."""
+        with self._lock:
+            before = len(self._entries)
+            self.retention = older_than
+            self._file.close()
+            self._compact()
+            self._file = open(self.path, "a", encoding="utf-8")
+            return before - len(self._entries)
+
+    def journal_get(self, sid: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(sid)
+            return dict(entry) if entry else None
+
+    def journal_unfinished(self) -> list[dict]:
+        """Entries not yet sent or done, oldest message first."""
+        with self._lock:
+            entries = [dict(e) for e in self._entries.values() if e["stage"] not in FINISHED]
+        return sorted(entries, key=lambda e: e.get("date") or "")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
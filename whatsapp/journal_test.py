@@ -0,0 +1,156 @@
+"""
+journal_test.py — deterministic checks of MessageJournal recovery and
+compaction.
+
+What a restart finds must be exactly what was recorded before it: stages
+only move forward, a torn last line (a crash mid-append) loses only that
+record, and compaction (on open, on prune, or when the log has grown)
+drops finished entries past retention but never unfinished ones.
+
+  python journal_test.py      (or: python -m pytest journal_test.py)
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import time
+
+from journal import (
+    DISPATCHED,
+    DONE,
+    RECEIVED,
+    RESPONSE_READY,
+    SENT,
+    JournalMessage,
+    MessageJournal,
+)
+
+
+def lines(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def receive(j, sid: str, date: str) -> None:
+    j.journal_record(sid, RECEIVED, date=date, body=f"body of {sid}",
+                     **{"from": "whatsapp:+1", "to": "whatsapp:+2"})
+
+
+def test_restart_recovers_unfinished_work_by_stage():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "journal.jsonl")
+        j = MessageJournal(path, fsync=False)
+        receive(j, "m3", "2026-01-01T00:00:03+00:00")
+        receive(j, "m1", "2026-01-01T00:00:01+00:00")
+        receive(j, "m2", "2026-01-01T00:00:02+00:00")
+        receive(j, "m4", "2026-01-01T00:00:04+00:00")
+        j.journal_record("m1", DISPATCHED)
+        j.journal_record("m2", DISPATCHED)
+        j.journal_record("m2", RESPONSE_READY, response="hi", session_id="ses_2")
+        j.journal_record("m4", DISPATCHED)
+        j.journal_record("m4", DONE)
+        # Stages only move forward; a late, lower record is refused.
+        assert not j.journal_record("m2", DISPATCHED)
+        assert not j.journal_record("m4", SENT)
+        j.close()
+
+        j = MessageJournal(path, fsync=False)
+        try:
+            unfinished = j.journal_unfinished()
+            assert [e["sid"] for e in unfinished] == ["m1", "m2", "m3"]
+            assert [e["stage"] for e in unfinished] == [DISPATCHED, RESPONSE_READY, RECEIVED]
+            m2 = j.journal_get("m2")
+            assert (m2["response"], m2["session_id"], m2["body"]) == ("hi", "ses_2", "body of m2")
+            assert j.journal_get("m4")["stage"] == DONE
+
+            msg = JournalMessage.from_entry(unfinished[0])
+            assert (msg.sid, msg.from_, msg.body) == ("m1", "whatsapp:+1", "body of m1")
+            assert msg.date_sent.isoformat() == "2026-01-01T00:00:01+00:00"
+        finally:
+            j.close()
+
+
+def test_torn_last_line_loses_only_that_record():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "journal.jsonl")
+        j = MessageJournal(path, fsync=False)
+        receive(j, "m1", "2026-01-01T00:00:01+00:00")
+        receive(j, "m2", "2026-01-01T00:00:02+00:00")
+        j.close()
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"sid": "m1", "stage": "dispat')  # crash mid-append
+
+        j = MessageJournal(path, fsync=False)
+        try:
+            assert j.journal_get("m1")["stage"] == RECEIVED
+            # The bad line was compacted away, so appends start on a clean line.
+            assert len(lines(path)) == 2
+            j.journal_record("m1", DISPATCHED)
+        finally:
+            j.close()
+        assert lines(path)[-1]["stage"] == DISPATCHED
+        j = MessageJournal(path, fsync=False)
+        try:
+            assert j.journal_get("m1")["stage"] == DISPATCHED
+        finally:
+            j.close()
+
+
+def test_prune_drops_only_old_finished_entries():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "journal.jsonl")
+        j = MessageJournal(path, fsync=False)
+        try:
+            for sid, final in (("old_sent", SENT), ("old_done", DONE),
+                               ("old_open", DISPATCHED), ("new_sent", SENT)):
+                receive(j, sid, "2026-01-01T00:00:00+00:00")
+                j.journal_record(sid, final)
+            # Age the "old_" entries by rewriting their last update time.
+            for sid in ("old_sent", "old_done", "old_open"):
+                j._entries[sid]["updated"] = time.time() - 3600
+
+            assert j.journal_prune(older_than=60) == 2
+            assert j.journal_get("old_sent") is None
+            assert j.journal_get("old_done") is None
+            assert j.journal_get("old_open")["stage"] == DISPATCHED  # never pruned
+            assert j.journal_get("new_sent")["stage"] == SENT
+            assert sorted(e["sid"] for e in lines(path)) == ["new_sent", "old_open"]
+        finally:
+            j.close()
+
+
+def test_log_is_compacted_once_it_outgrows_the_live_entries():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "journal.jsonl")
+        j = MessageJournal(path, retention=3600, fsync=False)
+        try:
+            for i in range(400):
+                sid = f"m{i}"
+                receive(j, sid, f"2026-01-01T00:{i // 60:02d}:{i % 60:02d}+00:00")
+                j.journal_record(sid, DISPATCHED)
+                j.journal_record(sid, RESPONSE_READY, response=f"r{i}")
+                if i % 2:
+                    j.journal_record(sid, SENT)
+            # 1400 records were written; the log holds far fewer lines.
+            assert len(lines(path)) < 1000
+        finally:
+            j.close()
+
+        j = MessageJournal(path, fsync=False)
+        try:
+            unfinished = j.journal_unfinished()
+            assert len(unfinished) == 200
+            assert all(e["stage"] == RESPONSE_READY for e in unfinished)
+            assert j.journal_get("m3")["stage"] == SENT
+            assert j.journal_get("m4")["response"] == "r4"
+        finally:
+            j.close()
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(f"ok  {name}")
@@ -0,0 +1,276 @@
+"""
+metrics.py — in-process counters, gauges and latency histograms.
+
+Module-level registry, so any part of the agent can record without passing
+objects around:
+
+  metrics.inc("agent_fallback_replies_total", reason="timeout")
+  with metrics.timer("agent_opencode_seconds"):
+      ...
+  metrics.gauge("agent_dispatch_pending", dispatcher.pending_count)
+
+render() produces Prometheus text format, serve() exposes it over HTTP on
+/metrics (stdlib only, so it works without Flask), and StatsDumper
+periodically writes a JSON snapshot (with bucket-interpolated p50/p90/p99)
+to a file.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+HELP = {
+    "agent_messages_total": "Inbound messages dispatched.",
+    "agent_poll_seconds": "Twilio inbound poll duration.",
+    "agent_dispatch_wait_seconds": "Time a message waited on its lane before handling.",
+    "agent_coalesced_messages_total": "Inbound messages merged into a combined prompt.",
+    "agent_handle_seconds": "Total time handling one message.",
+    "agent_opencode_seconds": "call_opencode_wrapper / streaming call duration.",
+    "agent_opencode_timeouts_total": "opencode calls that timed out.",
+    "agent_opencode_cancelled_total": "opencode calls abandoned by --new/--resume.",
+    "agent_shed_total": "Messages or calls refused by admission control.",
+    "agent_journal_recovered_total": "Journaled messages resumed after a restart, by stage.",
+    "agent_fallback_replies_total": "Fallback replies sent instead of a model answer.",
+    "agent_session_compactions_total": "Sessions rolled over to a summarized new session.",
+    "agent_twilio_send_seconds": "Twilio messages.create duration per chunk.",
+    "agent_twilio_retries_total": "Retried Twilio sends.",
+    "agent_state_load_seconds": "State load duration.",
+    "agent_state_save_seconds": "State save/flush duration.",
+    "agent_trail_append_seconds": "append_trail duration on the calling thread.",
+    "agent_trail_write_seconds": "Trail batch write duration (writer thread).",
+    "agent_trace_write_seconds": "Span batch write duration (trace writer thread).",
+    "agent_dispatch_pending": "Messages dispatched but not finished.",
+    "agent_outbound_pending": "Replies waiting in the outbound queue.",
+    "agent_cluster_pending": "Messages handed to instances and not yet finished (cluster-wide).",
+    "agent_opencode_running": "opencode calls holding an admission slot.",
+    "agent_opencode_waiting": "opencode calls waiting for an admission slot.",
+}
+
+_lock = threading.Lock()
+_counters: dict[tuple, float] = {}
+_histograms: dict[tuple, "_Histogram"] = {}
+_gauges: dict[tuple, Callable[[], float]] = {}
+
+
+class _Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by linear interpolation within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else lower
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = _Histogram()
+        h.observe(value)
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """Observe the wall time of the `with` block into histogram `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def gauge(name: str, fn: Callable[[], float], **labels) -> None:
+    """Register a gauge whose value is read from fn() at render time."""
+    with _lock:
+        _gauges[_key(name, labels)] = fn
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _gauges.clear()
+
+
+# ---------------------------------------------------------------------------
+# Export
+# ---------------------------------------------------------------------------
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def render() -> str:
+    """All metrics in Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        hists = {k: (list(h.counts), h.sum, h.count, h.buckets) for k, h in _histograms.items()}
+        gauges = dict(_gauges)
+
+    out: list[str] = []
+    typed: set[str] = set()
+
+    def header(name: str, kind: str) -> None:
+        if name not in typed:
+            typed.add(name)
+            if name in HELP:
+                out.append(f"# HELP {name} {HELP[name]}")
+            out.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        out.append(f"{name}{_fmt_labels(labels)} {value}")
+
+    for (name, labels), fn in sorted(gauges.items(), key=lambda kv: kv[0]):
+        try:
+            value = fn()
+        except Exception:
+            continue
+        header(name, "gauge")
+        out.append(f"{name}{_fmt_labels(labels)} {value}")
+
+    for (name, labels), (counts, total, count, buckets) in sorted(hists.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(list(buckets) + ["+Inf"], counts):
+            cumulative += n
+            out.append(
+                f"{name}_bucket{_fmt_labels(labels, (('le', bound),))} {cumulative}"
+            )
+        out.append(f"{name}_sum{_fmt_labels(labels)} {total}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {count}")
+
+    return "\n".join(out) + "\n"
+
+
+def snapshot() -> dict:
+    """JSON-friendly view: counters, gauges, and histogram count/mean/p50/p90/p99."""
+    with _lock:
+        data = {
+            "counters": {
+                name + _fmt_labels(labels): v
+                for (name, labels), v in sorted(_counters.items())
+            },
+            "histograms": {
+                name + _fmt_labels(labels): {
+                    "count": h.count,
+                    "mean": h.sum / h.count if h.count else None,
+                    "p50": h.quantile(0.5),
+                    "p90": h.quantile(0.9),
+                    "p99": h.quantile(0.99),
+                }
+                for (name, labels), h in sorted(_histograms.items())
+            },
+        }
+        gauges = dict(_gauges)
+    data["gauges"] = {}
+    for (name, labels), fn in gauges.items():
+        try:
+            data["gauges"][name + _fmt_labels(labels)] = fn()
+        except Exception:
+            pass
+    data["ts"] = time.time()
+    return data
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str = "127.0.0.1", port: int = 9108) -> ThreadingHTTPServer:
+    """Serve /metrics on a daemon thread; call .shutdown() on the result to stop."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    return server
+
+
+class StatsDumper:
+    """Write snapshot() as JSON to `path` every `interval` seconds."""
+
+    def __init__(self, path: str, interval: float = 60):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stats-dump", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def dump(self) -> None:
+        # Imported here: state_store itself imports this module.
+        from state_store import atomic_write
+        try:
+            atomic_write(self.path, json.dumps(snapshot(), indent=2))
+        except Exception as e:
+            logging.error(f"Error writing stats file: {e}")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.dump()
@@ -0,0 +1,411 @@
+"""
+opencode_backend.py — pluggable ways for the agent to run a prompt.
+
+  SubprocessBackend   one cold `opencode run --format=json` per prompt
+  ServerPoolBackend   a pool of long-lived `opencode serve` workers reached
+                      over HTTP; sessions stick to the worker that last
+                      served them so their history stays warm
+  FallbackBackend     try one backend, fall back to another when the first
+                      is unavailable
+
+Every backend implements run(prompt, session_id, timeout, cancel) ->
+(text, session_id). Passing a CancelToken lets another thread abandon the
+run: the subprocess is killed (or the server session aborted) and run()
+raises Cancelled.
+The server command is a template, so tests can point the pool at a small
+fake HTTP server instead of opencode.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+import runopencode
+import tracing
+
+DEFAULT_SERVE_COMMAND = [
+    "{opencode}", "serve", "--hostname", "127.0.0.1", "--port", "{port}",
+]
+
+
+class OpencodeError(Exception):
+    """opencode ran but did not produce a usable answer."""
+
+
+class BackendTimeout(OpencodeError):
+    """The prompt did not finish within its timeout."""
+
+
+class BackendUnavailable(OpencodeError):
+    """The backend could not take the request at all (safe to retry elsewhere)."""
+
+
+class Cancelled(OpencodeError):
+    """The run was abandoned through its CancelToken."""
+
+
+class CancelToken:
+    """
+    Shared between a run and whoever may abandon it. Backends register how
+    to stop their work with on_cancel(); cancel() calls those callbacks (at
+    most once each), including ones registered after the fact.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks: list[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def on_cancel(self, fn: Callable[[], None]) -> None:
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(fn)
+                return
+        self._call(fn)
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._call(fn)
+
+    @staticmethod
+    def _call(fn: Callable[[], None]) -> None:
+        try:
+            fn()
+        except Exception as e:
+            logging.warning(f"Cancel callback failed: {e}")
+
+
+class OpencodeBackend(ABC):
+    @abstractmethod
+    def run(
+        self,
+        prompt: str,
+        session_id: Optional[str] = None,
+        timeout: float = 120,
+        cancel: Optional[CancelToken] = None,
+    ) -> tuple[str, Optional[str]]:
+        """Send prompt (continuing session_id if given); return (text, session_id)."""
+
+    def close(self) -> None:
+        pass
+
+
+class SubprocessBackend(OpencodeBackend):
+    def __init__(self, opencode: str, model: str, variant: str):
+        self.opencode = opencode
+        self.model = model
+        self.variant = variant
+
+    def run(self, prompt, session_id=None, timeout=120, cancel=None):
+        if cancel and cancel.cancelled:
+            raise Cancelled("cancelled before start")
+        # Spawn (fork/exec up to Popen returning) and the run itself are
+        # traced separately, from the on_start callback.
+        started = [time.time_ns(), None]
+
+        def on_start(proc):
+            started[1] = time.time_ns()
+            tracing.record("opencode.spawn", started[0], started[1], pid=proc.pid)
+            if cancel:
+                cancel.on_cancel(proc.kill)
+
+        try:
+            result = runopencode.run_opencode(
+                prompt,
+                model=self.model,
+                variant=self.variant,
+                session=session_id,
+                fmt="json",
+                opencode=self.opencode,
+                timeout=timeout,
+                on_start=on_start,
+            )
+        except subprocess.TimeoutExpired as e:
+            if started[1]:
+                tracing.record("opencode.run", started[1], time.time_ns(), error="timeout")
+            raise BackendTimeout("opencode timed out") from e
+        if started[1]:
+            tracing.record(
+                "opencode.run", started[1], time.time_ns(),
+                exit_code=result.returncode, stdout_len=len(result.stdout),
+            )
+
+        if cancel and cancel.cancelled:
+            raise Cancelled("opencode run was cancelled")
+        if result.returncode != 0:
+            raise OpencodeError(
+                f"exit code {result.returncode}: {result.stderr[:300]}"
+            )
+        with tracing.span("opencode.parse"):
+            return runopencode.parse_json_events(result.stdout)
+
+
+# ---------------------------------------------------------------------------
+# opencode serve pool
+# ---------------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerWorker:
+    """One `opencode serve` process and its HTTP endpoint."""
+
+    def __init__(self, name: str, command: list[str], opencode: str):
+        self.name = name
+        self.command = command
+        self.opencode = opencode
+        self.proc: Optional[subprocess.Popen] = None
+        self.port = 0
+        self.inflight = 0
+        self.served = 0
+        self.restarting = False  # out of rotation while the pool restarts it
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, startup_timeout: float = 30) -> None:
+        self.port = _free_port()
+        argv = [
+            a.format(port=self.port, opencode=self.opencode) for a in self.command
+        ]
+        self.proc = subprocess.Popen(
+            argv,
+            env=runopencode.build_env(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.served = 0
+        deadline = time.time() + startup_timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise BackendUnavailable(f"{self.name} exited during startup")
+            if self.healthy():
+                logging.info(f"opencode worker {self.name} ready on port {self.port}")
+                return
+            time.sleep(0.2)
+        self.stop()
+        raise BackendUnavailable(f"{self.name} not ready after {startup_timeout}s")
+
+    def stop(self) -> None:
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def healthy(self) -> bool:
+        if not self.alive():
+            return False
+        try:
+            with urllib.request.urlopen(f"{self.base_url}/config", timeout=2) as r:
+                return r.status == 200
+        except (OSError, urllib.error.URLError):
+            return False
+
+    def request(self, method: str, path: str, body: Optional[dict], timeout: float):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(
+            f"{self.base_url}{path}",
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as r:
+                return json.loads(r.read() or b"null")
+        except socket.timeout as e:
+            raise BackendTimeout(f"{self.name} timed out") from e
+        except urllib.error.HTTPError as e:
+            raise OpencodeError(f"{self.name} HTTP {e.code}: {e.read()[:300]!r}") from e
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, socket.timeout):
+                raise BackendTimeout(f"{self.name} timed out") from e
+            raise BackendUnavailable(f"{self.name} unreachable: {e.reason}") from e
+
+
+class ServerPoolBackend(OpencodeBackend):
+    """
+    Keeps `size` opencode servers running. A session is routed to the worker
+    that created or last served it; new sessions go to the least-busy
+    worker. A background thread restarts workers that die or fail their
+    health check, and workers are recycled after max_requests prompts.
+    """
+
+    def __init__(
+        self,
+        opencode: str,
+        model: str,
+        size: int = 2,
+        variant: Optional[str] = None,
+        command: Optional[list[str]] = None,
+        max_requests: int = 500,
+        health_interval: float = 30,
+    ):
+        provider, _, model_id = model.partition("/")
+        self.model = {"providerID": provider, "modelID": model_id}
+        # Sent with each prompt, like `opencode run --variant`, so both
+        # backends answer with the same reasoning effort.
+        self.variant = variant
+        self.max_requests = max_requests
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._affinity: dict[str, ServerWorker] = {}
+        self._workers = [
+            ServerWorker(f"opencode-{i}", command or DEFAULT_SERVE_COMMAND, opencode)
+            for i in range(size)
+        ]
+        for w in self._workers:
+            try:
+                w.start()
+            except BackendUnavailable as e:
+                logging.error(f"opencode worker failed to start: {e}")
+        self._closed = threading.Event()
+        self._monitor = threading.Thread(
+            target=self._health_loop, name="opencode-health", daemon=True
+        )
+        self._monitor.start()
+
+    def _pick(self, session_id: Optional[str]) -> ServerWorker:
+        with self._lock:
+            w = self._affinity.get(session_id) if session_id else None
+            if w is None or w.restarting or not w.alive():
+                live = [w for w in self._workers if not w.restarting and w.alive()]
+                if not live:
+                    raise BackendUnavailable("no live opencode workers")
+                w = min(live, key=lambda w: w.inflight)
+            w.inflight += 1
+            return w
+
+    def _release(self, w: ServerWorker, session_id: Optional[str]) -> None:
+        with self._lock:
+            w.inflight -= 1
+            w.served += 1
+            if session_id:
+                self._affinity[session_id] = w
+
+    def run(self, prompt, session_id=None, timeout=120, cancel=None):
+        if cancel and cancel.cancelled:
+            raise Cancelled("cancelled before start")
+        w = self._pick(session_id)
+        out_session = session_id
+        try:
+            if not out_session:
+                with tracing.span("opencode.session_create", worker=w.name):
+                    created = w.request("POST", "/session", {}, timeout=10)
+                out_session = created["id"]
+            if cancel:
+                # Ask the worker to stop generating; the pending message
+                # request then returns early.
+                sid = out_session
+                cancel.on_cancel(
+                    lambda: w.request("POST", f"/session/{sid}/abort", {}, timeout=5)
+                )
+            body = {"model": self.model, "parts": [{"type": "text", "text": prompt}]}
+            if self.variant:
+                body["variant"] = self.variant
+            with tracing.span("opencode.message", worker=w.name, session=out_session):
+                reply = w.request(
+                    "POST", f"/session/{out_session}/message", body, timeout=timeout,
+                )
+        except OpencodeError:
+            if cancel and cancel.cancelled:
+                raise Cancelled("opencode run was cancelled") from None
+            raise
+        finally:
+            self._release(w, out_session)
+
+        if cancel and cancel.cancelled:
+            raise Cancelled("opencode run was cancelled")
+        texts = [
+            p.get("text", "")
+            for p in (reply or {}).get("parts", [])
+            if p.get("type") == "text"
+        ]
+        return "".join(texts).strip(), out_session
+
+    def _health_loop(self) -> None:
+        while not self._closed.wait(self.health_interval):
+            for w in self._workers:
+                with self._lock:
+                    busy = w.inflight > 0
+                    worn = w.served >= self.max_requests
+                if busy:
+                    continue
+                if worn or not w.healthy():
+                    # Take it out of rotation under the lock, so _pick()
+                    # cannot hand it to a request that the restart kills.
+                    with self._lock:
+                        if w.inflight > 0:
+                            continue
+                        w.restarting = True
+                    reason = "recycling" if worn else "unhealthy, restarting"
+                    logging.warning(f"opencode worker {w.name} {reason}")
+                    try:
+                        self._restart(w)
+                    finally:
+                        with self._lock:
+                            w.restarting = False
+
+    def _restart(self, w: ServerWorker) -> None:
+        with self._lock:
+            # Drop affinity so sessions re-home; storage is shared on disk.
+            for sid in [s for s, owner in self._affinity.items() if owner is w]:
+                del self._affinity[sid]
+        w.stop()
+        try:
+            w.start()
+        except BackendUnavailable as e:
+            logging.error(f"opencode worker restart failed: {e}")
+
+    def close(self) -> None:
+        self._closed.set()
+        for w in self._workers:
+            w.stop()
+
+
+class FallbackBackend(OpencodeBackend):
+    """Use primary; on BackendUnavailable, run the same prompt on fallback."""
+
+    def __init__(self, primary: OpencodeBackend, fallback: OpencodeBackend):
+        self.primary = primary
+        self.fallback = fallback
+
+    def run(self, prompt, session_id=None, timeout=120, cancel=None):
+        try:
+            return self.primary.run(prompt, session_id, timeout, cancel)
+        except BackendUnavailable as e:
+            logging.warning(f"Primary opencode backend unavailable ({e}); falling back")
+            return self.fallback.run(prompt, session_id, timeout, cancel)
+
+    def close(self) -> None:
+        self.primary.close()
+        self.fallback.close()
@@ -0,0 +1,141 @@
+"""
+opencode_backend_test.py — ServerPoolBackend / FallbackBackend against
+fake_opencode.py, a small http.server standing in for `opencode serve`.
+
+Checks session affinity, that a worker being restarted by the health loop
+gets no requests, and that FallbackBackend runs the prompt on the cold
+SubprocessBackend when no server can take it.
+
+  python opencode_backend_test.py      (or: python -m pytest opencode_backend_test.py)
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opencode_backend import (  # noqa: E402
+    FallbackBackend,
+    ServerPoolBackend,
+    SubprocessBackend,
+    _free_port,
+)
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_opencode.py")
+COMMAND = [sys.executable, FAKE, "serve", "--hostname", "127.0.0.1", "--port", "{port}"]
+MODEL = "openai/gpt-5.2"
+WAIT = 10  # seconds; only reached if a check is about to fail
+
+
+def make_pool(size: int = 2, **kwargs) -> ServerPoolBackend:
+    kwargs.setdefault("health_interval", 3600)
+    pool = ServerPoolBackend(FAKE, MODEL, size=size, variant="medium",
+                             command=COMMAND, **kwargs)
+    assert all(w.alive() for w in pool._workers)
+    return pool
+
+
+def served_by(text: str) -> int:
+    """The port of the fake server that answered, or 0 for the cold path."""
+    m = re.match(r"serve:(\d+) ", text)
+    return int(m.group(1)) if m else 0
+
+
+def wait_until(check, what: str) -> None:
+    deadline = time.time() + WAIT
+    while not check():
+        assert time.time() < deadline, f"timed out waiting for {what}"
+        time.sleep(0.02)
+
+
+def test_sessions_stick_to_their_worker():
+    pool = make_pool()
+    try:
+        text, session = pool.run("hello")
+        assert "variant=medium" in text and text.endswith(" hello")
+        home = served_by(text)
+        # Make the home worker the busier one, so least-busy would pick the other.
+        other = next(w for w in pool._workers if w.port != home)
+        with pool._lock:
+            next(w for w in pool._workers if w.port == home).inflight += 1
+        try:
+            for _ in range(3):
+                text, again = pool.run("more", session)
+                assert (served_by(text), again) == (home, session)
+            text, _ = pool.run("new")
+            assert served_by(text) == other.port
+        finally:
+            with pool._lock:
+                next(w for w in pool._workers if w.port == home).inflight -= 1
+    finally:
+        pool.close()
+
+
+def test_worker_being_restarted_gets_no_requests():
+    pool = make_pool(health_interval=0.05)
+    entered, proceed = threading.Event(), threading.Event()
+    restart = pool._restart
+
+    def held_restart(w):
+        entered.set()
+        assert proceed.wait(WAIT)
+        restart(w)
+
+    pool._restart = held_restart
+    try:
+        first, second = pool._workers
+        text, session = pool.run("hello")
+        assert served_by(text) == first.port  # both idle: the first one wins
+        with pool._lock:
+            first.served = pool.max_requests  # due for recycling
+        assert entered.wait(WAIT)
+        assert first.restarting and first.alive()
+
+        for _ in range(3):
+            assert served_by(pool.run("during", session)[0]) == second.port
+            assert served_by(pool.run("during")[0]) == second.port
+
+        old_port = first.port
+        proceed.set()
+        wait_until(lambda: not first.restarting, "the restart to finish")
+        assert first.alive() and first.port != old_port
+        assert served_by(pool.run("after")[0]) == first.port
+    finally:
+        proceed.set()
+        pool.close()
+
+
+def test_falls_back_to_subprocess_when_servers_are_gone():
+    pool = make_pool(size=1)
+    backend = FallbackBackend(pool, SubprocessBackend(FAKE, MODEL, "medium"))
+    try:
+        text, _ = backend.run("warm")
+        assert served_by(text) == pool._workers[0].port
+
+        # Alive but unreachable: the request fails, the cold path answers.
+        port = pool._workers[0].port
+        pool._workers[0].port = _free_port()
+        text, session = backend.run("unreachable", "ses_x")
+        assert text == "run variant=medium session=ses_x unreachable"
+        pool._workers[0].port = port
+
+        # Dead: no live worker at all.
+        pool._workers[0].proc.kill()
+        pool._workers[0].proc.wait()
+        text, session = backend.run("dead")
+        assert served_by(text) == 0 and text.endswith(" dead")
+        assert session == "ses_cold_1"
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(f"ok  {name}")
@@ -0,0 +1,174 @@
+"""
+outbound.py — rate-limited, retrying outbound WhatsApp sender.
+
+One shared Twilio client (so HTTP connections are reused) and one sender
+thread draining a FIFO queue. send() returns immediately; chunks go out in
+the order they were queued, paced by a token bucket sized to the sending
+number's limit, and 429/5xx responses are retried with exponential backoff.
+Urgent replies (short command acknowledgements) jump ahead of queued ones.
+"""
+
+from __future__ import annotations
+
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional
+
+from twilio.base.exceptions import TwilioRestException
+from twilio.rest import Client
+
+import metrics
+import tracing
+
+MAX_CHUNK = 1500
+_URGENT, _NORMAL, _STOP = 0, 1, 2   # queue priorities
+
+
+def chunk_message(body: str, max_len: int = MAX_CHUNK) -> list[str]:
+    """Split a reply into WhatsApp-sized chunks."""
+    return [body[i:i + max_len] for i in range(0, len(body), max_len)]
+
+
+class TokenBucket:
+    """
+    Allow `rate` events/second on average, bursting up to `capacity`.
+    A rate of 0 (or less) means unlimited.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def acquire(self) -> None:
+        """Block until a token is available."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class OutboundSender:
+    def __init__(
+        self,
+        account_sid: str,
+        auth_token: str,
+        from_: str,
+        rate: float = 1 / 3,
+        burst: float = 1,
+        max_retries: int = 5,
+    ):
+        self.from_ = from_
+        self.max_retries = max_retries
+        self.client = Client(account_sid, auth_token)
+        self.bucket = TokenBucket(rate, burst)
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._thread = threading.Thread(
+            target=self._run, name="outbound", daemon=True
+        )
+        self._thread.start()
+
+    def send(self, to: str, body: str, urgent: bool = False) -> Future:
+        """
+        Queue a reply (split into chunks) for delivery. The returned future
+        resolves to the list of message SIDs, or to the error that stopped
+        delivery. An urgent reply goes out before any non-urgent one that
+        is still queued.
+        """
+        future: Future = Future()
+        priority = _URGENT if urgent else _NORMAL
+        # Delivery spans join the caller's trace, from the sender thread.
+        item = (to, chunk_message(body), future, tracing.current(), time.time_ns())
+        self._queue.put((priority, next(self._seq), item))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self, timeout: float = 30) -> None:
+        """Deliver what is already queued (up to `timeout`), then stop."""
+        self._queue.put((_STOP, next(self._seq), None))
+        self._thread.join(timeout=timeout)
+
+    # -- sender thread ------------------------------------------------------
+
+    def _run(self) -> None:
+        while True:
+            priority, _, item = self._queue.get()
+            if priority == _STOP:
+                return
+            to, chunks, future, parent, queued_ns = item
+            sids = []
+            with tracing.attach(parent):
+                tracing.record("outbound.queue", queued_ns, time.time_ns(),
+                               urgent=priority == _URGENT)
+                try:
+                    for i, chunk in enumerate(chunks):
+                        with tracing.span("send_whatsapp", chunk=i, chunks=len(chunks),
+                                          length=len(chunk)):
+                            sids.append(self._send_chunk(to, chunk))
+                    future.set_result(sids)
+                except Exception as e:
+                    logging.error(f"Failed to send WhatsApp to {to}: {e}")
+                    future.set_exception(e)
+
+    def _send_chunk(self, to: str, chunk: str) -> str:
+        delay = 1.0
+        for attempt in range(1, self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                with metrics.timer("agent_twilio_send_seconds"):
+                    message = self.client.messages.create(
+                        from_=self.from_, body=chunk, to=to
+                    )
+                logging.info(f"Sent message {message.sid} to {to}")
+                span = tracing.current()
+                if span:
+                    span.set(message_sid=message.sid, attempts=attempt)
+                return message.sid
+            except TwilioRestException as e:
+                if not _retryable(e.status) or attempt == self.max_retries:
+                    raise
+                logging.warning(
+                    f"Twilio {e.status} sending to {to}; retry {attempt} in {delay:.0f}s"
+                )
+            except OSError as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Network error sending to {to}: {e}; retry in {delay:.0f}s")
+            metrics.inc("agent_twilio_retries_total")
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+        raise RuntimeError("unreachable")
+
+
+def _retryable(status: Optional[int]) -> bool:
+    return status == 429 or (status is not None and status >= 500)
@@ -0,0 +1,175 @@
+"""
+profiling.py — opt-in, sampled CPU and memory profiling for production.
+
+  profiler = Profiler("profiles", cpu=True, memory=True, interval=300)
+  profiler.start()
+  ...
+  with profiler.profile():     # a main-loop pass, or one message
+      ...
+
+CPU: profile() runs a `sample` fraction of the blocks it wraps under
+cProfile and adds them to one running pstats.Stats. Only one block is
+profiled at a time (cProfile cannot profile two at once on Python 3.12+);
+a block that comes up while another is being profiled just runs.
+
+Memory: tracemalloc traces every allocation from start(), which costs
+noticeably more than the CPU sampling, so it is enabled separately.
+
+Every `interval` seconds (and on stop) a background thread writes what
+was collected into `directory`:
+
+  cpu-<stamp>.pstats   the stats since the last dump (python -m pstats, snakeviz)
+  cpu-<stamp>.txt      top functions by cumulative time
+  mem-<stamp>.txt      top allocation sites, and growth since the last dump
+
+Only the newest `keep` dumps of each kind are kept.
+"""
+
+from __future__ import annotations
+
+import cProfile
+import glob
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+TOP_N = 40
+MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, pstats.__file__),  # our own CPU stats
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+class Profiler:
+    def __init__(
+        self,
+        directory: str,
+        cpu: bool = True,
+        memory: bool = False,
+        interval: float = 300,
+        sample: float = 0.1,
+        keep: int = 48,
+        frames: int = 10,
+    ):
+        self.directory = directory
+        self.cpu = cpu
+        self.memory = memory
+        self.interval = interval
+        self.sample = sample
+        self.keep = keep
+        self.frames = frames
+        self._busy = threading.Lock()   # the one block being profiled
+        self._lock = threading.Lock()   # guards _stats / _profiled
+        self._stats: Optional[pstats.Stats] = None
+        self._profiled = 0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="profiler", daemon=True
+        )
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the dump thread and write what was collected since the last dump."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+        self.dump()
+        if self.memory:
+            tracemalloc.stop()
+
+    @contextmanager
+    def profile(self):
+        """Profile the `with` block, if it is sampled and nothing else is profiled."""
+        if (not self.cpu or random.random() >= self.sample
+                or not self._busy.acquire(blocking=False)):
+            yield
+            return
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+            try:
+                yield
+            finally:
+                prof.disable()
+        finally:
+            self._busy.release()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(prof)
+            else:
+                self._stats.add(prof)
+            self._profiled += 1
+
+    # -- dumps ----------------------------------------------------------------
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def dump(self) -> None:
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        try:
+            if self.cpu:
+                self._dump_cpu(stamp)
+            if self.memory and tracemalloc.is_tracing():
+                self._dump_memory(stamp)
+            self._prune()
+        except Exception as e:
+            logging.error(f"Profile dump failed: {e}")
+
+    def _dump_cpu(self, stamp: str) -> None:
+        with self._lock:
+            stats, self._stats = self._stats, None
+            profiled, self._profiled = self._profiled, 0
+        if stats is None:
+            return
+        path = os.path.join(self.directory, f"cpu-{stamp}.pstats")
+        stats.dump_stats(path)
+        out = io.StringIO()
+        out.write(f"{profiled} profiled blocks\n")
+        pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(TOP_N)
+        with open(os.path.join(self.directory, f"cpu-{stamp}.txt"), "w") as f:
+            f.write(out.getvalue())
+        logging.info(f"CPU profile of {profiled} blocks written to {path}")
+
+    def _dump_memory(self, stamp: str) -> None:
+        snapshot = tracemalloc.take_snapshot().filter_traces(MEMORY_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced: {current / 1e6:.1f} MB now, {peak / 1e6:.1f} MB peak", ""]
+        lines.append(f"Top {TOP_N} allocation sites:")
+        lines.extend(str(s) for s in snapshot.statistics("lineno")[:TOP_N])
+        if self._snapshot is not None:
+            lines += ["", f"Top {TOP_N} changes since the last dump:"]
+            lines.extend(
+                str(s) for s in snapshot.compare_to(self._snapshot, "lineno")[:TOP_N]
+            )
+        self._snapshot = snapshot
+        path = os.path.join(self.directory, f"mem-{stamp}.txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        logging.info(f"Memory profile written to {path}")
+
+    def _prune(self) -> None:
+        if self.keep <= 0:
+            return
+        for pattern in ("cpu-*.pstats", "cpu-*.txt", "mem-*.txt"):
+            for old in sorted(glob.glob(os.path.join(self.directory, pattern)))[:-self.keep]:
+                try:
+                    os.unlink(old)
+                except OSError as e:
+                    logging.error(f"Could not remove {old}: {e}")
@@ -0,0 +1,245 @@
+"""
+session_catalog.py — indexed catalog of opencode's stored sessions.
+
+opencode keeps one file per session at
+~/.local/share/opencode/storage/session/<project>/<session_id>.json. Rather
+than globbing that tree on every lookup, the catalog keeps an in-memory
+index of session ID -> (path, mtime, size), persisted to a small JSON file
+so restarts don't rescan everything.
+
+Refreshing is incremental: only project directories whose mtime changed
+since the last scan are re-listed (adding, removing or renaming a session
+file bumps its directory's mtime), so a refresh costs one stat per project,
+not one per session. Lookups are a dict hit, with a single stat to confirm
+the file is still there.
+
+  python session_catalog.py            # list sessions, newest first
+  python session_catalog.py --prune    # drop entries whose files are gone
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from state_store import atomic_write
+
+DEFAULT_ROOT = os.path.expanduser("~/.local/share/opencode/storage/session")
+
+
+@dataclass
+class SessionInfo:
+    session_id: str
+    path: str
+    mtime: float
+    size: int
+
+    def title(self) -> Optional[str]:
+        """The session title from opencode's file, if it has one."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f).get("title")
+        except (OSError, json.JSONDecodeError, AttributeError):
+            return None
+
+
+class SessionCatalog:
+    def __init__(
+        self,
+        root: str = DEFAULT_ROOT,
+        index_path: Optional[str] = None,
+        min_refresh_interval: float = 2.0,
+    ):
+        self.root = root
+        self.index_path = index_path
+        self.min_refresh_interval = min_refresh_interval
+        self._lock = threading.Lock()
+        self._sessions: dict[str, SessionInfo] = {}
+        self._by_dir: dict[str, set[str]] = {}
+        self._dir_mtimes: dict[str, float] = {}
+        self._last_refresh = 0.0
+        self._load_index()
+        self.refresh(force=True)
+
+    # -- persistence --------------------------------------------------------
+
+    def _load_index(self) -> None:
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("root") != self.root:
+                return
+            self._dir_mtimes = data.get("dirs", {})
+            for sid, entry in data.get("sessions", {}).items():
+                info = SessionInfo(sid, *entry)
+                self._sessions[sid] = info
+                self._by_dir.setdefault(os.path.dirname(info.path), set()).add(sid)
+        except Exception as e:
+            logging.error(f"Error reading session catalog {self.index_path}: {e}")
+            self._sessions, self._by_dir, self._dir_mtimes = {}, {}, {}
+
+    def _save_index(self) -> None:
+        """Caller holds the lock."""
+        if not self.index_path:
+            return
+        data = {
+            "root": self.root,
+            "dirs": self._dir_mtimes,
+            "sessions": {
+                sid: [info.path, info.mtime, info.size]
+                for sid, info in self._sessions.items()
+            },
+        }
+        try:
+            atomic_write(self.index_path, json.dumps(data, separators=(",", ":")))
+        except Exception as e:
+            logging.error(f"Error saving session catalog: {e}")
+
+    # -- indexing -----------------------------------------------------------
+
+    def refresh(self, force: bool = False) -> int:
+        """
+        Re-list project directories that changed since the last scan.
+        Unless forced, does nothing if the last refresh was under
+        min_refresh_interval seconds ago. Returns the number of
+        directories rescanned.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_refresh < self.min_refresh_interval:
+                return 0
+            self._last_refresh = now
+
+            try:
+                projects = {
+                    e.path: e.stat().st_mtime
+                    for e in os.scandir(self.root) if e.is_dir()
+                }
+            except FileNotFoundError:
+                projects = {}
+            except OSError as e:
+                logging.error(f"Cannot list {self.root}: {e}")
+                return 0
+
+            changed = [d for d, m in projects.items() if self._dir_mtimes.get(d) != m]
+            removed = [d for d in self._dir_mtimes if d not in projects]
+            for d in changed + removed:
+                self._rescan_dir(d, projects.get(d))
+            if changed or removed:
+                self._save_index()
+            return len(changed) + len(removed)
+
+    def _rescan_dir(self, directory: str, mtime: Optional[float]) -> None:
+        """Replace the index entries for one project dir. Caller holds the lock."""
+        for sid in self._by_dir.pop(directory, ()):
+            self._sessions.pop(sid, None)
+        if mtime is None:
+            self._dir_mtimes.pop(directory, None)
+            return
+        sids = self._by_dir[directory] = set()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    st = entry.stat()
+                    sid = entry.name[:-len(".json")]
+                    self._sessions[sid] = SessionInfo(sid, entry.path, st.st_mtime, st.st_size)
+                    sids.add(sid)
+        except OSError as e:
+            logging.error(f"Cannot list {directory}: {e}")
+            return
+        self._dir_mtimes[directory] = mtime
+
+    def _forget(self, session_id: str) -> None:
+        """Caller holds the lock."""
+        info = self._sessions.pop(session_id, None)
+        if info is not None:
+            self._by_dir.get(os.path.dirname(info.path), set()).discard(session_id)
+
+    # -- lookups ------------------------------------------------------------
+
+    def get(self, session_id: str) -> Optional[SessionInfo]:
+        """Catalog entry for session_id, refreshing once if it is not known yet."""
+        with self._lock:
+            info = self._sessions.get(session_id)
+        if info is None:
+            # Possibly created since the last scan.
+            self.refresh(force=True)
+            with self._lock:
+                info = self._sessions.get(session_id)
+        if info is not None and not os.path.exists(info.path):
+            with self._lock:
+                self._forget(session_id)
+            return None
+        return info
+
+    def exists(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def list(self, limit: Optional[int] = None) -> list[SessionInfo]:
+        """Sessions newest first, with sizes and mtimes re-read from disk."""
+        self.refresh()
+        with self._lock:
+            infos = list(self._sessions.values())
+        fresh = []
+        for info in infos:
+            try:
+                st = os.stat(info.path)
+            except OSError:
+                continue
+            fresh.append(SessionInfo(info.session_id, info.path, st.st_mtime, st.st_size))
+        fresh.sort(key=lambda i: i.mtime, reverse=True)
+        return fresh[:limit] if limit else fresh
+
+    def prune(self) -> int:
+        """Drop entries whose session files no longer exist. Returns how many."""
+        self.refresh(force=True)
+        with self._lock:
+            stale = [s for s, i in self._sessions.items() if not os.path.exists(i.path)]
+            for sid in stale:
+                self._forget(sid)
+            if stale:
+                self._save_index()
+        return len(stale)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="List or prune opencode's stored sessions.")
+    ap.add_argument("--root", default=DEFAULT_ROOT)
+    ap.add_argument("--index", default="session_catalog.json",
+                    help="Persisted index file (default: session_catalog.json)")
+    ap.add_argument("--limit", type=int, default=20)
+    ap.add_argument("--prune", action="store_true", help="Drop entries whose files are gone")
+    ap.add_argument("--json", action="store_true", help="Print entries as JSON lines")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    catalog = SessionCatalog(args.root, index_path=args.index)
+    if args.prune:
+        print(f"Pruned {catalog.prune()} stale entries; {len(catalog)} sessions indexed.")
+        return 0
+
+    for info in catalog.list(args.limit):
+        if args.json:
+            print(json.dumps({**asdict(info), "title": info.title()}))
+            continue
+        updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(info.mtime))
+        print(f"{info.session_id}  {updated}  {info.size:>8}  {info.title() or ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
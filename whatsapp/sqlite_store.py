@@ -0,0 +1,427 @@
+"""
+sqlite_store.py — optional SQLite (WAL) storage backend for the agent.
+
+Drop-in alternative to StateStore (same methods) that also holds the audit
+trail and the inbound work journal (the journal_* methods of
+MessageJournal). Sessions, aliases (both directions), the inbound watermark
+and trail events live in indexed tables, so lookups stay O(log n) and the
+trail can be queried by sender, session or time without scanning a JSONL
+file.
+
+On first open the existing agent_state.json and trail (trail.jsonl and its
+rotated trail.*.jsonl.gz segments) are imported once (the files are left
+in place). To migrate by hand:
+
+  python sqlite_store.py --db agent_state.db --state agent_state.json --trail trail.jsonl
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+import metrics
+import tracing
+from journal import FINISHED, advance
+from trail_writer import segments
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    phone      TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_session ON sessions(session_id);
+CREATE TABLE IF NOT EXISTS aliases (
+    name       TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS aliases_by_session ON aliases(session_id);
+CREATE TABLE IF NOT EXISTS trail (
+    id         INTEGER PRIMARY KEY,
+    ts         TEXT NOT NULL,
+    sender     TEXT,
+    session_id TEXT,
+    action     TEXT,
+    event      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trail_by_ts ON trail(ts);
+CREATE INDEX IF NOT EXISTS trail_by_sender ON trail(sender, ts);
+CREATE INDEX IF NOT EXISTS trail_by_session ON trail(session_id, ts);
+CREATE TABLE IF NOT EXISTS session_usage (
+    session_id     TEXT PRIMARY KEY,
+    turns          INTEGER NOT NULL,
+    prompt_chars   INTEGER NOT NULL,
+    response_chars INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS carryover (
+    phone        TEXT PRIMARY KEY,
+    from_session TEXT NOT NULL,
+    summary      TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    sid     TEXT PRIMARY KEY,
+    stage   TEXT NOT NULL,
+    updated REAL NOT NULL,
+    date    TEXT,
+    entry   TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS journal_by_stage ON journal(stage, date);
+"""
+
+WATERMARK_KEY = "last_processed_time"
+MIGRATED_KEY = "migrated_from_files"
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _trail_row(event: dict) -> tuple:
+    event = dict(event)
+    event.setdefault("ts", _now())
+    return (
+        event["ts"],
+        event.get("from"),
+        event.get("session_id") or event.get("old_session"),
+        event.get("action") or "reply",
+        json.dumps(event, ensure_ascii=True),
+    )
+
+
+class SqliteStore:
+    """
+    One shared connection in autocommit mode, guarded by a lock; WAL lets
+    readers (e.g. ad-hoc sqlite3 queries) run while the agent writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(SCHEMA)
+
+    def _one(self, sql: str, params: tuple = ()):
+        with metrics.timer("agent_state_load_seconds", backend="sqlite"), \
+                tracing.child("state.load", backend="sqlite"), self._lock:
+            row = self._conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    def _exec(self, sql: str, params: tuple = ()) -> int:
+        with metrics.timer("agent_state_save_seconds", backend="sqlite"), \
+                tracing.child("state.save", backend="sqlite"), self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    # -- lifecycle (StateStore-compatible) ----------------------------------
+
+    def flush(self) -> None:
+        """Writes are committed immediately; nothing to do."""
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # -- watermark ----------------------------------------------------------
+
+    def get_last_processed_time(self) -> Optional[datetime]:
+        lpt = self._one("SELECT value FROM meta WHERE key = ?", (WATERMARK_KEY,))
+        return datetime.fromisoformat(lpt) if lpt else None
+
+    def set_last_processed_time(self, dt: datetime) -> None:
+        self._exec(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (WATERMARK_KEY, dt.isoformat()),
+        )
+
+    # -- sessions -----------------------------------------------------------
+
+    def get_session(self, phone: str) -> Optional[str]:
+        return self._one("SELECT session_id FROM sessions WHERE phone = ?", (phone,))
+
+    def set_session(self, phone: str, session_id: str) -> None:
+        self._exec(
+            "INSERT INTO sessions (phone, session_id, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(phone) DO UPDATE SET "
+            "session_id = excluded.session_id, updated_at = excluded.updated_at",
+            (phone, session_id, _now()),
+        )
+
+    def pop_session(self, phone: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "DELETE FROM sessions WHERE phone = ? RETURNING session_id", (phone,)
+            ).fetchone()
+        return row[0] if row else None
+
+    # -- aliases ------------------------------------------------------------
+
+    def get_alias(self, name: str) -> Optional[str]:
+        return self._one(
+            "SELECT session_id FROM aliases WHERE name = ?", (name.lower(),)
+        )
+
+    def set_alias(self, name: str, session_id: str) -> None:
+        # Upsert keeps the rowid, so alias_for_session's "first alias"
+        # ordering matches the JSON store's dict ordering.
+        self._exec(
+            "INSERT INTO aliases (name, session_id) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET session_id = excluded.session_id",
+            (name.lower(), session_id),
+        )
+
+    def alias_for_session(self, session_id: str) -> Optional[str]:
+        return self._one(
+            "SELECT name FROM aliases WHERE session_id = ? ORDER BY rowid LIMIT 1",
+            (session_id,),
+        )
+
+    # -- session growth (compaction) ----------------------------------------
+
+    def add_session_usage(self, session_id: str, prompt_chars: int, response_chars: int) -> dict:
+        with self._lock:
+            row = self._conn.execute(
+                "INSERT INTO session_usage VALUES (?, 1, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET turns = turns + 1, "
+                "prompt_chars = prompt_chars + excluded.prompt_chars, "
+                "response_chars = response_chars + excluded.response_chars "
+                "RETURNING turns, prompt_chars, response_chars",
+                (session_id, prompt_chars, response_chars),
+            ).fetchone()
+        return {"turns": row[0], "prompt_chars": row[1], "response_chars": row[2]}
+
+    def reset_session_usage(self, session_id: str) -> None:
+        self._exec("DELETE FROM session_usage WHERE session_id = ?", (session_id,))
+
+    def set_carryover(self, phone: str, from_session: str, summary: str) -> None:
+        self._exec(
+            "INSERT OR REPLACE INTO carryover VALUES (?, ?, ?)",
+            (phone, from_session, summary),
+        )
+
+    def get_carryover(self, phone: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT from_session, summary FROM carryover WHERE phone = ?", (phone,)
+            ).fetchone()
+        return {"from_session": row[0], "summary": row[1]} if row else None
+
+    def pop_carryover(self, phone: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "DELETE FROM carryover WHERE phone = ? RETURNING from_session, summary",
+                (phone,),
+            ).fetchone()
+        return {"from_session": row[0], "summary": row[1]} if row else None
+
+    # -- audit trail --------------------------------------------------------
+
+    def append_trail(self, event: dict) -> None:
+        self._exec(
+            "INSERT INTO trail (ts, sender, session_id, action, event) "
+            "VALUES (?, ?, ?, ?, ?)",
+            _trail_row(event),
+        )
+
+    def query_trail(
+        self,
+        sender: Optional[str] = None,
+        session_id: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        limit: int = 100,
+    ) -> list[dict]:
+        """Trail events matching all given filters, newest first."""
+        where, params = [], []
+        for col, op, val in (
+            ("sender", "=", sender),
+            ("session_id", "=", session_id),
+            ("ts", ">=", since),
+            ("ts", "<", until),
+        ):
+            if val is not None:
+                where.append(f"{col} {op} ?")
+                params.append(val)
+        sql = "SELECT event FROM trail"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    # -- inbound work journal (MessageJournal-compatible) ---------------------
+
+    def journal_record(self, sid: str, stage: str, **fields) -> bool:
+        # The read and the write are one write transaction, so another
+        # process (AGENT_CLUSTER) cannot slip a record in between and have
+        # it overwritten by a lower stage.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT entry FROM journal WHERE sid = ?", (sid,)
+                ).fetchone()
+                entry = advance(row and json.loads(row[0]), sid, stage, fields)
+                if entry is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)",
+                        (sid, stage, entry["updated"], entry.get("date"),
+                         json.dumps(entry, ensure_ascii=True)),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return entry is not None
+
+    def journal_get(self, sid: str) -> Optional[dict]:
+        entry = self._one("SELECT entry FROM journal WHERE sid = ?", (sid,))
+        return json.loads(entry) if entry else None
+
+    def journal_unfinished(self) -> list[dict]:
+        marks = ", ".join("?" * len(FINISHED))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT entry FROM journal WHERE stage NOT IN ({marks}) ORDER BY date",
+                FINISHED,
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def journal_prune(self, older_than: float) -> int:
+        marks = ", ".join("?" * len(FINISHED))
+        return self._exec(
+            f"DELETE FROM journal WHERE stage IN ({marks}) AND updated < ?",
+            (*FINISHED, time.time() - older_than),
+        )
+
+    # -- migration ----------------------------------------------------------
+
+    def migrate_from_files(self, state_path: str, trail_path: str) -> bool:
+        """
+        Import agent_state.json and the trail (rotated segments oldest first,
+        then trail.jsonl) once, in one transaction. Returns False if this
+        database was already migrated.
+        """
+        if self._one("SELECT value FROM meta WHERE key = ?", (MIGRATED_KEY,)):
+            return False
+
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                state = json.load(f)
+
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN")
+            try:
+                now = _now()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                    [(p, s, now) for p, s in state.get("sessions", {}).items()],
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO aliases VALUES (?, ?)",
+                    list(state.get("aliases", {}).items()),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO session_usage VALUES (?, ?, ?, ?)",
+                    [
+                        (sid, u.get("turns", 0), u.get("prompt_chars", 0),
+                         u.get("response_chars", 0))
+                        for sid, u in state.get("session_usage", {}).items()
+                    ],
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO carryover VALUES (?, ?, ?)",
+                    [
+                        (phone, c["from_session"], c["summary"])
+                        for phone, c in state.get("carryover", {}).items()
+                    ],
+                )
+                if state.get(WATERMARK_KEY):
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (WATERMARK_KEY, state[WATERMARK_KEY]),
+                    )
+                trail_rows = 0
+                trail_files = segments(trail_path)
+                if os.path.exists(trail_path):
+                    trail_files.append(trail_path)
+                for path in trail_files:
+                    cur = conn.executemany(
+                        "INSERT INTO trail (ts, sender, session_id, action, event) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (_trail_row(e) for e in _read_jsonl(path)),
+                    )
+                    trail_rows += cur.rowcount
+                conn.execute(
+                    "INSERT INTO meta VALUES (?, ?)", (MIGRATED_KEY, now)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        logging.info(
+            f"Migrated {len(state.get('sessions', {}))} sessions, "
+            f"{len(state.get('aliases', {}))} aliases and {trail_rows} trail "
+            f"events into {self.path}"
+        )
+        return True
+
+
+def _read_jsonl(path: str) -> Iterable[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    try:
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping bad trail line: {line[:100]}...")
+    except (OSError, EOFError) as e:
+        # e.g. a segment cut short by a crash mid-rotation: keep what was read
+        logging.error(f"Could not read all of {path}: {e}")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Migrate agent state/trail into SQLite.")
+    ap.add_argument("--db", default="agent_state.db")
+    ap.add_argument("--state", default="agent_state.json")
+    ap.add_argument("--trail", default="trail.jsonl")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    store = SqliteStore(args.db)
+    try:
+        if not store.migrate_from_files(args.state, args.trail):
+            print(f"{args.db} was already migrated; nothing to do.")
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,210 @@
+"""
+state_store.py — in-memory agent state with atomic write-behind persistence.
+
+agent_state.json is read once at startup and kept in memory. Mutations mark
+the store dirty; a background thread writes it back at most every
+flush_interval seconds via temp file + fsync + rename, so the file on disk
+is always either the old or the new complete state, never a torn write.
+
+The JSON layout keeps last_processed_time, sessions and aliases as before
+(so existing state files load as-is), plus session_usage (per-session turn
+and size counters) and carryover (summaries waiting to seed a sender's next
+session).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime
+from typing import Optional
+
+import metrics
+import tracing
+
+
+class StateStore:
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()  # one writer at a time, in order
+        self._dirty = threading.Event()
+        self._closed = threading.Event()
+        self._state = self.load()
+        self._sessions: dict = self._state.setdefault("sessions", {})
+        self._aliases: dict = self._state.setdefault("aliases", {})
+        self._usage: dict = self._state.setdefault("session_usage", {})
+        self._carryover: dict = self._state.setdefault("carryover", {})
+        # session_id -> {alias: None}, insertion-ordered like the alias map
+        self._alias_index: dict[str, dict] = {}
+        for name, sid in self._aliases.items():
+            self._alias_index.setdefault(sid, {})[name] = None
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="state-flush", daemon=True
+        )
+        self._flusher.start()
+
+    # -- persistence --------------------------------------------------------
+
+    def load(self) -> dict:
+        """Read the state file from disk (startup only)."""
+        try:
+            if os.path.exists(self.path):
+                with metrics.timer("agent_state_load_seconds", backend="json"), \
+                        tracing.span("state.load", backend="json"), \
+                        open(self.path, "r") as f:
+                    return json.load(f)
+        except Exception as e:
+            logging.error(f"Error reading state file: {e}")
+        return {}
+
+    def flush(self) -> None:
+        """Write the current state to disk atomically if it changed."""
+        with self._io_lock:
+            if not self._dirty.is_set():
+                return
+            with self._lock:
+                self._dirty.clear()
+                data = json.dumps(self._state, separators=(",", ":"))
+            try:
+                with metrics.timer("agent_state_save_seconds", backend="json"), \
+                        tracing.span("state.save", backend="json", bytes=len(data)):
+                    atomic_write(self.path, data)
+            except Exception as e:
+                self._dirty.set()
+                logging.error(f"Error saving state file: {e}")
+
+    def _flush_loop(self) -> None:
+        while not self._closed.is_set():
+            self._dirty.wait()
+            # Batch whatever else changes within the interval into one write.
+            self._closed.wait(self.flush_interval)
+            self.flush()
+
+    def close(self) -> None:
+        """Stop the flusher and write any pending changes."""
+        self._closed.set()
+        self._dirty.set()  # wake the flusher so it can exit
+        self._flusher.join(timeout=5)
+        self.flush()
+
+    def _mark_dirty(self) -> None:
+        self._dirty.set()
+
+    # -- watermark ----------------------------------------------------------
+
+    def get_last_processed_time(self) -> Optional[datetime]:
+        with self._lock:
+            lpt = self._state.get("last_processed_time")
+        return datetime.fromisoformat(lpt) if lpt else None
+
+    def set_last_processed_time(self, dt: datetime) -> None:
+        with self._lock:
+            self._state["last_processed_time"] = dt.isoformat()
+            self._mark_dirty()
+
+    # -- sessions -----------------------------------------------------------
+
+    def get_session(self, phone: str) -> Optional[str]:
+        with self._lock:
+            return self._sessions.get(phone)
+
+    def set_session(self, phone: str, session_id: str) -> None:
+        with self._lock:
+            self._sessions[phone] = session_id
+            self._mark_dirty()
+
+    def pop_session(self, phone: str) -> Optional[str]:
+        with self._lock:
+            old = self._sessions.pop(phone, None)
+            if old is not None:
+                self._mark_dirty()
+            return old
+
+    # -- aliases ------------------------------------------------------------
+
+    def get_alias(self, name: str) -> Optional[str]:
+        with self._lock:
+            return self._aliases.get(name.lower())
+
+    def set_alias(self, name: str, session_id: str) -> None:
+        name = name.lower()
+        with self._lock:
+            old = self._aliases.get(name)
+            if old is not None and old in self._alias_index:
+                self._alias_index[old].pop(name, None)
+                if not self._alias_index[old]:
+                    del self._alias_index[old]
+            self._aliases[name] = session_id
+            self._alias_index.setdefault(session_id, {})[name] = None
+            self._mark_dirty()
+
+    def alias_for_session(self, session_id: str) -> Optional[str]:
+        """First alias assigned to session_id, if any (O(1))."""
+        with self._lock:
+            names = self._alias_index.get(session_id)
+            return next(iter(names)) if names else None
+
+    # -- session growth (compaction) ----------------------------------------
+
+    def add_session_usage(self, session_id: str, prompt_chars: int, response_chars: int) -> dict:
+        """Count one turn against session_id; returns the updated totals."""
+        with self._lock:
+            usage = self._usage.setdefault(
+                session_id, {"turns": 0, "prompt_chars": 0, "response_chars": 0}
+            )
+            usage["turns"] += 1
+            usage["prompt_chars"] += prompt_chars
+            usage["response_chars"] += response_chars
+            self._mark_dirty()
+            return dict(usage)
+
+    def reset_session_usage(self, session_id: str) -> None:
+        with self._lock:
+            if self._usage.pop(session_id, None) is not None:
+                self._mark_dirty()
+
+    def set_carryover(self, phone: str, from_session: str, summary: str) -> None:
+        with self._lock:
+            self._carryover[phone] = {"from_session": from_session, "summary": summary}
+            self._mark_dirty()
+
+    def get_carryover(self, phone: str) -> Optional[dict]:
+        with self._lock:
+            carry = self._carryover.get(phone)
+            return dict(carry) if carry else None
+
+    def pop_carryover(self, phone: str) -> Optional[dict]:
+        with self._lock:
+            carry = self._carryover.pop(phone, None)
+            if carry is not None:
+                self._mark_dirty()
+            return carry
+
+
+def atomic_write(path: str, data: str) -> None:
+    """Write data to path via a fsynced temp file in the same directory."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".state-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # Persist the rename itself.
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
@@ -0,0 +1,244 @@
+"""
+tracing.py — per-message span trees, written as OpenTelemetry JSON.
+
+Module-level, like metrics.py, so any part of the agent can add a span
+without passing objects around:
+
+  with tracing.root("message", msg.sid, sender=msg.from_):
+      with tracing.span("call_opencode_wrapper") as s:
+          ...
+          s.set(output_len=len(response))
+
+A root span starts a trace whose ID is derived from its key (the Twilio
+MessageSid), so a message re-sent after a restart lands in the same trace.
+span() opens a child of the current span (a contextvar, so each worker
+thread has its own); outside any trace it starts a trace of its own, which
+is how background work (polls, state flushes) shows up; child() does
+not, for calls made too often to trace on their own. Work handed to
+another thread carries its parent along with current() / attach().
+record() adds a span whose start and end were measured elsewhere (e.g.
+process spawn, from a callback).
+
+Finished spans are appended, one OTLP/JSON ExportTraceServiceRequest per
+line, to a file written by a TrailWriter (so it is batched off the calling
+thread and rotated like the trail). The OpenTelemetry collector's
+otlpjsonfile receiver, or jq, reads it as is. Tracing is off until
+enable() is called; until then span() and friends do nothing.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import hashlib
+import os
+import socket
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from trail_writer import TrailWriter
+
+SERVICE_NAME = "whatsapp-agent"
+
+_writer: Optional[TrailWriter] = None
+_sample = 1.0
+_resource: dict = {}
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+
+# OTLP status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end",
+                 "attrs", "error", "sampled")
+
+    def __init__(self, name: str, trace_id: str, parent: Optional["Span"],
+                 start: int, sampled: bool, attrs: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start = start
+        self.end = None
+        self.attrs = attrs
+        self.error = None
+        self.sampled = sampled
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def fail(self, message: str) -> None:
+        """Mark the span as failed without raising (e.g. a fallback reply)."""
+        self.error = message
+
+
+def enable(path: str, sample: float = 1.0, resource: Optional[dict] = None,
+           **writer_kwargs) -> None:
+    """
+    Start writing spans to `path` (writer_kwargs go to TrailWriter). Only a
+    `sample` fraction of traces is kept, chosen by trace ID so a trace is
+    kept or dropped as a whole. `resource` adds process-wide attributes.
+    """
+    global _writer, _sample, _resource
+    _sample = sample
+    _resource = {
+        "service.name": SERVICE_NAME,
+        "host.name": socket.gethostname(),
+        "process.pid": os.getpid(),
+        **(resource or {}),
+    }
+    _writer = TrailWriter(path, metric="agent_trace_write_seconds", **writer_kwargs)
+
+
+def disable() -> None:
+    """Write the spans still queued and stop tracing."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+def enabled() -> bool:
+    return _writer is not None
+
+
+def current() -> Optional[Span]:
+    """The span open on this thread, to hand to work done on another thread."""
+    return _current.get()
+
+
+@contextmanager
+def attach(parent: Optional[Span]):
+    """Make `parent` the current span for the `with` block."""
+    token = _current.set(parent)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def _trace_id(key: Optional[str]) -> str:
+    if key is None:
+        return os.urandom(16).hex()
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def _sampled(trace_id: str) -> bool:
+    return _sample >= 1 or int(trace_id[:8], 16) < _sample * 0x100000000
+
+
+def _open(name: str, parent: Optional[Span], key: Optional[str],
+          start: Optional[int], attrs: dict) -> Span:
+    if parent is None:
+        trace_id = _trace_id(key)
+        sampled = _sampled(trace_id)
+    else:
+        trace_id, sampled = parent.trace_id, parent.sampled
+    return Span(name, trace_id, parent, start or time.time_ns(), sampled, attrs)
+
+
+@contextmanager
+def _run(span: Span):
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = span.error or f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        span.end = time.time_ns()
+        _export(span)
+
+
+@contextmanager
+def root(name: str, key: Optional[str] = None, start: Optional[int] = None, **attrs):
+    """
+    Start a new trace (keyed by e.g. a MessageSid) for the `with` block.
+    `start` (time.time_ns()) backdates the span, e.g. to when the message
+    was sent. Yields the Span, or None when tracing is off.
+    """
+    if _writer is None:
+        yield None
+        return
+    with _run(_open(name, None, key, start, attrs)) as s:
+        yield s
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """A child of the current span (or a new trace) for the `with` block."""
+    if _writer is None:
+        yield None
+        return
+    with _run(_open(name, _current.get(), None, None, attrs)) as s:
+        yield s
+
+
+@contextmanager
+def child(name: str, **attrs):
+    """Like span(), but only inside a trace: for calls too frequent to trace alone."""
+    parent = _current.get()
+    if _writer is None or parent is None:
+        yield None
+        return
+    with _run(_open(name, parent, None, None, attrs)) as s:
+        yield s
+
+
+def record(name: str, start: int, end: int, error: Optional[str] = None, **attrs) -> None:
+    """Add a finished child of the current span (if any) from measured times."""
+    parent = _current.get()
+    if _writer is None or parent is None:
+        return
+    s = _open(name, parent, None, start, attrs)
+    s.end = max(end, start)
+    s.error = error
+    _export(s)
+
+
+# ---------------------------------------------------------------------------
+# Export (OTLP/JSON)
+# ---------------------------------------------------------------------------
+
+def _value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def _attributes(attrs: dict) -> list:
+    return [{"key": k, "value": _value(v)} for k, v in attrs.items() if v is not None]
+
+
+def _export(span: Span) -> None:
+    writer = _writer
+    if writer is None or not span.sampled:
+        return
+    data = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end),
+        "attributes": _attributes(span.attrs),
+        "status": (
+            {"code": STATUS_ERROR, "message": span.error[:500]}
+            if span.error else {"code": STATUS_OK}
+        ),
+    }
+    if span.parent_id:
+        data["parentSpanId"] = span.parent_id
+    writer.append({
+        "resourceSpans": [{
+            "resource": {"attributes": _attributes(_resource)},
+            "scopeSpans": [{"scope": {"name": "whatsapp.agent"}, "spans": [data]}],
+        }]
+    })
@@ -0,0 +1,437 @@
+"""
+trail_index.py — indexed queries and analytics over the audit trail.
+
+trail.jsonl (and its rotated trail.*.jsonl.gz segments, see trail_writer.py)
+only ever grows, so answering "p95 reply time for this sender this week"
+by scanning it gets slower every day. This keeps a sidecar SQLite index
+(trail.jsonl.idx by default) with one row per event: file, byte offset and
+length, plus the fields queries filter and aggregate on (time, sender,
+session, action, reply latency and sizes).
+
+Reply latency is time to reply-ready: from the inbound message's
+date_sent to when the reply event was logged, which happens before the
+reply is handed to the outbound queue. Outbound pacing and Twilio send
+time are not included (see agent_outbound_pending and
+agent_twilio_send_seconds for those).
+
+Updating is incremental: the active file is read from the last indexed
+offset, and each rotated segment is indexed once. A rotation starts the
+active file over, so its rows are dropped and the new segment is indexed
+in their place; deleted segments drop their rows. Rotation is told by the
+active file's first line (kept as a hash), not only by its inode, which
+the filesystem may hand straight back to the new file. Filters and aggregates
+run on the index alone; listing events seeks straight to their offsets.
+
+  python trail_index.py stats --since 2026-02-09 --sender whatsapp:+1555...
+  python trail_index.py stats --by session --format table
+  python trail_index.py events --action session_reset --limit 20
+  python trail_index.py update
+
+With AGENT_STATE_BACKEND=sqlite the trail is already an indexed table in
+agent_state.db; see SqliteStore.query_trail.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from trail_writer import segments
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id      INTEGER PRIMARY KEY,
+    name    TEXT NOT NULL UNIQUE,
+    inode   INTEGER,
+    head    TEXT,      -- active file: hash of its first line
+    indexed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS events (
+    file_id      INTEGER NOT NULL,
+    offset       INTEGER NOT NULL,
+    length       INTEGER NOT NULL,
+    ts           TEXT,
+    sender       TEXT,
+    session_id   TEXT,
+    action       TEXT NOT NULL,
+    latency      REAL,     -- reply events: seconds from inbound to reply-ready
+    prompt_len   INTEGER,
+    response_len INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_by_ts ON events(ts);
+CREATE INDEX IF NOT EXISTS events_by_sender ON events(sender, ts);
+CREATE INDEX IF NOT EXISTS events_by_session ON events(session_id, ts);
+CREATE INDEX IF NOT EXISTS events_by_action ON events(action, ts);
+CREATE INDEX IF NOT EXISTS events_by_file ON events(file_id, offset);
+"""
+
+HEAD_BYTES = 4096  # enough of the first line to tell trail files apart
+
+GROUP_COLUMNS = {
+    "sender": "sender",
+    "session": "session_id",
+    "action": "action",
+    "day": "substr(ts, 1, 10)",
+}
+
+
+def _parse_ts(value) -> Optional[datetime]:
+    try:
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def event_row(event: dict) -> tuple:
+    """(ts, sender, session_id, action, latency, prompt_len, response_len)."""
+    ts = _parse_ts(event.get("ts"))
+    inbound = _parse_ts(event.get("inbound_ts"))
+    action = event.get("action") or "reply"
+    latency = None
+    if action == "reply" and ts and inbound:
+        latency = (ts - inbound).total_seconds()
+    response_len = event.get("response_len")
+    if response_len is None and isinstance(event.get("response"), str):
+        response_len = len(event["response"])
+    return (
+        ts.astimezone(timezone.utc).isoformat() if ts else None,
+        event.get("from"),
+        event.get("session_id") or event.get("old_session"),
+        action,
+        latency,
+        event.get("prompt_len"),
+        response_len,
+    )
+
+
+def head_hash(path: str) -> Optional[str]:
+    """Hash of the file's first line, or None until one has been written."""
+    try:
+        with open(path, "rb") as f:
+            line = f.readline(HEAD_BYTES)
+    except OSError:
+        return None
+    if not line.endswith(b"\n") and len(line) < HEAD_BYTES:
+        return None
+    return hashlib.sha1(line).hexdigest()
+
+
+def normalize_time(value: Optional[str]) -> Optional[str]:
+    """An ISO date/time (UTC if no zone given) in the index's ts format."""
+    if value is None:
+        return None
+    dt = _parse_ts(value)
+    if dt is None:
+        raise ValueError(f"not an ISO date/time: {value}")
+    return dt.astimezone(timezone.utc).isoformat()
+
+
+def percentiles(values: list[float]) -> dict:
+    """Nearest-rank percentiles, as in bench/replay.py."""
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+
+    def pct(p: float) -> float:
+        return v[min(len(v) - 1, max(0, math.ceil(p * len(v)) - 1))]
+    return {
+        "n": len(v), "p50": pct(0.5), "p90": pct(0.9), "p95": pct(0.95),
+        "p99": pct(0.99), "max": v[-1], "mean": sum(v) / len(v),
+    }
+
+
+class TrailIndex:
+    def __init__(self, trail_path: str, index_path: Optional[str] = None):
+        self.trail_path = trail_path
+        self.index_path = index_path or trail_path + ".idx"
+        self._conn = sqlite3.connect(self.index_path)
+        self._conn.executescript(SCHEMA)
+        columns = [r[1] for r in self._conn.execute("PRAGMA table_info(files)")]
+        if "head" not in columns:
+            # Index from before first-line hashes: the active file has none
+            # stored, so it is indexed again once.
+            self._conn.execute("ALTER TABLE files ADD COLUMN head TEXT")
+
+    def close(self) -> None:
+        self._conn.close()
+
+    # -- indexing -------------------------------------------------------------
+
+    def update(self) -> int:
+        """Bring the index up to date; returns the number of events added."""
+        conn = self._conn
+        added = 0
+        with conn:
+            known = {
+                name: (fid, inode, head, indexed)
+                for fid, name, inode, head, indexed in conn.execute(
+                    "SELECT id, name, inode, head, indexed FROM files"
+                )
+            }
+            present = [os.path.basename(p) for p in segments(self.trail_path)]
+            active = os.path.basename(self.trail_path)
+            if os.path.exists(self.trail_path):
+                present.append(active)
+
+            for name in set(known) - set(present):
+                self._drop_file(known.pop(name)[0])
+
+            directory = os.path.dirname(os.path.abspath(self.trail_path))
+            for name in present:
+                path = os.path.join(directory, name)
+                fid, inode, head, indexed = known.get(name, (None, None, None, 0))
+                if name == active:
+                    st = os.stat(path)
+                    current = head_hash(path)
+                    if fid is not None and (
+                        inode != st.st_ino or st.st_size < indexed
+                        or (indexed and head != current)
+                    ):
+                        # Rotated (or truncated): start this file over.
+                        self._drop_file(fid)
+                        fid, indexed = None, 0
+                    if fid is not None and st.st_size == indexed:
+                        continue
+                    inode = st.st_ino
+                elif fid is not None:
+                    continue  # segments never change once written
+                if fid is None:
+                    fid = conn.execute(
+                        "INSERT INTO files (name, inode) VALUES (?, ?)", (name, inode)
+                    ).lastrowid
+                n, indexed = self._index_file(fid, path, indexed)
+                if name == active:
+                    # Hashed before reading: a rotation during the read
+                    # shows up as a mismatch next time.
+                    head = current or head_hash(path)
+                conn.execute(
+                    "UPDATE files SET inode = ?, head = ?, indexed = ? WHERE id = ?",
+                    (inode, head, indexed, fid),
+                )
+                added += n
+        return added
+
+    def _drop_file(self, fid: int) -> None:
+        self._conn.execute("DELETE FROM events WHERE file_id = ?", (fid,))
+        self._conn.execute("DELETE FROM files WHERE id = ?", (fid,))
+
+    def _index_file(self, fid: int, path: str, start: int) -> tuple[int, int]:
+        """Index complete lines from byte `start`; returns (events, new offset)."""
+        opener = gzip.open if path.endswith(".gz") else open
+        rows = []
+        offset = start
+        try:
+            with opener(path, "rb") as f:
+                f.seek(start)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # being written; picked up next time
+                    length = len(line)
+                    if line.strip():
+                        try:
+                            event = json.loads(line)
+                        except json.JSONDecodeError:
+                            logging.warning(f"Skipping bad trail line at {path}:{offset}")
+                        else:
+                            rows.append((fid, offset, length, *event_row(event)))
+                    offset += length
+        except (OSError, EOFError) as e:
+            # e.g. a segment cut short by a crash mid-rotation: keep what was read
+            logging.error(f"Could not read all of {path}: {e}")
+        self._conn.executemany(
+            "INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        return len(rows), offset
+
+    # -- queries --------------------------------------------------------------
+
+    @staticmethod
+    def _where(
+        sender: Optional[str] = None,
+        session_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> tuple[str, list]:
+        where, params = [], []
+        for col, op, val in (
+            ("sender", "=", sender),
+            ("session_id", "=", session_id),
+            ("action", "=", action),
+            ("ts", ">=", normalize_time(since)),
+            ("ts", "<", normalize_time(until)),
+        ):
+            if val is not None:
+                where.append(f"{col} {op} ?")
+                params.append(val)
+        return (" WHERE " + " AND ".join(where) if where else ""), params
+
+    def events(self, limit: int = 100, **filters) -> list[dict]:
+        """Matching events, newest first, read from the trail by offset."""
+        where, params = self._where(**filters)
+        rows = self._conn.execute(
+            "SELECT files.name, offset, length FROM events "
+            "JOIN files ON files.id = events.file_id"
+            f"{where} ORDER BY ts DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        directory = os.path.dirname(os.path.abspath(self.trail_path))
+        by_file: dict[str, list] = {}
+        for i, (name, offset, length) in enumerate(rows):
+            by_file.setdefault(name, []).append((offset, length, i))
+
+        found: list = [None] * len(rows)
+        for name, spans in by_file.items():
+            path = os.path.join(directory, name)
+            opener = gzip.open if name.endswith(".gz") else open
+            # Ascending offsets: gzip seeks forward without restarting.
+            with opener(path, "rb") as f:
+                for offset, length, i in sorted(spans):
+                    f.seek(offset)
+                    found[i] = json.loads(f.read(length))
+        return [e for e in found if e is not None]
+
+    def stats(self, by: Optional[str] = None, **filters) -> dict:
+        """
+        Event count, per-action counts, and time to reply-ready / response size
+        percentiles for matching events; grouped by sender, session, action
+        or day if `by` is given.
+        """
+        where, params = self._where(**filters)
+        group = GROUP_COLUMNS[by] if by else "''"
+        groups: dict = {}
+        for key, action, latency, response_len in self._conn.execute(
+            f"SELECT {group}, action, latency, response_len FROM events{where}",
+            params,
+        ):
+            g = groups.setdefault(key, {"events": 0, "actions": {}, "lat": [], "size": []})
+            g["events"] += 1
+            g["actions"][action] = g["actions"].get(action, 0) + 1
+            if latency is not None:
+                g["lat"].append(latency)
+            if response_len is not None:
+                g["size"].append(response_len)
+
+        def summary(g: dict) -> dict:
+            return {
+                "events": g["events"],
+                "actions": dict(sorted(g["actions"].items())),
+                "reply_ready_s": percentiles(g["lat"]),
+                "response_chars": percentiles(g["size"]),
+            }
+
+        if not by:
+            return summary(groups.get("", {"events": 0, "actions": {}, "lat": [], "size": []}))
+        ordered = sorted(groups.items(), key=lambda kv: -kv[1]["events"])
+        return {str(key): summary(g) for key, g in ordered}
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def _fmt(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+def print_table(header: list[str], rows: Iterable[list]) -> None:
+    rows = [[_fmt(v) for v in row] for row in rows]
+    widths = [max([len(h)] + [len(r[i]) for r in rows]) for i, h in enumerate(header)]
+    print("  ".join(h.ljust(w) for h, w in zip(header, widths)).rstrip())
+    print("  ".join("-" * w for w in widths))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+
+
+def print_stats_table(result: dict, by: Optional[str]) -> None:
+    groups = result if by else {"all": result}
+    header = [by or "", "events", "ready n", "ready p50", "ready p95", "ready p99",
+              "chars p50", "chars p95", "actions"]
+    rows = []
+    for key, s in groups.items():
+        lat, size = s["reply_ready_s"], s["response_chars"]
+        actions = " ".join(f"{a}={n}" for a, n in s["actions"].items())
+        rows.append([key, s["events"], lat["n"], lat.get("p50"), lat.get("p95"),
+                     lat.get("p99"), size.get("p50"), size.get("p95"), actions])
+    print_table(header, rows)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Indexed queries over trail.jsonl.")
+    ap.add_argument("--trail", default="trail.jsonl")
+    ap.add_argument("--index", help="Sidecar index (default: <trail>.idx)")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("update", help="Index new trail events and exit")
+    for name, help_text in (
+        ("events", "List matching events, newest first"),
+        ("stats", "Counts, reply-ready time and size percentiles, per-action breakdown"),
+    ):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--sender", help="e.g. whatsapp:+15551234567")
+        p.add_argument("--session", dest="session_id")
+        p.add_argument("--action", help="reply, session_reset, session_resume, ...")
+        p.add_argument("--since", help="ISO date/time (UTC unless a zone is given)")
+        p.add_argument("--until", help="ISO date/time, exclusive")
+        p.add_argument("--format", choices=("json", "table"), default="json")
+        if name == "events":
+            p.add_argument("--limit", type=int, default=100)
+        else:
+            p.add_argument("--by", choices=sorted(GROUP_COLUMNS))
+
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+
+    index = TrailIndex(args.trail, args.index)
+    try:
+        added = index.update()
+        if args.command == "update":
+            print(f"Indexed {added} new events into {index.index_path}.")
+            return 0
+
+        filters = dict(
+            sender=args.sender, session_id=args.session_id, action=args.action,
+            since=args.since, until=args.until,
+        )
+        if args.command == "events":
+            events = index.events(limit=args.limit, **filters)
+            if args.format == "json":
+                for event in events:
+                    print(json.dumps(event, ensure_ascii=False))
+            else:
+                print_table(
+                    ["ts", "from", "action", "session_id", "inbound"],
+                    [[e.get("ts"), e.get("from"), e.get("action") or "reply",
+                      e.get("session_id") or e.get("old_session"),
+                      (e.get("inbound") or "")[:40]] for e in events],
+                )
+        else:
+            result = index.stats(by=args.by, **filters)
+            if args.format == "json":
+                print(json.dumps(result, indent=2))
+            else:
+                print_stats_table(result, args.by)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 2
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,123 @@
+"""
+trail_index_test.py — deterministic checks of incremental trail indexing.
+
+The index must follow the active trail file across appends and rotations,
+including a rotation whose new file got the old one's inode back (here:
+the file rewritten in place), and must never serve rows whose offsets
+point into a different file than the one they were read from.
+
+  python trail_index_test.py      (or: python -m pytest trail_index_test.py)
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+
+from trail_index import TrailIndex
+
+
+def event(n: int, sender: str = "whatsapp:+1") -> dict:
+    return {"ts": f"2026-01-01T00:00:{n:02d}+00:00", "from": sender,
+            "action": "reply", "response": "x" * n}
+
+
+def write(path: str, events: list[dict], mode: str = "a") -> None:
+    with open(path, mode, encoding="utf-8") as f:
+        f.writelines(json.dumps(e) + "\n" for e in events)
+
+
+def rotate(path: str, stamp: str) -> None:
+    """What TrailWriter does: rename, gzip, unlink."""
+    base, ext = os.path.splitext(path)
+    segment = f"{base}.{stamp}{ext}"
+    os.replace(path, segment)
+    with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+        dst.write(src.read())
+    os.unlink(segment)
+
+
+def times(index: TrailIndex) -> list[str]:
+    return sorted(e["ts"][17:19] for e in index.events(limit=1000))
+
+
+def test_appends_are_indexed_incrementally():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "trail.jsonl")
+        write(path, [event(1), event(2)])
+        index = TrailIndex(path)
+        try:
+            assert index.update() == 2
+            assert index.update() == 0
+            write(path, [event(3)])
+            with open(path, "a", encoding="utf-8") as f:
+                f.write('{"ts": "2026-01-01T00:00:04')  # still being written
+            assert index.update() == 1
+            assert times(index) == ["01", "02", "03"]
+        finally:
+            index.close()
+
+
+def test_rotation_moves_rows_to_the_segment():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "trail.jsonl")
+        write(path, [event(1), event(2)])
+        index = TrailIndex(path)
+        try:
+            index.update()
+            rotate(path, "20260101T000010000000")
+            write(path, [event(11), event(12), event(13)])
+            assert index.update() == 5
+            assert times(index) == ["01", "02", "11", "12", "13"]
+            assert index.stats()["events"] == 5
+        finally:
+            index.close()
+
+
+def test_new_file_with_the_old_inode_is_indexed_from_the_start():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "trail.jsonl")
+        write(path, [event(1), event(2)])
+        index = TrailIndex(path)
+        try:
+            index.update()
+            inode = os.stat(path).st_ino
+            # Same inode, at least as large: only the first line tells.
+            write(path, [event(21), event(22), event(23)], mode="w")
+            assert os.stat(path).st_ino == inode
+            assert index.update() == 3
+            assert times(index) == ["21", "22", "23"]
+        finally:
+            index.close()
+
+
+def test_index_from_before_head_hashes_is_upgraded():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "trail.jsonl")
+        write(path, [event(1), event(2)])
+        index = TrailIndex(path)
+        index.update()
+        index.close()
+        conn = sqlite3.connect(path + ".idx")
+        conn.execute("ALTER TABLE files DROP COLUMN head")
+        conn.close()
+
+        index = TrailIndex(path)
+        try:
+            assert index.update() == 2  # no hash to check against: once more
+            assert index.update() == 0
+            write(path, [event(3)])
+            assert index.update() == 1
+            assert times(index) == ["01", "02", "03"]
+        finally:
+            index.close()
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(f"ok  {name}")
@@ -0,0 +1,158 @@
+"""
+trail_writer.py — buffered, rotating, compressed audit-trail writer.
+
+append() only enqueues; a background thread drains the queue and writes
+events in groups (one write + flush per batch, at least every
+flush_interval seconds). When the active file passes rotate_bytes, or the
+day changes, it is renamed to a timestamped segment and gzip-compressed:
+
+  trail.jsonl                          active file
+  trail.20260216T000001123456.jsonl.gz rotated segments (newest `retention` kept)
+"""
+
+from __future__ import annotations
+
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+from datetime import datetime, timezone
+
+import metrics
+
+_STOP = object()
+
+
+class TrailWriter:
+    def __init__(
+        self,
+        path: str,
+        max_queue: int = 10000,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        rotate_bytes: int = 50 * 1024 * 1024,
+        rotate_daily: bool = True,
+        retention: int = 30,
+        metric: str = "agent_trail_write_seconds",
+    ):
+        self.path = path
+        self.metric = metric
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.retention = retention
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._day = None
+        self._thread = threading.Thread(
+            target=self._run, name="trail-writer", daemon=True
+        )
+        self._thread.start()
+
+    def append(self, event: dict) -> None:
+        """Queue one event. Blocks up to 1s if the queue is full, then drops."""
+        line = json.dumps(event, ensure_ascii=True) + "\n"
+        try:
+            self._queue.put(line, timeout=1)
+        except queue.Full:
+            logging.error("Trail queue full; dropping event")
+
+    def close(self) -> None:
+        """Write everything still queued, then stop the writer thread."""
+        self._queue.put(_STOP)
+        self._thread.join(timeout=10)
+
+    # -- writer thread ------------------------------------------------------
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            for item in self._drain(first):
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+            if batch:
+                with metrics.timer(self.metric):
+                    self._write(batch)
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _drain(self, first):
+        yield first
+        for _ in range(self.batch_size - 1):
+            try:
+                yield self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _write(self, lines: list[str]) -> None:
+        try:
+            self._maybe_rotate()
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._day = _file_day(self.path)
+            self._file.write("".join(lines))
+            self._file.flush()
+        except Exception as e:
+            logging.error(f"Error writing trail: {e}")
+
+    def _maybe_rotate(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return
+        today = datetime.now(timezone.utc).date()
+        day = self._day or _file_day(self.path)
+        if size < self.rotate_bytes and not (self.rotate_daily and day != today):
+            return
+
+        if self._file:
+            self._file.close()
+            self._file = None
+        base, ext = os.path.splitext(self.path)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        segment = f"{base}.{stamp}{ext}"
+        os.replace(self.path, segment)
+        with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.unlink(segment)
+        logging.info(f"Rotated trail to {segment}.gz")
+        self._prune()
+
+    def _prune(self) -> None:
+        """Keep the newest `retention` segments (0 keeps all)."""
+        if self.retention <= 0:
+            return
+        for old in segments(self.path)[:-self.retention]:
+            try:
+                os.unlink(old)
+                logging.info(f"Removed old trail segment {old}")
+            except OSError as e:
+                logging.error(f"Could not remove {old}: {e}")
+
+
+def segments(path: str) -> list[str]:
+    """Rotated, compressed segments for `path`, oldest first."""
+    base, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(base)}.*{ext}.gz"))
+
+
+def _file_day(path: str):
+    """UTC date the active file was last written (its mtime)."""
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(path), timezone.utc).date()
+    except OSError:
+        return datetime.now(timezone.utc).date()
@@ -0,0 +1,104 @@
+"""
+webhook.py — push-mode inbound receiver for the WhatsApp agent.
+
+Twilio (directly, or via the forwarding Function in twilio/whatsapp-receiver)
+POSTs each inbound message here. Requests are checked against the
+X-Twilio-Signature header and put on a queue that the agent's main loop
+drains, so a message is dispatched as soon as it arrives instead of on the
+next poll tick.
+"""
+
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from flask import Flask, Response, request
+from twilio.request_validator import RequestValidator
+from werkzeug.serving import make_server
+
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+
+@dataclass
+class InboundMessage:
+    """
+    The subset of a Twilio MessageInstance the agent reads, built from
+    webhook form fields so pushed and polled messages look the same.
+    """
+    sid: str
+    from_: str
+    to: str
+    body: str
+    date_sent: datetime
+    direction: str = "inbound"
+
+
+def create_app(
+    auth_token: str,
+    inbox: queue.Queue,
+    path: str = "/whatsapp",
+    public_url: Optional[str] = None,
+) -> Flask:
+    """
+    Build the Flask app that validates and enqueues inbound webhooks.
+
+    public_url is the exact URL Twilio signs against. Set it when the agent
+    sits behind a tunnel or reverse proxy, where request.url differs.
+    """
+    app = Flask(__name__)
+    validator = RequestValidator(auth_token)
+
+    @app.route(path, methods=["POST"])
+    def inbound():
+        params = request.form.to_dict()
+        signature = request.headers.get("X-Twilio-Signature", "")
+        url = public_url or request.url
+        if not validator.validate(url, params, signature):
+            logging.warning(f"Rejected webhook with bad signature from {request.remote_addr}")
+            return Response("invalid signature", status=403)
+
+        sid = params.get("MessageSid") or params.get("SmsMessageSid")
+        if not sid or not params.get("From"):
+            return Response("missing MessageSid/From", status=400)
+
+        # Webhooks carry no DateSent; Twilio stamps inbound messages on
+        # receipt, so our own receive time is a close upper bound.
+        inbox.put(InboundMessage(
+            sid=sid,
+            from_=params["From"],
+            to=params.get("To", ""),
+            body=params.get("Body", ""),
+            date_sent=datetime.now(timezone.utc),
+        ))
+        logging.info(f"Webhook queued {sid} from {params['From']}")
+        return Response(EMPTY_TWIML, mimetype="text/xml")
+
+    @app.route("/healthz", methods=["GET"])
+    def healthz():
+        return Response("ok", mimetype="text/plain")
+
+    return app
+
+
+class BackgroundServer:
+    """Run a WSGI app on a daemon thread (threaded werkzeug server)."""
+
+    def __init__(self, app, host: str, port: int, name: str = "http"):
+        self._server = make_server(host, port, app, threaded=True)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name=name, daemon=True
+        )
+        self.host = host
+        self.port = self._server.server_port
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._thread.join(timeout=5)